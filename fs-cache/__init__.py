@@ -4,78 +4,419 @@ Classes for salts filesystem cache for larger installations.
 import salt.utils
 
 import salt.config
+import os
 import time
 import multiprocessing
 import random
 import sys
+import re
+import fnmatch
 import zmq
-from fsworker import FSWorker
-from threading import Thread, Timer, Event
+from fsworker import FSWorker, ipc_addr, shard_name, shard_of, stat_sig, project
+from fsshm import ShmStore
+from fsstore import CacheStore, SingleFlight
+from fsnotify import Inotify
+from fsthrottle import Backoff, Backoffs
+from fsfilter import PathFilter
+from fssnap import read_snapshot, write_snapshot
+from fsstats import Histogram, prometheus, rss
+from fssched import Scheduler
+from threading import Thread
+from collections import deque
 import signal
 
 DEBUG = False
 
+# the fields the operations of dict-queries need and their types
+QUERY_FIELDS = {'get': (('path', basestring),),
+                'mget': (('paths', list),),
+                'prefix': (('path', basestring),),
+                'glob': (('patt', basestring),),
+                'index': (('job', basestring), ('field', basestring), ('values', list)),
+                'stats': (),
+                'snapshot': (('job', basestring),)}
 
-class FSTimer(Thread):
+
+def op_name(msg):
+    '''
+    Returns the name of the operation a request asks for
+    '''
+    if not isinstance(msg, list) or len(msg) != 2:
+        return 'invalid'
+    if isinstance(msg[1], list):
+        return 'mget'
+    if isinstance(msg[1], dict):
+        op = msg[1].get('op', None)
+        return op if op in QUERY_FIELDS else 'invalid'
+    return 'get'
+
+
+# the fields of the chunks a replica receives from its primary and of the
+# states it resyncs from, the latter have no deletes
+STATE_FIELDS = (('job', basestring),
+                ('gen', (int, long)),
+                ('epoch', basestring),
+                ('rseq', (int, long)),
+                ('upsert', dict),
+                ('sigs', dict))
+CHUNK_FIELDS = STATE_FIELDS + (('delete', list),)
+
+
+def bad_chunk(chunk, fields=CHUNK_FIELDS):
     '''
-    A basic timer class the fires timer-events every second.
+    Returns why a chunk or state from the primary can not be applied
+    or None if it can
     '''
-    def __init__(self, opts, event):
+    if not isinstance(chunk, dict):
+        return 'not a dict'
+    for field, ftype in fields:
+        if not isinstance(chunk.get(field, None), ftype):
+            return 'no valid {0!r}'.format(field)
+    if not isinstance(chunk.get('proj', {}), dict) or not isinstance(chunk.get('cold', []), list):
+        return "no valid 'proj' or 'cold'"
+    for path, fdata in chunk['upsert'].iteritems():
+        if not isinstance(path, basestring) or not isinstance(fdata, str):
+            return 'invalid upsert of {0!r}'.format(path)
+    for sig in chunk['sigs'].itervalues():
+        if not isinstance(sig, (list, tuple)):
+            return 'invalid signature {0!r}'.format(sig)
+    for fields in chunk.get('proj', {}).itervalues():
+        if not isinstance(fields, dict):
+            return 'invalid projection {0!r}'.format(fields)
+    for path in chunk.get('delete', []) + chunk.get('cold', []):
+        if not isinstance(path, basestring):
+            return 'invalid path {0!r}'.format(path)
+    return None
+
+
+def bad_query(query):
+    '''
+    Returns why a query can not be answered or None if it can
+    '''
+    if isinstance(query, basestring):
+        return None
+    if isinstance(query, list):
+        paths = query
+    elif isinstance(query, dict):
+        op = query.get('op', None)
+        if op not in QUERY_FIELDS:
+            return 'unknown op {0!r}'.format(op)
+        for field, ftype in QUERY_FIELDS[op]:
+            if not isinstance(query.get(field, None), ftype):
+                return '{0} needs {1!r} as {2}'.format(op, field, ftype.__name__)
+        paths = query.get('paths', [])
+    else:
+        return 'invalid query'
+    for path in paths:
+        if not isinstance(path, basestring):
+            return 'invalid path {0!r}'.format(path)
+    return None
+
+
+class FSReader(Thread):
+    '''
+    A thread that answers cache-requests forwarded to it by the FSCaches
+    request-proxy. Several readers serve requests from many clients in
+    parallel to the FSCaches main loop applying the cache-updates.
+
+    The files of read-through requests are read right here. They are sent
+    to the main loop as a delta-chunk like a workers, which applies them
+    to the store, the manifest, the projections and the subscribers.
+    '''
+    def __init__(self, cache, context, rid):
         Thread.__init__(self)
-        self.opts = opts
-        self.stopped = event
+        self.cache = cache
+        self.context = context
+        self.rid = rid
         self.daemon = True
-        self.serial = salt.payload.Serial(opts.get('serial', ''))
+        self.serial = salt.payload.Serial(cache.opts.get('serial', ''))
 
     def run(self):
         '''
-        main loop that fires the event every second
+        main loop that answers the requests
         '''
-        context = zmq.Context()
-        # the socket for outgoing timer events
-        socket = context.socket(zmq.PUSH)
+        socket = self.context.socket(zmq.REP)
         socket.setsockopt(zmq.LINGER, 100)
-        socket.bind("ipc:///tmp/fsc_timer")
+        socket.connect("inproc://fsc_readers")
+        upd = self.context.socket(zmq.PUSH)
+        upd.setsockopt(zmq.LINGER, 100)
+        upd.connect(ipc_addr(self.cache.opts, 'upd', self.cache.shard))
 
-        count = 0
-        while not self.stopped.wait(1):
-            socket.send(self.serial.dumps(count))
+        timing = self.cache.timing
+        while 1:
+            try:
+                frame = socket.recv()
+            except zmq.ZMQError:
+                break
+            t_start = time.time()
+            self.cache.counters['requests'] += 1
+            msg = None
+            try:
+                msg = self.serial.loads(frame)
+                t_loaded = time.time()
+                timing('deserialize', t_loaded - t_start)
+                # read-through misses are loaded right here, concurrent
+                # requests for the same path wait for the first reader
+                missing = self.cache.missing_loads(msg)
+                loaded = {}
+                loads = {}
+                for path in missing:
+                    leader, result = self.cache.flight.do(path, self.cache.load_path, path)
+                    if result is not None:
+                        loaded[path] = result[0]
+                    if leader:
+                        loads[path] = result
+                t_handle = time.time()
+                reply = self.cache.handle_request(msg)
+                t_handled = time.time()
+                timing('req_' + op_name(msg), t_handled - t_handle)
+                if missing:
+                    self.cache.fill_loaded(msg, reply, loaded)
+                    reply.append(True)
+                # the main loop applying our loads may evict other
+                # paths of the request, they are sent once its reply is built
+                if loads:
+                    self.send_loads(upd, loads)
+                frame = self.serial.dumps(reply)
+                t_done = time.time()
+                timing('serialize', t_done - t_handled)
+                self.cache.backoff.record(t_done - t_start)
+            except Exception as err:
+                # the REP-socket has to answer before it can go on
+                frame = self.serial.dumps(self.cache.failed(msg, err))
+            try:
+                socket.send(frame)
+            except zmq.ZMQError:
+                break
+        socket.close()
+        upd.close()
 
-            count += 1
-            if count >= 60:
-                count = 0
+    def send_loads(self, upd, loads):
+        '''
+        Sends the files we loaded as one delta-chunk per job to the main
+        loop, files that could not be read are reported as deleted
+        '''
+        chunks = {}
+        for path, result in loads.iteritems():
+            name = self.cache.loadable(path)
+            if name is None:
+                continue
+            chunk = chunks.get(name, None)
+            if chunk is None:
+                chunk = chunks[name] = {'job': name,
+                                        'gen': max(self.cache.job_gens.get(name, 0),
+                                                   self.cache.applied_gens.get(name, 0)),
+                                        'seq': 0,
+                                        'last': True,
+                                        'load': True,
+                                        'upsert': {},
+                                        'sigs': {},
+                                        'proj': {},
+                                        'delete': []}
+            if result is None:
+                chunk['delete'].append(path)
+                continue
+            fdata, sig = result
+            chunk['upsert'][path] = fdata
+            chunk['sigs'][path] = sig
+            spec = self.cache.jobs[name].get('proj', None)
+            if spec:
+                try:
+                    chunk['proj'][path] = project(self.serial.loads(fdata), spec)
+                except Exception:
+                    chunk['proj'][path] = {}
+        for chunk in chunks.itervalues():
+            upd.send(self.serial.dumps(chunk))
 
 
 class FSCache(multiprocessing.Process):
     '''
-    Provides access to the cache-system and manages the subprocesses
-    that do the cache updates in the background.
+    Provides access to the cache-system and manages the pool of worker
+    subprocesses that do the cache updates in the background.
 
     Access to the cache is available to any module that connects
     to the FSCaches IPC-socket.
+
+    With fsc_shards set to N, N FSCaches each hold the paths hashing to
+    their shard, see fsworker.shard_of() and start_cache(). Shard 0 is the
+    leader that runs the workers, the schedule and the watches, the workers
+    send every shard its files and the clients ask the shard owning a path.
     '''
 
-    def __init__(self, opts):
+    def __init__(self, opts, shard=0):
         '''
-        starts the timer and inits the cache itself
+        inits the cache itself
         '''
         super(FSCache, self).__init__()
         # the possible settings for the cache
         self.opts = opts
+        # our shard of fsc_shards, every shard has sockets and files of
+        # its own
+        self.shard = shard
+        self.shards = self.opts.get('fsc_shards', 1)
 
         # all jobs the FSCache should run in intervals
         self.jobs = {}
-        # the actual cached data
-        self.path_data = {}
-
-        # the timer provides 1-second intervals to the loop in run()
-        # to make the cache system most responsive, we do not use a loop-
-        # delay which makes it hard to get 1-second intervals without a timer
-        self.timer_stop = Event()
-        self.timer = FSTimer(self.opts, self.timer_stop)
-        self.timer.start()
+        # the compiled PathFilter of every job
+        self.filters = {}
+        # the actual cached data, limited to the budget of fsc_max_bytes.
+        # Files larger than fsc_max_entry_bytes are always read from disk.
+        # The data can be compressed with fsc_compress 'zlib' or 'lz4' and
+        # packed into buffers of fsc_arena_bytes.
+        self.store = CacheStore(self.opts.get('fsc_max_bytes', 0),
+                                self.opts.get('fsc_max_entry_bytes', 0),
+                                self.opts.get('fsc_compress', None),
+                                self.opts.get('fsc_compress_level', 1),
+                                self.opts.get('fsc_arena_bytes', 0))
+        # the {path: stat_sig} of every cached file per job, handed to
+        # the workers to detect changed and deleted files
+        self.manifests = {}
+        # the generation of the last run started for each job and the
+        # generation of the newest run whose updates got applied
+        self.job_gens = {}
+        self.applied_gens = {}
+        # the projections of the files of jobs that declare one as
+        # {job: {path: {field: value}}} and their reverse index
+        # {job: {field: {value: set(paths)}}}
+        self.proj_data = {}
+        self.proj_index = {}
+        # the runs currently executed by the worker-pool as
+        # {job: {gen: start-time}}, None while they wait for a worker
+        self.active_jobs = {}
+        # the io-counters of the last finished run of each job
+        self.job_io = {}
+
+        # the latency-histograms of the requests per operation and of the
+        # (de)serialization and the applying of updates, see timing(), and
+        # the counters of the main loop
+        self.latency = {}
+        self.counters = {'requests': 0,
+                         'bad_requests': 0,
+                         'failed_requests': 0,
+                         'bad_repl_msgs': 0,
+                         'updates': 0,
+                         'stale_chunks': 0,
+                         'failed_jobs': 0}
+        self.started = time.time()
+        # the stats are written to fsc_metrics_path in the prometheus
+        # text-format every fsc_metrics_ival seconds
+        self.metrics_path = self.shard_path('fsc_metrics_path')
+        self.metrics_ival = self.opts.get('fsc_metrics_ival', 10)
+        self.metrics_due = 0
+
+        # the pool of long-lived workers the jobs are dispatched to
+        self.pool_size = self.opts.get('fsc_workers', 2)
+        # the seconds after which an unfinished job is considered lost
+        self.job_timeout = self.opts.get('fsc_job_timeout', 300)
+        self.workers = []
+        # the workers announce when they are ready for a job, jobs wait
+        # here until one is, see dispatch_jobs(). Loads go first, clients
+        # are waiting for them.
+        self.idle = deque()
+        self.job_queue = deque()
+        self.load_queue = deque()
+        # the workers pause between their reads while the requests take
+        # longer than fsc_latency_target seconds on average, 0 disables it
+        self.backoff = Backoff(self.opts.get('fsc_latency_target', 0.01),
+                               self.opts.get('fsc_max_backoff', 1.0))
+        # the Backoffs of all shards, start_cache() hands them to the
+        # leader whose workers read the files of every shard
+        self.shard_backoffs = [self.backoff]
+
+        # read-through requests waiting for the workers to load the files
+        # they missed as {path: [request, ...]}. A path is loaded only once
+        # no matter how many requests wait for it.
+        self.parked = {}
+        self.load_timeout = self.opts.get('fsc_load_timeout', 5)
+        # evicted files that plain requests asked for, the workers load
+        # them again in the background, and those being loaded as
+        # {path: time}. The main loop never reads from disk itself.
+        self.cold = []
+        self.loading = {}
+        # the reader-threads read the files themselves, the main
+        # loop applies them
+        self.flight = SingleFlight()
+
+        # the inotify-watches of jobs with 'watch' set as {fd: (job, watch)},
+        # the changed files they reported and the jobs that lost events
+        self.watches = {}
+        self.watch_queue = {}
+        self.watch_full = set()
+
+        # the number of reader-threads answering requests, with 0 all
+        # requests are answered from the main loop
+        self.num_readers = self.opts.get('fsc_readers', 0)
+        # the max number of requests answered before the main loop
+        # checks for cache-updates again
+        self.req_batch = self.opts.get('fsc_req_batch', 100)
+
+        # the optional memory-mapped copy of the cache clients can read
+        # without asking us, created in run() to belong to our process
+        self.shm_path = self.shard_path('fsc_shm_path')
+        self.shm = None
+
+        # the optional PUB-socket on which every applied change is published
+        # to the subscribers of the job as [<job>\0, {...}], see publish().
+        # The events of each job are numbered to let subscribers notice gaps.
+        self.pub = None
+        self.event_seqs = {}
+
+        # replication to FSCaches on other masters sharing the cache-tree.
+        # The primary (fsc_repl_bind set to the address to listen on) walks
+        # the jobs, publishes every applied chunk on fsc_repl_port and
+        # answers resync-requests on the port above it. A replica
+        # (fsc_repl_primary set to the primaries host) runs no workers
+        # and applies the chunks it receives instead. Every shard
+        # replicates to the same shard of the replica on ports of its own.
+        self.repl_bind = self.opts.get('fsc_repl_bind', None)
+        self.repl_primary = self.opts.get('fsc_repl_primary', None)
+        self.repl_port = self.opts.get('fsc_repl_port', 4520) + 2 * self.shard
+        self.repl_timeout = self.opts.get('fsc_repl_timeout', 10)
+        self.repl_pub = None
+        self.repl_server = None
+        self.repl_sub = None
+        self.repl_sync = None
+        # the primaries chunks are numbered per job within an epoch that
+        # changes with every start of the primary
+        self.repl_epoch = '{0}-{1}'.format(os.getpid(), time.time())
+        self.repl_out_seqs = {}
+        # on a replica: the (epoch, seq) of the last chunk applied per job,
+        # the jobs waiting for a resync with the time it was requested and
+        # the chunks received meanwhile
+        self.repl_in = {}
+        self.repl_pending = {}
+        self.repl_resyncs = 0
+        # wether we run the workers, the schedule and the watches
+        self.leader = self.shard == 0 and not self.repl_primary
+
+        # the snapshot of the cache written every fsc_snap_ival seconds by
+        # a forked child and loaded on start. The jobs in reconcile are run
+        # as soon as possible after loading it.
+        self.snap_path = self.shard_path('fsc_snap_path')
+        self.snap_ival = self.opts.get('fsc_snap_ival', 300)
+        self.snap_due = time.time() + self.snap_ival
+        self.snap_pid = None
+        self.reconcile = set()
+
+        # the deadlines of the jobs, the main loop polls its sockets until
+        # the next one. Runs of jobs with catchup 'all' that could not be
+        # dispatched yet wait in queued_runs as {job: count}.
+        self.sched = Scheduler()
+        self.queued_runs = {}
+        # the housekeeping of the main loop is done once a second
+        self.tick_due = 0
         self.running = True
 
+    def shard_path(self, opt):
+        '''
+        Returns the file-path set in an option, suffixed with our shard
+        if the cache is sharded
+        '''
+        path = self.opts.get(opt, None)
+        if path:
+            return shard_name(self.opts, path, self.shard)
+        return path
+
     def signal_handler(self, sig, frame):
         '''
         handle signals and shutdown
@@ -85,6 +426,29 @@ class FSCache(multiprocessing.Process):
     def add_job(self, **kwargs):
         '''
         adds a new job to the FSCache
+
+        Optional variables:
+        incr - only re-read files whose stat-signature changed since
+               the last run of the job
+        chunk_bytes - the max size of the delta-chunks the workers send
+        chunk_files - the max number of files in a delta-chunk
+        proj - {field: dotted.path} to extract from every decoded file,
+               the values can be looked up with the 'index' request
+        max_bytes - the quota of the job in the caches memory
+        watch - watch the path with inotify and re-read changed files within
+                a second, the ival-runs then only reconcile lost events
+        max_bps - the max bytes per second the workers read for the job
+        max_fps - the max files per second the workers read for the job
+        include - shell-patterns of which the files must match one
+        exclude - shell-patterns of files not to cache
+        prune - shell-patterns of directories not to descend into
+        jitter - delay every run by a random amount of up to that many seconds
+        catchup - what to do about missed runs: 'once', 'all' or 'skip'
+        max_running - the number of runs of the job that may be active
+                      at once, 1 by default
+
+        The ival is a list of seconds within every minute, a number of
+        seconds or a cron-expression, see fssched.
         '''
         req_vars = ['name', 'path', 'ival', 'patt']
 
@@ -96,13 +460,925 @@ class FSCache(multiprocessing.Process):
         del kwargs['name']
         self.jobs[job_name] = {}
         self.jobs[job_name].update(kwargs)
+        self.filters[job_name] = PathFilter.from_job(kwargs)
+        self.sched.add(job_name,
+                       kwargs['ival'],
+                       kwargs.get('jitter', 0),
+                       kwargs.get('catchup', 'once'),
+                       kwargs.get('grace', 1))
+        self.store.add_job(job_name, kwargs['path'], kwargs.get('max_bytes', 0))
+
+    def check_pool(self):
+        '''
+        Starts the worker-pool and replaces workers that died
+        '''
+        for wid in range(self.pool_size):
+            if wid < len(self.workers):
+                if self.workers[wid].is_alive():
+                    continue
+                self.workers[wid].join()
+                print "FSCACHE:  worker #{0} died, restarting".format(wid)
+                self.workers[wid] = FSWorker(self.opts, wid, Backoffs(self.shard_backoffs))
+            else:
+                self.workers.append(FSWorker(self.opts, wid, Backoffs(self.shard_backoffs)))
+            self.workers[wid].start()
+
+    def stop_pool(self):
+        '''
+        Shuts down the worker-pool
+        '''
+        for worker in self.workers:
+            worker.terminate()
+            worker.join()
+        self.workers = []
 
     def run_job(self, name):
         '''
-        Creates a new subprocess to execute the given job in
+        Queues a run of the given job for the worker-pool unless max_running
+        runs of the same job are still active or waiting for a worker. Runs
+        time out job_timeout seconds after a worker started them.
+        '''
+        runs = self.active_jobs.setdefault(name, {})
+        now = time.time()
+        for gen, started in runs.items():
+            if started is not None and now - started >= self.job_timeout:
+                print "FSCACHE:  job {0}/{1} timed out".format(name, gen)
+                del runs[gen]
+        if len(runs) >= self.jobs[name].get('max_running', 1):
+            if DEBUG:
+                print "FSCACHE:  job {0} still running, skipping".format(name)
+            return False
+
+        self.job_gens[name] = self.job_gens.get(name, 0) + 1
+        job = {'name': name,
+               'gen': self.job_gens[name],
+               'shard': self.shard,
+               'manifest': self.manifests.get(name, {})}
+        job.update(self.jobs[name])
+        runs[self.job_gens[name]] = None
+        self.job_queue.append(job)
+        self.dispatch_jobs()
+        return True
+
+    def dispatch_jobs(self):
+        '''
+        Hands the waiting loads and runs to the workers that are ready. A
+        worker that went away is dropped and the job given to the next one.
         '''
-        sub_p = FSWorker(self.opts, name, **self.jobs[name])
-        sub_p.start()
+        while self.idle and (self.load_queue or self.job_queue):
+            queue = self.load_queue or self.job_queue
+            job = queue.popleft()
+            worker = self.idle.popleft()
+            try:
+                self.jobs_out.send_multipart([worker, self.serial.dumps(job)], zmq.NOBLOCK)
+            except zmq.ZMQError:
+                queue.appendleft(job)
+                continue
+            runs = self.active_jobs.get(job['name'], {})
+            if 'paths' not in job and job['gen'] in runs:
+                runs[job['gen']] = time.time()
+
+    def worker_state(self, worker, msg):
+        '''
+        Keeps track of the workers that are ready for a job. Workers say so
+        when they start and after every job, and tell every shard when they
+        took a job from any of them. A run counts as started from then on.
+        '''
+        if not isinstance(msg, dict):
+            return
+        if msg.get('ready'):
+            if worker not in self.idle:
+                self.idle.append(worker)
+            self.dispatch_jobs()
+        elif msg.get('busy'):
+            try:
+                self.idle.remove(worker)
+            except ValueError:
+                pass
+            runs = self.active_jobs.get(msg.get('job'), {})
+            if not msg.get('load') and msg.get('gen') in runs:
+                runs[msg['gen']] = time.time()
+
+    def job_done(self, name, gen):
+        '''
+        Marks the run of a job as finished
+        '''
+        self.active_jobs.get(name, {}).pop(gen, None)
+
+    def dispatch_due(self):
+        '''
+        Runs the jobs whose deadline passed
+        '''
+        due = self.sched.due()
+        for name in due:
+            self.queued_runs[name] = self.queued_runs.get(name, 0) + 1
+        self.run_queued(set(due))
+
+    def run_queued(self, names):
+        '''
+        Dispatches the queued runs of the given jobs. Runs that find the job
+        still running are dropped, unless the job catches up on all missed
+        runs.
+        '''
+        for name in names:
+            count = self.queued_runs.get(name, 0)
+            while count and self.run_job(name):
+                count -= 1
+            if count and self.jobs[name].get('catchup') == 'all':
+                self.queued_runs[name] = count
+            else:
+                self.queued_runs.pop(name, None)
+
+    def housekeeping(self):
+        '''
+        The checks of the main loop that are done once a second
+        '''
+        if self.repl_primary:
+            self.repl_check()
+        elif self.leader:
+            self.check_pool()
+        self.backoff.adjust()
+        self.expire_parked()
+        self.load_cold()
+        self.flush_watches()
+        self.run_queued(self.queued_runs.keys())
+        # jobs loaded from a snapshot are reconciled right away by
+        # the leader, on a replica by the primary
+        if not self.leader:
+            self.reconcile.clear()
+        for name in list(self.reconcile):
+            if self.run_job(name):
+                self.reconcile.discard(name)
+        if self.snap_path:
+            self.check_snapshot()
+        if self.metrics_path and time.time() >= self.metrics_due:
+            self.metrics_due = time.time() + self.metrics_ival
+            self.dump_metrics()
+
+    def loadable(self, path):
+        '''
+        Returns the name of the job whose files include the path or None
+        '''
+        job = self.store.job_of(path)
+        if job is None or not self.filters[job.name].match(path):
+            return None
+        return job.name
+
+    def missing_loads(self, msg):
+        '''
+        Returns the paths of a read-through request that belong to one of
+        the jobs but whose data is not in memory
+        '''
+        try:
+            query = msg[1]
+        except (TypeError, IndexError, KeyError):
+            return []
+        if not isinstance(query, dict) or not query.get('load') or self.repl_primary:
+            return []
+        if bad_query(query) is not None:
+            return []
+        if query.get('op') == 'get':
+            paths = [query['path']]
+        elif query.get('op') == 'mget':
+            paths = query['paths']
+        else:
+            return []
+        return [path for path in paths
+                if not self.store.resident(path) and self.loadable(path)]
+
+    def park(self, frames, msg, missing):
+        '''
+        Holds back the reply to a read-through request until the workers
+        loaded the missing paths. Paths already being loaded for another
+        request are not loaded again. The data of the requested paths in
+        memory is held by the request, the loads may evict it.
+        '''
+        req = {'frames': frames,
+               'msg': msg,
+               'missing': set(missing),
+               'loaded': {},
+               'time': time.time()}
+        if msg[1].get('op') == 'mget':
+            held = self.get_many([path for path in msg[1]['paths'] if path not in req['missing']])
+            req['loaded'] = dict((path, fdata) for path, fdata in held.iteritems()
+                                 if fdata is not None)
+        loads = {}
+        for path in missing:
+            if path not in self.parked:
+                self.parked[path] = []
+                if path not in self.loading:
+                    loads.setdefault(self.loadable(path), []).append(path)
+            self.parked[path].append(req)
+        for name, paths in loads.iteritems():
+            self.load_paths(name, paths)
+
+    def load_paths(self, name, paths):
+        '''
+        Dispatches the loading of single files of a job to the worker-pool
+        '''
+        # a shard that is not the leader only knows the
+        # generations of the runs from their chunks
+        job = {'name': name,
+               'gen': max(self.job_gens.get(name, 0), self.applied_gens.get(name, 0)),
+               'shard': self.shard,
+               'paths': paths}
+        job.update(self.jobs[name])
+        self.load_queue.append(job)
+        self.dispatch_jobs()
+
+    def load_cold(self):
+        '''
+        Has the workers load the evicted files plain requests asked for,
+        files already being loaded are skipped
+        '''
+        cold, self.cold = self.cold, []
+        if not cold or self.repl_primary:
+            return
+        now = time.time()
+        loads = {}
+        for path in cold:
+            if path in self.loading or path in self.parked:
+                continue
+            name = self.loadable(path)
+            if name is not None:
+                self.loading[path] = now
+                loads.setdefault(name, []).append(path)
+        for name, paths in loads.iteritems():
+            self.load_paths(name, paths)
+
+    def load_path(self, path):
+        '''
+        Reads a single file for a reader-thread, returns its data and
+        signature or None if it is gone or not a file
+        '''
+        try:
+            st = os.stat(path)
+            with open(path, 'rb') as fhandle:
+                fdata = fhandle.read()
+        except (IOError, OSError):
+            return None
+        return fdata, stat_sig(st)
+
+    def fill_loaded(self, msg, reply, loaded):
+        '''
+        Adds the loaded files the store did not admit or evicted since
+        to the reply of a read-through request
+        '''
+        query = msg[1]
+        if query.get('op') == 'get':
+            if reply[1] is None:
+                reply[1] = loaded.get(query['path'])
+        elif isinstance(reply[1], dict):
+            for path, fdata in reply[1].iteritems():
+                if fdata is None and path in loaded:
+                    reply[1][path] = loaded[path]
+
+    def unpark(self, paths, loaded=None):
+        '''
+        Answers the parked requests that do not wait for more than the
+        given paths anymore. loaded has the data of the paths that were
+        just loaded, even if the store did not admit them.
+        '''
+        loaded = loaded or {}
+        for path in paths:
+            self.loading.pop(path, None)
+            for req in self.parked.pop(path, []):
+                req['missing'].discard(path)
+                if path in loaded:
+                    req['loaded'][path] = loaded[path]
+                if not req['missing']:
+                    try:
+                        reply = self.handle_request(req['msg'])
+                        self.fill_loaded(req['msg'], reply, req['loaded'])
+                    except Exception as err:
+                        reply = self.failed(req['msg'], err)
+                    # tell the client the reply needed a disk-load
+                    reply.append(True)
+                    req['frames'][-1] = self.serial.dumps(reply)
+                    self.creq_in.send_multipart(req['frames'])
+
+    def expire_parked(self):
+        '''
+        Answers parked requests whose loads did not finish in time
+        with what the cache has
+        '''
+        now = time.time()
+        expired = [path for path, reqs in self.parked.iteritems()
+                   if now - reqs[0]['time'] > self.load_timeout]
+        expired.extend(path for path, started in self.loading.iteritems()
+                       if now - started > self.load_timeout)
+        self.unpark(expired)
+
+    def add_watches(self, poller):
+        '''
+        Sets up the inotify-watches for the jobs that want them
+        '''
+        for name, job in self.jobs.iteritems():
+            if not job.get('watch'):
+                continue
+            try:
+                watch = Inotify(job['path'])
+            except OSError as err:
+                print "FSCACHE:  can not watch {0}: {1}".format(job['path'], err)
+                continue
+            self.watches[watch.fileno()] = (name, watch)
+            poller.register(watch.fileno(), zmq.POLLIN)
+
+    def read_watches(self, socks):
+        '''
+        Queues the changed files reported by the inotify-watches
+        '''
+        for fd, (name, watch) in self.watches.iteritems():
+            if socks.get(fd) == zmq.POLLIN:
+                changed, overflow = watch.read()
+                self.watch_queue.setdefault(name, set()).update(changed)
+                if overflow:
+                    self.watch_full.add(name)
+
+    def flush_watches(self):
+        '''
+        Dispatches the loading of the queued files. Jobs that lost events
+        get a full run instead.
+        '''
+        for name in list(self.watch_full):
+            if self.run_job(name):
+                self.watch_full.discard(name)
+                self.watch_queue.pop(name, None)
+        for name, paths in self.watch_queue.items():
+            paths = [path for path in paths if self.filters[name].match(path)]
+            if paths:
+                self.load_paths(name, paths)
+        self.watch_queue = {}
+
+    def apply_update(self, upd):
+        '''
+        Applies a delta-chunk of a worker to the cache and the jobs manifest.
+        Chunks of runs that were overtaken by a newer run of the same job
+        are dropped, their data is outdated.
+        '''
+        if upd['gen'] < self.applied_gens.get(upd['job'], 0):
+            self.counters['stale_chunks'] += 1
+            if DEBUG:
+                print "FSCACHE:  dropping stale chunk {0}/{1}".format(upd['job'],
+                                                                     upd['gen'])
+            return False
+        self.applied_gens[upd['job']] = upd['gen']
+
+        manifest = self.manifests.setdefault(upd['job'], {})
+        evicted = []
+        for file_n, fdata in upd['upsert'].iteritems():
+            evicted.extend(self.store.put(upd['job'], file_n, fdata))
+        # tuples are smaller than the lists we receive
+        for file_n, sig in upd['sigs'].iteritems():
+            manifest[file_n] = tuple(sig)
+        for file_n in upd['delete']:
+            self.store.delete(upd['job'], file_n)
+            manifest.pop(file_n, None)
+        if upd.get('proj') or upd['delete'] and upd['job'] in self.proj_data:
+            self.update_proj(upd)
+        if self.shm is not None:
+            self.update_shm(upd, evicted)
+        if self.pub is not None:
+            self.publish(upd)
+        if self.repl_pub is not None:
+            self.repl_publish(upd)
+        return True
+
+    def repl_publish(self, upd):
+        '''
+        Streams an applied chunk to the replicas, numbered within our epoch
+        '''
+        seq = self.repl_out_seqs.get(upd['job'], 0) + 1
+        self.repl_out_seqs[upd['job']] = seq
+        chunk = dict(upd)
+        chunk['epoch'] = self.repl_epoch
+        chunk['rseq'] = seq
+        try:
+            self.repl_pub.send_multipart(['{0}\0'.format(upd['job']),
+                                          self.serial.dumps(chunk)], zmq.NOBLOCK)
+        except zmq.Again:
+            pass
+
+    def repl_state(self, job):
+        '''
+        Returns the full state of a job for a replica to resync from
+        '''
+        if job not in self.jobs:
+            return {'job': job, 'error': 'unknown job'}
+        with self.store.lock:
+            paths = self.store.jobs[job].paths()
+        # evicted files are not loaded for it, the replica
+        # keeps what it has of them
+        files = self.get_many(paths)
+        manifest = self.manifests.get(job, {})
+        return {'job': job,
+                'epoch': self.repl_epoch,
+                'rseq': self.repl_out_seqs.get(job, 0),
+                'gen': self.applied_gens.get(job, 0),
+                'upsert': dict((path, fdata) for path, fdata in files.iteritems()
+                               if fdata is not None),
+                'cold': [path for path, fdata in files.iteritems() if fdata is None],
+                'sigs': dict((path, manifest[path]) for path in paths if path in manifest),
+                'proj': dict(self.proj_data.get(job, {}))}
+
+    def repl_decode(self, frames, count, what):
+        '''
+        Returns the message in the last of the frames received from a
+        replica or the primary, or None if it is not a message of count
+        frames that can be decoded
+        '''
+        if len(frames) != count:
+            self.repl_dropped(what, '{0} frames instead of {1}'.format(len(frames), count))
+            return None
+        try:
+            return self.serial.loads(frames[-1])
+        except Exception as err:
+            self.repl_dropped(what, err)
+            return None
+
+    def repl_dropped(self, what, why):
+        '''
+        Counts and logs a replication-message we could not use
+        '''
+        self.counters['bad_repl_msgs'] += 1
+        print "FSCACHE:  dropping bad replication-{0}: {1}".format(what, why)
+
+    def repl_serve(self, frames):
+        '''
+        Answers a resync-request of a replica. The port is open to anyone,
+        messages that are not a resync-request are dropped. The routing
+        envelope is sent back as received, REQ- and DEALER-peers get
+        their reply alike.
+        '''
+        if len(frames) < 2:
+            self.repl_dropped('request', 'no routing envelope')
+            return
+        req = self.repl_decode(frames[-1:], 1, 'request')
+        if req is None:
+            return
+        if not isinstance(req, dict) or req.get('op') != 'resync' \
+                or not isinstance(req.get('job', None), basestring):
+            self.repl_dropped('request', 'not a resync-request')
+            return
+        self.repl_server.send_multipart(frames[:-1] + [self.serial.dumps(self.repl_state(req['job']))])
+
+    def repl_resync(self, job, chunk=None):
+        '''
+        Asks the primary for the full state of a job, chunks received until
+        it arrives are kept to be applied on top of it
+        '''
+        _, chunks = self.repl_pending.get(job, (0, []))
+        if chunk is not None:
+            chunks.append(chunk)
+        self.repl_pending[job] = (time.time(), chunks)
+        self.repl_resyncs += 1
+        self.repl_sync.send(self.serial.dumps({'op': 'resync', 'job': job}))
+
+    def repl_receive(self, chunk):
+        '''
+        Applies a chunk from the primary if it is the next one of its job,
+        a gap or a new epoch of the primary triggers a resync
+        '''
+        error = bad_chunk(chunk)
+        if error is not None:
+            self.repl_dropped('chunk', error)
+            return
+        job = chunk['job']
+        if job not in self.jobs:
+            return
+        if job in self.repl_pending:
+            self.repl_pending[job][1].append(chunk)
+            return
+        epoch, seq = self.repl_in.get(job, (None, 0))
+        if chunk['epoch'] == epoch:
+            if chunk['rseq'] <= seq:
+                return
+            if chunk['rseq'] == seq + 1:
+                self.apply_update(chunk)
+                self.repl_in[job] = (epoch, chunk['rseq'])
+                return
+        if DEBUG:
+            print "FSCACHE:  lost chunks of {0}, resyncing".format(job)
+        self.repl_resync(job, chunk)
+
+    def repl_restore(self, state):
+        '''
+        Replaces the files of a job with the state sent by the primary
+        and applies the chunks received meanwhile
+        '''
+        if isinstance(state, dict) and 'error' in state:
+            if state.get('job') in self.repl_pending:
+                print "FSCACHE:  resync of {0} failed: {1}".format(state['job'], state['error'])
+                del self.repl_pending[state['job']]
+            return
+        error = bad_chunk(state, STATE_FIELDS)
+        if error is not None:
+            self.repl_dropped('state', error)
+            return
+        job = state['job']
+        if job not in self.repl_pending:
+            return
+        _, chunks = self.repl_pending.pop(job)
+        with self.store.lock:
+            known = self.store.jobs[job].paths()
+        cold = set(state.pop('cold', []))
+        state['delete'] = [path for path in known
+                           if path not in state['upsert'] and path not in cold]
+        state['seq'] = 0
+        state['last'] = True
+        # the generations of a restarted primary start over
+        self.applied_gens[job] = 0
+        self.apply_update(state)
+        self.repl_in[job] = (state['epoch'], state['rseq'])
+        print "FSCACHE:  resynced {0} with {1} files".format(job, len(state['upsert']))
+        for chunk in chunks:
+            self.repl_receive(chunk)
+
+    def repl_check(self):
+        '''
+        Repeats resync-requests that were not answered in time
+        '''
+        now = time.time()
+        for job, (sent, _) in self.repl_pending.items():
+            if now - sent > self.repl_timeout:
+                print "FSCACHE:  resync of {0} timed out, retrying".format(job)
+                self.repl_resync(job)
+
+    def publish(self, upd):
+        '''
+        Publishes the changes of an applied delta-chunk as
+
+        {'job': <name>, 'gen': <gen>, 'shard': <shard>, 'seq': <event-number>,
+         'upsert': {<path>: <data>}, 'proj': {<path>: {<field>: <value>}},
+         'delete': [<path>, ...]}
+
+        Subscribers that are too slow lose events, the PUB-socket
+        drops them once its high-water-mark is reached.
+        '''
+        if not upd['upsert'] and not upd['delete']:
+            return
+        seq = self.event_seqs.get(upd['job'], 0) + 1
+        self.event_seqs[upd['job']] = seq
+        event = {'job': upd['job'],
+                 'gen': upd['gen'],
+                 'shard': self.shard,
+                 'seq': seq,
+                 'upsert': upd['upsert'],
+                 'proj': upd.get('proj', {}),
+                 'delete': upd['delete']}
+        try:
+            self.pub.send_multipart(['{0}\0'.format(upd['job']),
+                                     self.serial.dumps(event)], zmq.NOBLOCK)
+        except zmq.Again:
+            pass
+
+    def replica_snapshot(self, job):
+        '''
+        Returns the files and projections of a job with the number of the
+        last event published for it. A replica applies the events after it.
+        Evicted files are left out, they come with the events once they
+        are loaded again.
+        '''
+        if job not in self.jobs:
+            return None
+        seq = self.event_seqs.get(job, 0)
+        with self.store.lock:
+            items = self.store.jobs[job].items()
+        return {'seq': seq,
+                'files': dict(items),
+                'proj': dict(self.proj_data.get(job, {}))}
+
+    def update_proj(self, upd):
+        '''
+        Applies the projections of a delta-chunk and maintains the reverse
+        index. Lists are indexed by each of their items.
+        '''
+        proj_data = self.proj_data.setdefault(upd['job'], {})
+        index = self.proj_index.setdefault(upd['job'], {})
+
+        def unindex(file_n):
+            for field, value in proj_data.pop(file_n, {}).iteritems():
+                for item in value if isinstance(value, list) else [value]:
+                    try:
+                        paths = index[field][item]
+                    except (KeyError, TypeError):
+                        continue
+                    paths.discard(file_n)
+                    if not paths:
+                        del index[field][item]
+
+        for file_n, fields in upd.get('proj', {}).iteritems():
+            unindex(file_n)
+            proj_data[file_n] = fields
+            for field, value in fields.iteritems():
+                for item in value if isinstance(value, list) else [value]:
+                    try:
+                        index.setdefault(field, {}).setdefault(item, set()).add(file_n)
+                    except TypeError:
+                        # unhashable values are not indexed
+                        pass
+        for file_n in upd['delete']:
+            unindex(file_n)
+
+    def update_shm(self, upd, evicted):
+        '''
+        Mirrors a delta-chunk into the memory-mapped store. If the store
+        is full, it is rebuilt from the cache which includes the chunk.
+        Evicted files are removed to keep within the caches budget.
+        '''
+        for file_n, fdata in upd['upsert'].iteritems():
+            if not self.shm.put(file_n, fdata, upd['gen']):
+                if DEBUG:
+                    print "FSCACHE:  rebuilding shm-store"
+                self.shm.rebuild(self.store.items())
+                return
+        for file_n in upd['delete']:
+            self.shm.delete(file_n, upd['gen'])
+        for file_n in evicted:
+            self.shm.delete(file_n, upd['gen'])
+
+    def save_snapshot(self, fork=True):
+        '''
+        Writes the cached data with the manifests and projections of the
+        jobs to the snapshot. With fork a child writes the copy-on-write
+        view of the cache while we go on answering requests.
+
+        The leader keeps the signatures of the other shards files as well,
+        their data is in the snapshots of those shards.
+        '''
+        if fork:
+            # a reader-thread holding the lock at the fork would
+            # leave it locked forever in the child
+            with self.store.lock:
+                pid = os.fork()
+            if pid:
+                self.snap_pid = pid
+                return
+        try:
+            items = []
+            jobs = {}
+            for name, jstore in self.store.jobs.iteritems():
+                manifest = self.manifests.get(name, {})
+                proj_data = self.proj_data.get(name, {})
+                # files without data are read again on the next run
+                j_items = [(path, fdata) for path, fdata in jstore.items()
+                           if path in manifest]
+                items.extend(j_items)
+                j_manifest = dict((path, manifest[path]) for path, _ in j_items)
+                if self.leader and self.shards > 1:
+                    j_manifest.update((path, sig) for path, sig in manifest.iteritems()
+                                      if shard_of(path, self.shards) != self.shard)
+                jobs[name] = {'root': jstore.root,
+                              'manifest': j_manifest,
+                              'proj': dict((path, proj_data[path]) for path, _ in j_items
+                                           if path in proj_data)}
+            write_snapshot(self.snap_path, self.serial.dumps({'jobs': jobs}), items)
+            if DEBUG:
+                print "FSCACHE:  wrote snapshot of {0} files".format(len(items))
+        except Exception as err:
+            print "FSCACHE:  writing snapshot failed: {0}".format(err)
+            if fork:
+                os._exit(1)
+        if fork:
+            # skip the cleanups of the parents sockets and workers
+            os._exit(0)
+
+    def check_snapshot(self):
+        '''
+        Reaps the finished snapshot-child and starts the next one when due
+        '''
+        if self.snap_pid is not None:
+            try:
+                pid, _ = os.waitpid(self.snap_pid, os.WNOHANG)
+            except OSError:
+                pid = self.snap_pid
+            if not pid:
+                return
+            self.snap_pid = None
+        if time.time() >= self.snap_due:
+            self.snap_due = time.time() + self.snap_ival
+            self.save_snapshot()
+
+    def load_snapshot(self):
+        '''
+        Fills the cache from the snapshot. Only jobs that still have the
+        same root are loaded, all of them are reconciled by an incremental
+        run right after.
+        '''
+        snap = read_snapshot(self.snap_path)
+        if snap is None:
+            return
+        meta, items = snap
+        jobs = dict((name, snap_job) for name, snap_job
+                    in self.serial.loads(meta).get('jobs', {}).iteritems()
+                    if name in self.jobs and snap_job['root'] == self.jobs[name]['path'])
+        for path, fdata in items:
+            job = self.store.job_of(path)
+            if job is not None and job.name in jobs:
+                self.store.put(job.name, path, fdata)
+        for name, snap_job in jobs.iteritems():
+            manifest = self.manifests.setdefault(name, {})
+            for path, sig in snap_job['manifest'].iteritems():
+                # the files of the other shards were restored by them
+                if self.store.contains(path) or shard_of(path, self.shards) != self.shard:
+                    manifest[path] = tuple(sig)
+            if snap_job['proj']:
+                self.update_proj({'job': name,
+                                  'proj': snap_job['proj'],
+                                  'delete': []})
+        self.reconcile.update(self.jobs)
+        print "FSCACHE:  loaded {0} files from snapshot".format(len(items))
+
+    def handle_request(self, msg):
+        '''
+        Answers a cache-request. We only accept requests as lists
+        [req_id, <query>] where query is one of
+
+        <path> - replied with [req_id, <data>]
+        [<path>, ...] - replied with [req_id, {<path>: <data>, ...}]
+        {'op': 'prefix', 'path': <prefix>} - all paths starting with prefix,
+            replied with [req_id, {<path>: <data>, ...}]
+        {'op': 'glob', 'patt': <pattern>} - all paths matching the
+            shell-pattern, replied with [req_id, {<path>: <data>, ...}]
+        {'op': 'index', 'job': <job>, 'field': <field>, 'values': [...]} - all
+            paths whose projected field contains one of the values, replied
+            with [req_id, {<path>: [<matched value>, ...]}] with the values in
+            the order of the projection or None if the job has no projection
+        {'op': 'stats'} - the caches counters, latency-histograms per operation
+            and queue-depths, replied with [req_id, {...}]
+        {'op': 'snapshot', 'job': <job>} - all files and projections of a job
+            and the number of its last change-event, replied with
+            [req_id, {'seq': <num>, 'files': {...}, 'proj': {...}}]
+
+        {'op': 'get', 'path': <path>, 'load': <bool>} and
+        {'op': 'mget', 'paths': [<path>, ...], 'load': <bool>} - like the
+            above, with load the files missing in the cache are read from
+            disk first and a third field True is added to the reply
+
+        Missing paths have None as their data. Evicted files asked for by
+        path are loaded again by the workers in the background.
+
+        Queries with missing or wrong fields and queries that failed are
+        replied with [req_id, None, False, <error>], see failed().
+        '''
+        if not isinstance(msg, list) or len(msg) != 2:
+            # wrong format, item not cached
+            return [None, None]
+
+        msgid, query = msg[:]
+        if DEBUG:
+            print "FSCACHE:  looking for {0}:{1}".format(msgid, query)
+        error = bad_query(query)
+        if error is not None:
+            self.counters['bad_requests'] += 1
+            return [msgid, None, False, error]
+
+        if isinstance(query, list):
+            return [msgid, self.get_many(query, self.cold)]
+        elif isinstance(query, dict):
+            if query.get('op') == 'get':
+                return [msgid, self.get(query['path'], self.cold)]
+            elif query.get('op') == 'mget':
+                return [msgid, self.get_many(query['paths'], self.cold)]
+            elif query.get('op') == 'prefix':
+                return [msgid, self.get_prefix(query['path'])]
+            elif query.get('op') == 'glob':
+                return [msgid, self.get_glob(query['patt'])]
+            elif query.get('op') == 'index':
+                return [msgid, self.lookup(query['job'],
+                                           query['field'],
+                                           query['values'])]
+            elif query.get('op') == 'stats':
+                return [msgid, self.stats()]
+            elif query.get('op') == 'snapshot':
+                return [msgid, self.replica_snapshot(query['job'])]
+            return [msgid, None]
+        return [msgid, self.get(query, self.cold)]
+
+    def failed(self, msg, err):
+        '''
+        Returns the reply to a request whose handling raised err
+        '''
+        self.counters['failed_requests'] += 1
+        print "FSCACHE:  request {0} failed: {1}".format(op_name(msg), err)
+        msgid = msg[0] if isinstance(msg, list) and msg else None
+        return [msgid, None, False, 'request failed: {0}'.format(err)]
+
+    def get(self, path, cold=None):
+        '''
+        Returns the cached data of a single path or None, see
+        CacheStore.get() for cold
+        '''
+        fdata = self.store.get(path, cold)
+
+        if DEBUG:
+            if fdata is not None:
+                print "FSCACHE:  hit"
+            else:
+                print "FSCACHE:  miss"
+        return fdata
+
+    def get_many(self, paths, cold=None):
+        '''
+        Returns the cached data of a list of paths
+        '''
+        # create shortcut to prevent manymany dot-lookups in the loop
+        get = self.store.get
+        return dict((path, get(path, cold)) for path in paths)
+
+    def get_prefix(self, prefix):
+        '''
+        Returns the cached data of all paths starting with prefix
+        '''
+        return self.get_many([path for path in self.store.paths()
+                              if path.startswith(prefix)])
+
+    def get_glob(self, patt):
+        '''
+        Returns the cached data of all paths matching a shell-pattern
+        '''
+        # the literal part of the pattern saves us most regex-matches
+        prefix = re.split(r'[*?\[]', patt, 1)[0]
+        match = re.compile(fnmatch.translate(patt)).match
+        return self.get_many([path for path in self.store.paths()
+                              if path.startswith(prefix) and match(path)])
+
+    def timing(self, name, seconds):
+        '''
+        Adds a duration to the latency-histogram of the given name. The
+        reader-threads race on the histograms, a lost count does not matter.
+        '''
+        hist = self.latency.get(name, None)
+        if hist is None:
+            hist = self.latency.setdefault(name, Histogram())
+        hist.add(seconds)
+
+    def stats(self):
+        '''
+        Returns the counters of the cache. The reader-threads call this while
+        the main loop changes the dicts, they are copied before iterating.
+        '''
+        return {'shard': self.shard,
+                'bytes': self.store.bytes,
+                'max_bytes': self.store.max_bytes,
+                'rss': rss(),
+                'uptime': time.time() - self.started,
+                'jobs': self.store.stats(),
+                'io': dict(self.job_io),
+                'latency': dict((name, hist.summary())
+                                for name, hist in self.latency.items()),
+                'counters': dict(self.counters),
+                'queues': {'parked': len(self.parked),
+                           'loading': len(self.loading),
+                           'active_jobs': sum(len(runs) for runs in self.active_jobs.values()),
+                           'queued_runs': sum(self.queued_runs.values()),
+                           'waiting_jobs': len(self.job_queue) + len(self.load_queue),
+                           'idle_workers': len(self.idle),
+                           'watch_queue': sum(len(paths) for paths in self.watch_queue.values()),
+                           'reconcile': len(self.reconcile),
+                           'resync_pending': len(self.repl_pending)},
+                'replication': {'role': 'replica' if self.repl_primary else
+                                        'primary' if self.repl_pub is not None else 'none',
+                                'resyncs': self.repl_resyncs,
+                                'seqs': dict((job, seq) for job, (_, seq) in self.repl_in.items())
+                                        if self.repl_primary else dict(self.repl_out_seqs)},
+                'schedule': self.sched.stats(),
+                'backoff': self.backoff.delay.value}
+
+    def dump_metrics(self):
+        '''
+        Writes the stats in the prometheus text-format to fsc_metrics_path
+        '''
+        tmp_path = '{0}.{1}'.format(self.metrics_path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as fhandle:
+                fhandle.write(prometheus(self.stats(),
+                                         labels={'jobs': 'job',
+                                                 'io': 'job',
+                                                 'latency': 'op'}))
+            os.rename(tmp_path, self.metrics_path)
+        except (IOError, OSError) as err:
+            print "FSCACHE:  writing metrics failed: {0}".format(err)
+
+    def lookup(self, job, field, values):
+        '''
+        Returns the paths whose projected field matches any of the values
+        '''
+        if job not in self.proj_index:
+            return None
+        index = self.proj_index[job].get(field, {})
+        proj_data = self.proj_data[job]
+        paths = set()
+        for value in values:
+            paths.update(index.get(value, ()))
+
+        values = set(values)
+        result = {}
+        for path in paths:
+            value = proj_data.get(path, {}).get(field)
+            items = value if isinstance(value, list) else [value]
+            result[path] = [item for item in items if item in values]
+        return result
 
     def stop(self):
         '''
@@ -111,8 +1387,6 @@ class FSCache(multiprocessing.Process):
         # avoid getting called twice
         if self.running:
             self.running = False
-            self.timer_stop.set()
-            self.timer.join()
 
     def run(self):
         '''
@@ -120,145 +1394,344 @@ class FSCache(multiprocessing.Process):
         from the workers and answer requests with data from the cache
         '''
         context = zmq.Context()
-        # the socket for incoming cache requests
-        creq_in = context.socket(zmq.REP)
+        # the socket for incoming cache requests. The ROUTER accepts
+        # pipelined requests from REQ- and DEALER-clients alike
+        creq_in = context.socket(zmq.ROUTER)
         creq_in.setsockopt(zmq.LINGER, 100)
-        creq_in.bind("ipc:///tmp/fsc_cache")
+        creq_in.bind(ipc_addr(self.opts, 'cache', self.shard))
+        self.creq_in = creq_in
 
-        # the socket for incoming cache-updates from workers
-        cupd_in = context.socket(zmq.REP)
+        # with reader-threads the requests are proxied to them and
+        # never seen by the main loop. The proxy is stopped through its
+        # control-socket before its sockets are closed on shutdown.
+        if self.num_readers:
+            readers = context.socket(zmq.DEALER)
+            readers.setsockopt(zmq.LINGER, 100)
+            readers.bind("inproc://fsc_readers")
+            for rid in range(self.num_readers):
+                FSReader(self, context, rid).start()
+            proxy_ctl = context.socket(zmq.PAIR)
+            proxy_ctl.bind("inproc://fsc_proxy_ctl")
+            proxy_cmd = context.socket(zmq.PAIR)
+            proxy_cmd.connect("inproc://fsc_proxy_ctl")
+            proxy = Thread(target=zmq.proxy_steerable, args=(creq_in, readers, None, proxy_ctl))
+            proxy.daemon = True
+            proxy.start()
+
+        # the socket for the stream of cache-updates from workers
+        cupd_in = context.socket(zmq.PULL)
         cupd_in.setsockopt(zmq.LINGER, 100)
-        cupd_in.bind("ipc:///tmp/fsc_upd")
+        cupd_in.bind(ipc_addr(self.opts, 'upd', self.shard))
+
+        # the socket for dispatching jobs to the worker-pool. The workers
+        # tell us when they are ready, a job is only sent to a worker that
+        # is. Sending to a worker that went away fails instead of dropping
+        # the job.
+        self.jobs_out = context.socket(zmq.ROUTER)
+        self.jobs_out.setsockopt(zmq.LINGER, 100)
+        self.jobs_out.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        self.jobs_out.bind(ipc_addr(self.opts, 'jobs', self.shard))
 
-        # the socket for the timer-event
-        timer_in = context.socket(zmq.PULL)
-        timer_in.setsockopt(zmq.LINGER, 100)
-        timer_in.connect("ipc:///tmp/fsc_timer")
+        # the socket for the change-events to subscribed clients
+        if self.opts.get('fsc_pub', False):
+            self.pub = context.socket(zmq.PUB)
+            self.pub.setsockopt(zmq.LINGER, 100)
+            self.pub.setsockopt(zmq.SNDHWM, self.opts.get('fsc_pub_hwm', 1000))
+            self.pub.bind(ipc_addr(self.opts, 'events', self.shard))
 
         poller = zmq.Poller()
-        poller.register(creq_in, zmq.POLLIN)
+        if not self.num_readers:
+            poller.register(creq_in, zmq.POLLIN)
         poller.register(cupd_in, zmq.POLLIN)
-        poller.register(timer_in, zmq.POLLIN)
+        poller.register(self.jobs_out, zmq.POLLIN)
+
+        # the sockets of the primary streaming its chunks to the replicas
+        # and answering their resync-requests, and those of a replica
+        if self.repl_bind:
+            self.repl_pub = context.socket(zmq.PUB)
+            self.repl_pub.setsockopt(zmq.LINGER, 100)
+            self.repl_pub.setsockopt(zmq.SNDHWM, self.opts.get('fsc_repl_hwm', 1000))
+            self.repl_pub.bind('tcp://{0}:{1}'.format(self.repl_bind, self.repl_port))
+            self.repl_server = context.socket(zmq.ROUTER)
+            self.repl_server.setsockopt(zmq.LINGER, 100)
+            self.repl_server.bind('tcp://{0}:{1}'.format(self.repl_bind, self.repl_port + 1))
+            poller.register(self.repl_server, zmq.POLLIN)
+        if self.repl_primary:
+            self.repl_sub = context.socket(zmq.SUB)
+            self.repl_sub.setsockopt(zmq.LINGER, 0)
+            for name in self.jobs:
+                self.repl_sub.setsockopt(zmq.SUBSCRIBE, '{0}\0'.format(name))
+            self.repl_sub.connect('tcp://{0}:{1}'.format(self.repl_primary, self.repl_port))
+            self.repl_sync = context.socket(zmq.DEALER)
+            self.repl_sync.setsockopt(zmq.LINGER, 0)
+            self.repl_sync.connect('tcp://{0}:{1}'.format(self.repl_primary, self.repl_port + 1))
+            poller.register(self.repl_sub, zmq.POLLIN)
+            poller.register(self.repl_sync, zmq.POLLIN)
 
         # our serializer
-        serial = salt.payload.Serial(self.opts.get('serial', ''))
+        self.serial = salt.payload.Serial(self.opts.get('serial', ''))
+        serial = self.serial
 
         # register a signal handler
         signal.signal(signal.SIGINT, self.signal_handler)
 
-        print "FSCACHE/{0}: started".format(self.pid)
+        # a replica takes everything from the primary
+        if self.repl_primary:
+            for name in self.jobs:
+                self.repl_resync(name)
+        elif self.leader:
+            self.add_watches(poller)
+
+        if self.shm_path:
+            self.shm = ShmStore(self.shm_path,
+                                self.opts.get('fsc_shm_slots', 131072),
+                                self.opts.get('fsc_shm_size', 256 * 1024 * 1024))
+
+        if self.snap_path:
+            self.load_snapshot()
+            if self.shm is not None:
+                self.shm.rebuild(self.store.items())
+
+        if self.leader:
+            self.check_pool()
+        print "FSCACHE/{0}: shard {1} started".format(self.pid, self.shard)
 
         while self.running:
 
-            # we check for new events with the poller
+            # we check for new events with the poller until the next
+            # deadline of a job or the housekeeping is due
+            now = time.time()
+            timeout = self.tick_due - now
+            # only the leader dispatches, the others would wake up
+            # for deadlines they never clear
+            next_job = self.sched.timeout(now) if self.leader else None
+            if next_job is not None:
+                timeout = min(timeout, next_job)
             try:
-                socks = dict(poller.poll())
+                socks = dict(poller.poll(int(max(0, timeout) * 1000) + 1))
             except KeyboardInterrupt:
                 self.stop()
+                continue
             except zmq.ZMQError as t:
                 self.stop()
+                continue
 
-            # check for next cache-request
+            # answer all pending cache-requests up to req_batch before
+            # looking at updates, requests are what the clients wait for.
+            # Their latency counts from the poll that found them.
             if socks.get(creq_in) == zmq.POLLIN:
-                msg = serial.loads(creq_in.recv())
-                if DEBUG:
-                    print "FSCACHE:  request {0}".format(msg)
-
-                # we only accept requests as lists [req_id, <path>]
-                if isinstance(msg, list):
-                    # for now only one item is assumed to be requested
-                    msgid, file_n = msg[:]
-                    if DEBUG:
-                        print "FSCACHE:  looking for {0}:{1}".format(msgid, file_n)
-
-                    fdata = self.path_data.get(file_n, None)
-
+                t_poll = time.time()
+                for _ in xrange(self.req_batch):
+                    try:
+                        frames = creq_in.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    # everything but the last frame is the routing-envelope
+                    t_start = time.time()
+                    try:
+                        msg = serial.loads(frames[-1])
+                    except Exception:
+                        msg = None
+                    self.timing('deserialize', time.time() - t_start)
+                    self.counters['requests'] += 1
                     if DEBUG:
-                        if fdata is not None:
-                            print "FSCACHE:  hit"
-                        else:
-                            print "FSCACHE:  miss"
+                        print "FSCACHE:  request {0}".format(msg)
 
                     # simulate slow caches
                     #randsleep = random.randint(0,3)
                     #time.sleep(randsleep)
 
+                    # read-through requests for files we do not know
+                    # are answered once the workers loaded them
+                    missing = self.missing_loads(msg)
+                    if missing:
+                        self.park(frames, msg, missing)
+                        continue
+
                     # Send reply back to client
-                    reply = serial.dumps([msgid, fdata])
-                    creq_in.send(reply)
+                    t_handle = time.time()
+                    try:
+                        reply = self.handle_request(msg)
+                    except Exception as err:
+                        reply = self.failed(msg, err)
+                    t_handled = time.time()
+                    self.timing('req_' + op_name(msg), t_handled - t_handle)
+                    frames[-1] = serial.dumps(reply)
+                    t_done = time.time()
+                    self.timing('serialize', t_done - t_handled)
+                    creq_in.send_multipart(frames)
+                    self.backoff.record(t_done - t_poll)
+                self.load_cold()
 
-                # wrong format, item not cached
-                else:
-                    reply = serial.dumps([msgid, None])
-                    creq_in.send(reply)
+            if self.watches:
+                self.read_watches(socks)
+
+            # resync-requests of replicas, anyone may connect to
+            # the port, bad messages are logged and dropped
+            if socks.get(self.repl_server) == zmq.POLLIN:
+                try:
+                    self.repl_serve(self.repl_server.recv_multipart())
+                except Exception as err:
+                    self.repl_dropped('request', err)
+
+            # chunks and resync-states from the primary
+            if socks.get(self.repl_sub) == zmq.POLLIN:
+                for _ in xrange(self.req_batch):
+                    try:
+                        frames = self.repl_sub.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    chunk = self.repl_decode(frames, 2, 'chunk')
+                    if chunk is None:
+                        continue
+                    try:
+                        self.repl_receive(chunk)
+                    except Exception as err:
+                        self.repl_dropped('chunk', err)
+            if socks.get(self.repl_sync) == zmq.POLLIN:
+                state = self.repl_decode(self.repl_sync.recv_multipart(), 1, 'state')
+                if state is not None:
+                    try:
+                        self.repl_restore(state)
+                    except Exception as err:
+                        self.repl_dropped('state', err)
+
+            # workers that are ready for a job or took one
+            if socks.get(self.jobs_out) == zmq.POLLIN:
+                for _ in xrange(self.req_batch):
+                    try:
+                        worker, frame = self.jobs_out.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    self.worker_state(worker, serial.loads(frame))
 
             # check for next cache-update from workers
-            elif socks.get(cupd_in) == zmq.POLLIN:
-                new_c_data = serial.loads(cupd_in.recv())
-                # tell the worker to exit
-                cupd_in.send(serial.dumps('OK'))
+            if socks.get(cupd_in) == zmq.POLLIN:
+                frame = cupd_in.recv()
+                t_start = time.time()
+                new_c_data = serial.loads(frame)
+                self.timing('deserialize_update', time.time() - t_start)
+                del frame
 
                 # check if the returned data is usable
-                if not isinstance(new_c_data, dict):
+                if not isinstance(new_c_data, dict) or 'job' not in new_c_data:
                     if DEBUG:
                         print "FSCACHE:  got unusable worker result"
                     del new_c_data
                     continue
 
-                # the workers will return differing data:
-                # 1. '{'file1': <data1>, 'file2': <data2>,...}' - a cache update
-                # 2. '{search-path: None}' -  job was not run, pre-checks failed
-                # 3. '{}' - no files found, check the pattern if defined?
-                # 4. anything else is considered malformed
+                # the workers send versioned delta-chunks:
+                # 1. '{'job': <name>, 'gen': <gen>, 'seq': <num>, 'last': <bool>,
+                #      'upsert': {'file1': <data1>,...}, 'sigs': {'file1': <sig>,...},
+                #      'delete': [<file>,...]}' - a cache update
+                # 2. '{'job': <name>, 'gen': <gen>, 'error': <msg>}' - job was
+                #    not run, pre-checks failed
+                # 3. anything else is considered malformed
 
-                if len(new_c_data) == 0:
-                    if DEBUG:
-                        print "FSCACHE:  got empty update from worker:"
-                elif new_c_data.values()[0] is not None:
+                if 'error' in new_c_data:
+                    print "FSCACHE:  job {0} failed: {1}".format(new_c_data['job'],
+                                                                new_c_data['error'])
+                    self.counters['failed_jobs'] += 1
+                    self.job_done(new_c_data['job'], new_c_data['gen'])
+                elif 'upsert' in new_c_data:
                     if DEBUG:
-                        print "FSCACHE:  got cache update: {0}".format(len(new_c_data))
-                    self.path_data.update(new_c_data)
+                        print "FSCACHE:  got cache update {0}/{1}/{2}: {3}/{4}".format(new_c_data['job'],
+                                                                                      new_c_data['gen'],
+                                                                                      new_c_data['seq'],
+                                                                                      len(new_c_data['upsert']),
+                                                                                      len(new_c_data['delete']))
+                    t_start = time.time()
+                    self.apply_update(new_c_data)
+                    self.timing('apply', time.time() - t_start)
+                    self.counters['updates'] += 1
+                    if self.parked or self.loading:
+                        self.unpark(new_c_data['upsert'].keys() + new_c_data['delete'],
+                                    new_c_data['upsert'])
+                    if new_c_data['last'] and not new_c_data.get('load'):
+                        started = self.active_jobs.get(new_c_data['job'], {}).get(new_c_data['gen'], None)
+                        self.job_done(new_c_data['job'], new_c_data['gen'])
+                        if 'io' in new_c_data:
+                            if started is not None:
+                                new_c_data['io']['seconds'] = time.time() - started
+                            self.job_io[new_c_data['job']] = new_c_data['io']
                 else:
                     if DEBUG:
                         print "FSCACHE:  got malformed result dict from worker"
                 if DEBUG:
-                    print "FSCACHE:  {0} entries".format(len(self.path_data))
+                    print "FSCACHE:  {0} entries".format(len(self.store))
+                del new_c_data
 
-            # check for next timer-event to start new jobs
-            elif socks.get(timer_in) == zmq.POLLIN:
-                sec_event = serial.loads(timer_in.recv())
-
-                if DEBUG:
-                    print "FSCACHE:  event: #{0}".format(sec_event)
-
-                # loop through the jobs and start if a jobs ival matches
-                for item in self.jobs:
-                    if sec_event in self.jobs[item]['ival']:
-                        self.run_job(item)
+            now = time.time()
+            if now >= self.tick_due:
+                self.tick_due = now + 1
+                self.housekeeping()
+            if self.leader:
+                self.dispatch_due()
         self.stop()
+        self.stop_pool()
+        if self.snap_path:
+            if self.snap_pid is not None:
+                os.waitpid(self.snap_pid, 0)
+            self.save_snapshot(fork=False)
+        if self.shm is not None:
+            self.shm.close()
+        for _, watch in self.watches.itervalues():
+            watch.close()
+        if self.num_readers:
+            proxy_cmd.send('TERMINATE')
+            proxy.join()
+            proxy_cmd.close()
+            proxy_ctl.close()
+            readers.close()
         creq_in.close()
         cupd_in.close()
-        timer_in.close()
+        self.jobs_out.close()
+        if self.pub is not None:
+            self.pub.close()
+        for sock in (self.repl_pub, self.repl_server, self.repl_sub, self.repl_sync):
+            if sock is not None:
+                sock.close()
+        # the readers blocking in their sockets get an ETERM,
+        # close them and exit
         context.term()
         print "FSCACHE/{0}:  exiting".format(self.pid)
 
+
+def start_cache(opts, jobs):
+    '''
+    Starts an FSCache with the given job-dicts, one per shard if
+    fsc_shards is set. Returns the started processes.
+    '''
+    caches = []
+    for shard in range(opts.get('fsc_shards', 1)):
+        cache = FSCache(opts, shard)
+        for job in jobs:
+            cache.add_job(**dict(job))
+        caches.append(cache)
+    # the Backoffs live in shared memory, all of them have
+    # to exist before the leader forks its workers
+    caches[0].shard_backoffs = [cache.backoff for cache in caches]
+    for cache in caches:
+        cache.start()
+    return caches
+
 if __name__ == '__main__':
 
     opts = salt.config.master_config('./master')
 
-    wlk = FSCache(opts)
     # add two jobs for jobs and cache-files
-    wlk.add_job(**{
-                    'name': 'grains',
-                    'path': '/var/cache/salt/master/minions',
-                    'ival': [2,12,22],
-                    'patt': '^.*$'
-                  })
-
-    wlk.add_job(**{
-                    'name': 'mine',
-                    'path': '/var/cache/salt/master/jobs/',
-                    'ival': [4,14,24,34,44,54],
-                    'patt': '^.*$'
-                })
-    wlk.start()
+    start_cache(opts, [{
+                         'name': 'grains',
+                         'path': '/var/cache/salt/master/minions',
+                         'ival': [2],
+                         'patt': r'^.*/data\.p$',
+                         'incr': True,
+                         'watch': True,
+                         'proj': {'ipv4': 'grains.ipv4'}
+                       },
+                       {
+                         'name': 'mine',
+                         'path': '/var/cache/salt/master/jobs/',
+                         'ival': [4,14,24,34,44,54],
+                         'patt': '^.*$'
+                       }])
@@ -0,0 +1,266 @@
+'''
+An asyncio-client for the FSCache, for callers running an event-loop.
+
+The CacheCli in minions-cache.py has one request in flight at a time. The
+AsyncCacheCli sends its requests over DEALER-sockets without waiting for the
+replies and matches the replies to the requests by their msgid, an event-loop
+can keep hundreds of lookups in flight on a single connection per shard.
+Every request has a deadline that grows with its work like in CacheCli, at
+most max_inflight requests are sent at once, the others wait for a free slot.
+
+This module needs python 3 and pyzmq with asyncio-support, unlike the rest
+of the cache. It does not import the python 2 modules, ipc_addr() and
+shard_of() have to agree with those in fsworker.
+'''
+import asyncio
+import itertools
+import zlib
+
+import zmq
+import zmq.asyncio
+import salt.payload
+
+
+class CacheUnavailable(Exception):
+    '''
+    Raised when the FSCache did not answer within the deadline or
+    answered with an error
+    '''
+
+
+def ipc_addr(opts, name, shard=0):
+    '''
+    Returns the address of one of the FSCaches IPC-sockets, see fsworker
+    '''
+    if opts.get('fsc_shards', 1) > 1:
+        name = '{0}.{1}'.format(name, shard)
+    return 'ipc://{0}/fsc_{1}'.format(opts.get('fsc_ipc_dir', '/tmp'), name)
+
+
+def shard_of(path, shards):
+    '''
+    Returns the FSCache-shard owning a path, see fsworker
+    '''
+    if shards <= 1:
+        return 0
+    if isinstance(path, str):
+        path = path.encode('utf-8')
+    return (zlib.crc32(path) & 0xffffffff) % shards
+
+
+class AsyncCacheCli(object):
+    '''
+    The pipelining client of the FSCache. The sockets and the tasks reading
+    the replies are created on the first request, inside the running loop.
+    Paths are read from disk if the cache does not answer in time.
+    '''
+
+    def __init__(self, opts, timeout=20, read_through=False, max_inflight=256):
+        self.opts = opts
+        self.shards = self.opts.get('fsc_shards', 1)
+        # the milliseconds to wait for a reply, read-through requests
+        # wait for the FSCache to load the files from disk as well
+        self.timeout = self.opts.get('fsc_cli_timeout', timeout)
+        self.load_timeout = self.timeout + self.opts.get('fsc_load_timeout', 5) * 1000
+        self.path_timeout = self.opts.get('fsc_cli_path_timeout', 0.1)
+        self.bulk_timeout = self.opts.get('fsc_cli_bulk_timeout', 2000)
+        self.read_through = read_through
+        self.max_inflight = self.opts.get('fsc_cli_inflight', max_inflight)
+        self.serial = salt.payload.Serial(self.opts.get('serial', ''))
+
+        # the ids of the requests count up, a late reply to a request
+        # that ran into its deadline can never be taken for another one
+        self.msgids = itertools.count(1)
+        # the requests waiting for their reply as {msgid: future}
+        self.pending = {}
+        self.context = None
+        self.socks = []
+        self.readers = []
+        self.slots = None
+
+    def connect(self):
+        '''
+        Opens a socket to every shard and starts reading their replies
+        '''
+        self.context = zmq.asyncio.Context()
+        self.slots = asyncio.Semaphore(self.max_inflight)
+        for shard in range(self.shards):
+            # a DEALER with an empty delimiter-frame talks like a REQ
+            # socket, but is not limited to one outstanding request
+            sock = self.context.socket(zmq.DEALER)
+            sock.setsockopt(zmq.LINGER, 0)
+            sock.connect(ipc_addr(self.opts, 'cache', shard))
+            self.socks.append(sock)
+            self.readers.append(asyncio.ensure_future(self.read_replies(sock)))
+
+    async def read_replies(self, sock):
+        '''
+        Hands the replies of a socket to the requests waiting for them,
+        replies nobody waits for anymore are dropped
+        '''
+        while True:
+            frames = await sock.recv_multipart()
+            try:
+                reply = self.serial.loads(frames[-1])
+                future = self.pending.pop(reply[0], None)
+            except Exception:
+                continue
+            if future is not None and not future.done():
+                future.set_result(reply)
+
+    def deadline(self, query):
+        '''
+        Returns the milliseconds to wait for the reply to a query
+        '''
+        if isinstance(query, list):
+            return self.timeout + len(query) * self.path_timeout
+        if not isinstance(query, dict):
+            return self.timeout
+        if query.get('op') in ('glob', 'index', 'snapshot'):
+            return self.bulk_timeout
+        timeout = self.load_timeout if query.get('load') else self.timeout
+        return timeout + len(query.get('paths', ())) * self.path_timeout
+
+    async def request(self, query, shard=0, timeout=None):
+        '''
+        Sends a query to a shard of the FSCache and returns the data of its
+        reply. See FSCache.handle_request() for the possible queries. Raises
+        CacheUnavailable if there was no reply within timeout milliseconds
+        or the reply is an error.
+        '''
+        if self.context is None:
+            self.connect()
+        if timeout is None:
+            timeout = self.deadline(query)
+
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout / 1000.0
+        try:
+            # the wait for a slot counts against the deadline
+            await asyncio.wait_for(self.slots.acquire(), timeout / 1000.0)
+        except asyncio.TimeoutError:
+            raise CacheUnavailable('no free slot within {0}ms'.format(timeout))
+        msgid = next(self.msgids)
+        future = loop.create_future()
+        self.pending[msgid] = future
+        try:
+            await self.socks[shard].send_multipart([b'', self.serial.dumps([msgid, query])])
+            reply = await asyncio.wait_for(future, max(0, deadline - loop.time()))
+        except asyncio.TimeoutError:
+            raise CacheUnavailable('no reply within {0}ms'.format(timeout))
+        finally:
+            self.pending.pop(msgid, None)
+            self.slots.release()
+        if len(reply) > 3 and reply[3]:
+            raise CacheUnavailable(reply[3])
+        return reply[1]
+
+    async def read_file(self, path):
+        '''
+        Reads a file from disk in the loops executor when the FSCache
+        is not available
+        '''
+        def read():
+            try:
+                with open(path, 'rb') as fhandle:
+                    return fhandle.read()
+            except (IOError, OSError):
+                return None
+        return await asyncio.get_event_loop().run_in_executor(None, read)
+
+    async def get(self, path):
+        '''
+        Returns the cached data of a path or None
+        '''
+        shard = shard_of(path, self.shards)
+        try:
+            if self.read_through:
+                return await self.request({'op': 'get', 'path': path, 'load': True}, shard)
+            return await self.request(path, shard)
+        except CacheUnavailable:
+            return await self.read_file(path)
+
+    async def get_many(self, paths):
+        '''
+        Returns {<path>: <data>} for a list of paths with one request per
+        shard, paths that are not cached have None as their data
+        '''
+        by_shard = {}
+        for path in paths:
+            by_shard.setdefault(shard_of(path, self.shards), []).append(path)
+
+        async def get_shard(shard, s_paths):
+            try:
+                if self.read_through:
+                    return await self.request({'op': 'mget', 'paths': s_paths, 'load': True},
+                                              shard) or {}
+                return await self.request(s_paths, shard) or {}
+            except CacheUnavailable:
+                datas = await asyncio.gather(*[self.read_file(path) for path in s_paths])
+                return dict(zip(s_paths, datas))
+
+        found = {}
+        for data in await asyncio.gather(*[get_shard(shard, s_paths)
+                                           for shard, s_paths in by_shard.items()]):
+            found.update(data)
+        return found
+
+    async def get_glob(self, patt):
+        '''
+        Returns {<path>: <data>} for all cached paths matching a
+        shell-pattern, None if a shard of the FSCache is not available.
+        The files the FSCache evicted from memory are read from disk.
+        '''
+        query = {'op': 'glob', 'patt': patt}
+        try:
+            replies = await asyncio.gather(*[self.request(query, shard)
+                                             for shard in range(self.shards)])
+        except CacheUnavailable:
+            return None
+        found = {}
+        for data in replies:
+            found.update(data or {})
+        cold = [path for path, fdata in found.items() if fdata is None]
+        for path, fdata in zip(cold, await asyncio.gather(*[self.read_file(path)
+                                                            for path in cold])):
+            found[path] = fdata
+        return found
+
+    async def lookup(self, job, field, values):
+        '''
+        Returns {<path>: [<value>, ...]} for all paths whose projected field
+        in the given cache-job matches any of the values, or None if the job
+        has no projection or a shard of the FSCache is not available
+        '''
+        query = {'op': 'index',
+                 'job': job,
+                 'field': field,
+                 'values': list(values)}
+        try:
+            replies = await asyncio.gather(*[self.request(query, shard)
+                                             for shard in range(self.shards)])
+        except CacheUnavailable:
+            return None
+        if None in replies:
+            return None
+        found = {}
+        for data in replies:
+            found.update(data)
+        return found
+
+    def close(self):
+        '''
+        Cancels the reader-tasks and the waiting requests
+        '''
+        for reader in self.readers:
+            reader.cancel()
+        for future in self.pending.values():
+            future.cancel()
+        self.pending = {}
+        for sock in self.socks:
+            sock.close()
+        if self.context is not None:
+            self.context.term()
+        self.context = None
+        self.socks = []
+        self.readers = []
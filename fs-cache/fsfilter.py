@@ -0,0 +1,121 @@
+'''
+The filter deciding which files of a jobs directory are cached.
+
+A job selects its files with the regex in 'patt' and optionally with lists of
+shell-patterns in 'include' and 'exclude'. Directories matching one of the
+shell-patterns in 'prune' are skipped without listing them. If all includes
+start with a literal directory, directories off the way to them are skipped
+as well.
+
+All patterns are compiled once per job. Patterns that only test the end or the
+beginning of a path, like '*/data.p' or '^.*\\.p$', are checked with
+str.endswith() and str.startswith() instead of a regex.
+'''
+import fnmatch
+import re
+
+# the characters that make a regex more than a literal string
+REGEX_META = re.compile(r'[.^$*+?{}\[\]\\|()]')
+GLOB_META = re.compile(r'[*?\[]')
+
+
+def regex_suffix(patt):
+    '''
+    Returns the literal suffix of a regex like '^.*/data\\.p$' that matches
+    exactly the strings ending with it, or None
+    '''
+    match = re.match(r'^\^?\.\*((?:[^.^$*+?{}\[\]\\|()]|\\[.^$*+?{}\[\]\\|()])*)\$$', patt)
+    if match is None:
+        return None
+    return re.sub(r'\\(.)', r'\1', match.group(1))
+
+
+def compile_glob(patt):
+    '''
+    Returns a function testing a path against a shell-pattern, a plain
+    endswith() or startswith() if the pattern allows it
+    '''
+    if patt.startswith('*') and not GLOB_META.search(patt[1:]):
+        suffix = patt[1:]
+        return lambda path: path.endswith(suffix)
+    if patt.endswith('*') and not GLOB_META.search(patt[:-1]):
+        prefix = patt[:-1]
+        return lambda path: path.startswith(prefix)
+    if not GLOB_META.search(patt):
+        return lambda path: path == patt
+    return re.compile(fnmatch.translate(patt)).match
+
+
+def compile_regex(patt):
+    '''
+    Returns a function testing a path against a regex with re.match(),
+    a plain endswith() if the regex allows it
+    '''
+    suffix = regex_suffix(patt)
+    if suffix is not None:
+        return lambda path: path.endswith(suffix)
+    return re.compile(patt).match
+
+
+class PathFilter(object):
+    '''
+    The compiled patterns of a job. match() tests files, want_dir()
+    tests directories before they are listed.
+    '''
+
+    def __init__(self, patt=None, include=(), exclude=(), prune=()):
+        self.patt = compile_regex(patt) if patt else None
+        self.include = [compile_glob(glob) for glob in include]
+        self.exclude = [compile_glob(glob) for glob in exclude]
+        self.prune = [compile_glob(glob) for glob in prune]
+        # the literal directories the includes start with, if all have one
+        self.roots = []
+        for glob in include:
+            literal = GLOB_META.split(glob, 1)[0]
+            if '/' not in literal:
+                self.roots = []
+                break
+            self.roots.append(literal[:literal.rindex('/') + 1])
+
+    @classmethod
+    def from_job(cls, job):
+        '''
+        Creates the filter for a job-dict
+        '''
+        return cls(job.get('patt', None),
+                   job.get('include', ()),
+                   job.get('exclude', ()),
+                   job.get('prune', ()))
+
+    def match(self, path):
+        '''
+        Checks wether a file is part of the job
+        '''
+        if self.patt is not None and not self.patt(path):
+            return False
+        if self.include:
+            for include in self.include:
+                if include(path):
+                    break
+            else:
+                return False
+        for exclude in self.exclude:
+            if exclude(path):
+                return False
+        return True
+
+    def want_dir(self, path):
+        '''
+        Checks wether a directory may hold files of the job
+        '''
+        for prune in self.prune:
+            if prune(path):
+                return False
+        if self.roots:
+            path += '/'
+            for root in self.roots:
+                # on the way down to the root or below it
+                if root.startswith(path) or path.startswith(root):
+                    return True
+            return False
+        return True
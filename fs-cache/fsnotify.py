@@ -0,0 +1,135 @@
+'''
+A minimal ctypes-binding to the linux inotify-api to watch a directory-tree
+for changed files.
+
+The FSCache registers the file-descriptor of an Inotify-instance in its
+poller and reads the changed paths whenever it becomes readable. Changes the
+kernel could not report in detail, like a queue-overflow or a directory moved
+out of the tree, are signaled by read() and require a full walk of the tree.
+'''
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# the events we need to keep the cache up to date
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+EVENT = struct.Struct('iIII')
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                        use_errno=True)
+    _libc.inotify_init1
+except (OSError, AttributeError):
+    _libc = None
+
+
+class Inotify(object):
+    '''
+    Watches a directory and all its subdirectories
+    '''
+
+    def __init__(self, root):
+        if _libc is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.root = root
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        # {watch-descriptor: directory}
+        self.wds = {}
+        self.add_tree(root)
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+
+    def add_watch(self, directory):
+        '''
+        Adds a watch for a single directory, returns False if that failed
+        '''
+        wd = _libc.inotify_add_watch(self.fd, directory, WATCH_MASK | IN_ONLYDIR)
+        if wd < 0:
+            if ctypes.get_errno() == errno.ENOSPC:
+                print "INOTIFY:  out of watches, raise fs.inotify.max_user_watches"
+            return False
+        self.wds[wd] = directory
+        return True
+
+    def add_tree(self, directory):
+        '''
+        Adds watches for a directory and its subdirectories and returns
+        the files found in them. They may have been created before the
+        watch was in place.
+        '''
+        files = []
+        for path, dirs, names in os.walk(directory):
+            self.add_watch(path)
+            files.extend(os.path.join(path, name) for name in names)
+        return files
+
+    def read(self):
+        '''
+        Reads all pending events and returns (changed, overflow). The
+        changed paths are files that were written, moved or deleted,
+        overflow is True if events were lost.
+        '''
+        changed = set()
+        overflow = False
+        while 1:
+            try:
+                buf = os.read(self.fd, 65536)
+            except OSError as err:
+                if err.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            if not buf:
+                break
+            pos = 0
+            while pos < len(buf):
+                wd, mask, _, length = EVENT.unpack_from(buf, pos)
+                name = buf[pos + EVENT.size:pos + EVENT.size + length].rstrip('\0')
+                pos += EVENT.size + length
+
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                if mask & IN_IGNORED:
+                    self.wds.pop(wd, None)
+                    continue
+                directory = self.wds.get(wd, None)
+                if directory is None or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    continue
+                path = os.path.join(directory, name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        changed.update(self.add_tree(path))
+                    elif mask & IN_MOVED_FROM:
+                        # the files moved away with it are not reported
+                        overflow = True
+                else:
+                    if mask & (IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE):
+                        changed.add(path)
+        return changed, overflow
@@ -0,0 +1,261 @@
+'''
+A deadline-scheduler for the FSCaches jobs.
+
+The deadlines of all jobs are kept in a heap. The FSCache polls its sockets
+with the time until the earliest deadline as timeout and asks for the jobs
+that are due once the poll returns. There is no timer-thread, a busy loop
+delays a run, it does not lose it.
+
+A jobs 'ival' is one of
+
+    [<sec>, ...] - the seconds within every minute to run on
+    <seconds> - run every that many seconds, aligned to multiples of it
+    '<cron>' - a cron-expression 'minute hour day month weekday' with
+               '*', '*/n', 'a-b', 'a-b/n' and 'a,b,...' in each field
+
+'jitter' delays every run by a random amount of up to that many seconds to
+keep jobs with the same ival from running at once. 'catchup' decides what
+happens to runs that were missed because the loop was busy or the host slept:
+
+    'once' - run once, no matter how many runs were missed (default)
+    'all' - run once for every missed run, at most MAX_CATCHUP times
+    'skip' - do not run at all if the deadline is more than 'grace'
+             seconds (default 1) in the past
+'''
+import datetime
+import heapq
+import random
+import time
+
+MAX_CATCHUP = 10
+
+
+class Seconds(object):
+    '''
+    Fires on the given seconds within every minute
+    '''
+
+    def __init__(self, seconds):
+        self.seconds = sorted(set(int(sec) % 60 for sec in seconds))
+        if not self.seconds:
+            raise ValueError('no seconds to run on')
+
+    def next_after(self, stamp):
+        '''
+        Returns the first deadline after stamp
+        '''
+        minute = int(stamp // 60) * 60
+        for sec in self.seconds:
+            if minute + sec > stamp:
+                return minute + sec
+        return minute + 60 + self.seconds[0]
+
+
+class Interval(object):
+    '''
+    Fires every <every> seconds, on multiples of it
+    '''
+
+    def __init__(self, every):
+        if every <= 0:
+            raise ValueError('the interval must be positive')
+        self.every = every
+
+    def next_after(self, stamp):
+        '''
+        Returns the first deadline after stamp
+        '''
+        return (int(stamp // self.every) + 1) * self.every
+
+
+def parse_cron_field(field, low, high):
+    '''
+    Returns the set of values a cron-field matches
+    '''
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/', 1)
+            step = int(step)
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = [int(val) for val in part.split('-', 1)]
+        else:
+            start = end = int(part)
+            if step != 1:
+                end = high
+        if start < low or end > high or start > end or step < 1:
+            raise ValueError('invalid cron-field {0}'.format(field))
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class Cron(object):
+    '''
+    Fires on the minutes matching a cron-expression, in local time. Like
+    in cron, a day matches if either the day of the month or the weekday
+    matches when both are restricted.
+    '''
+
+    def __init__(self, expr):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError('a cron-expression needs five fields: {0}'.format(expr))
+        self.minutes = parse_cron_field(fields[0], 0, 59)
+        self.hours = parse_cron_field(fields[1], 0, 23)
+        self.days = parse_cron_field(fields[2], 1, 31)
+        self.months = parse_cron_field(fields[3], 1, 12)
+        # 0 and 7 are both sunday
+        self.weekdays = set(day % 7 for day in parse_cron_field(fields[4], 0, 7))
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    def day_matches(self, moment):
+        '''
+        Checks the day of the month and the weekday of a datetime
+        '''
+        day = moment.day in self.days
+        weekday = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, stamp):
+        '''
+        Returns the first deadline after stamp
+        '''
+        moment = datetime.datetime.fromtimestamp(int(stamp // 60) * 60)
+        moment += datetime.timedelta(minutes=1)
+        # a few years cover every valid expression, the
+        # others like '* * 31 2 *' never match
+        limit = moment + datetime.timedelta(days=5 * 366)
+        while moment < limit:
+            if moment.month not in self.months:
+                year = moment.year + moment.month // 12
+                moment = moment.replace(year=year, month=moment.month % 12 + 1, day=1,
+                                        hour=0, minute=0)
+            elif not self.day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + datetime.timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += datetime.timedelta(minutes=1)
+            else:
+                return time.mktime(moment.timetuple())
+        raise ValueError('the cron-expression never matches')
+
+
+def make_spec(ival):
+    '''
+    Returns the schedule for a jobs ival
+    '''
+    if isinstance(ival, (list, tuple)):
+        return Seconds(ival)
+    if isinstance(ival, basestring):
+        return Cron(ival)
+    return Interval(ival)
+
+
+class Entry(object):
+    '''
+    The schedule of a single job
+    '''
+
+    def __init__(self, name, spec, jitter=0, catchup='once', grace=1):
+        if catchup not in ('once', 'all', 'skip'):
+            raise ValueError('unknown catchup-policy {0}'.format(catchup))
+        self.name = name
+        self.spec = spec
+        self.jitter = jitter
+        self.catchup = catchup
+        self.grace = grace
+        # the deadline without jitter, the next one is computed from it
+        self.base = 0
+        self.deadline = 0
+        self.missed = 0
+        self.skipped = 0
+
+    def schedule(self, base):
+        '''
+        Sets the next deadline
+        '''
+        self.base = base
+        self.deadline = base
+        if self.jitter:
+            self.deadline += random.uniform(0, self.jitter)
+
+
+class Scheduler(object):
+    '''
+    The heap of the jobs deadlines
+    '''
+
+    def __init__(self):
+        self.heap = []
+        self.entries = {}
+
+    def add(self, name, ival, jitter=0, catchup='once', grace=1):
+        '''
+        Adds a job or replaces its schedule
+        '''
+        entry = Entry(name, make_spec(ival), jitter, catchup, grace)
+        entry.schedule(entry.spec.next_after(time.time()))
+        self.entries[name] = entry
+        heapq.heappush(self.heap, (entry.deadline, name, entry))
+
+    def remove(self, name):
+        '''
+        Removes a job, its heap-entry is dropped once it comes up
+        '''
+        self.entries.pop(name, None)
+
+    def timeout(self, now=None):
+        '''
+        Returns the seconds until the next deadline or None
+        '''
+        if not self.heap:
+            return None
+        return max(0, self.heap[0][0] - (now or time.time()))
+
+    def due(self, now=None):
+        '''
+        Returns the names of the jobs that are due, a name is in there
+        several times if the job has to catch up on missed runs
+        '''
+        now = now or time.time()
+        names = []
+        while self.heap and self.heap[0][0] <= now:
+            _, name, entry = heapq.heappop(self.heap)
+            if self.entries.get(name, None) is not entry:
+                continue
+            missed = 0
+            base = entry.spec.next_after(entry.base)
+            while base <= now:
+                missed += 1
+                if missed >= MAX_CATCHUP:
+                    base = entry.spec.next_after(now)
+                    break
+                base = entry.spec.next_after(base)
+            entry.missed += missed
+
+            if entry.catchup == 'skip' and now - entry.deadline > entry.grace:
+                entry.skipped += 1
+            elif entry.catchup == 'all':
+                # the due run and the missed ones, MAX_CATCHUP in all
+                names.extend([name] * min(missed + 1, MAX_CATCHUP))
+            else:
+                names.append(name)
+            entry.schedule(base)
+            heapq.heappush(self.heap, (entry.deadline, name, entry))
+        return names
+
+    def stats(self):
+        '''
+        Returns the next deadline and the missed and skipped runs per job
+        '''
+        return dict((name, {'next': entry.deadline,
+                            'missed': entry.missed,
+                            'skipped': entry.skipped})
+                    for name, entry in self.entries.items())
@@ -0,0 +1,251 @@
+'''
+A memory-mapped store for the FSCaches data that clients on the same host
+can read without going through the FSCaches IPC-socket.
+
+The FSCache is the only writer. It appends keys and data to an arena and
+points the slots of an open-addressing hash-index at them. Every slot has its
+own sequence-counter that is odd while the slot is written, readers retry
+until they read the same even counter before and after reading a slot
+(a seqlock). Data in the arena is never overwritten, so a reader that passed
+the check always holds consistent data.
+
+Once the arena or the index is full, the writer builds a new file from the
+live data, renames it over the old one and marks the old one as stale.
+Readers notice the stale-flag and re-open the path.
+
+Layout of the file:
+
+    header  - magic, slots, arena-offset, arena-size, arena-used, stale, count
+    index   - <slots> times: seq, hash, key-offset, key-length,
+                             data-offset, data-length, generation
+    arena   - keys and data
+'''
+import mmap
+import os
+import struct
+import zlib
+
+MAGIC = 'FSCSHM01'
+HEADER = struct.Struct('<8sQQQQQQ')
+SLOT = struct.Struct('<QQQIQIQ')
+# the data-length of a deleted entry
+TOMBSTONE = 0xffffffff
+# offsets of the fields in the header we update in place
+H_USED = 32
+H_STALE = 40
+H_COUNT = 48
+
+
+def key_hash(key):
+    '''
+    A hash of the key that is the same in all processes, never 0
+    which marks an empty slot
+    '''
+    return ((zlib.crc32(key) & 0xffffffff) << 32 | (zlib.adler32(key) & 0xffffffff)) or 1
+
+
+class ShmStore(object):
+    '''
+    The writing side of the store, used by the FSCache
+    '''
+
+    def __init__(self, path, slots=131072, size=256 * 1024 * 1024):
+        self.path = path
+        self.nslots = slots
+        self.size = size
+        # {key: slot-number} to spare us probing the index on writes
+        self.index = {}
+        self.mm = None
+        self.create()
+
+    def create(self):
+        '''
+        Creates a new empty store file and renames it over the current one
+        '''
+        arena_off = HEADER.size + self.nslots * SLOT.size
+        tmp_path = '{0}.{1}'.format(self.path, os.getpid())
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            os.ftruncate(fd, arena_off + self.size)
+            new_mm = mmap.mmap(fd, arena_off + self.size)
+        finally:
+            os.close(fd)
+        HEADER.pack_into(new_mm, 0, MAGIC, self.nslots, arena_off, self.size,
+                         0, 0, 0)
+        os.rename(tmp_path, self.path)
+
+        # tell the readers of the old file to re-open the path
+        if self.mm is not None:
+            struct.pack_into('<Q', self.mm, H_STALE, 1)
+            self.mm.close()
+        self.mm = new_mm
+        self.arena_off = arena_off
+        self.used = 0
+        self.index = {}
+
+    def close(self):
+        '''
+        Removes the store, readers fall back to the FSCache
+        '''
+        if self.mm is not None:
+            struct.pack_into('<Q', self.mm, H_STALE, 1)
+            self.mm.close()
+            self.mm = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def _alloc(self, blob):
+        '''
+        Appends a blob to the arena and returns its offset or None if full
+        '''
+        if self.used + len(blob) > self.size:
+            return None
+        offset = self.arena_off + self.used
+        self.mm[offset:offset + len(blob)] = blob
+        self.used += len(blob)
+        struct.pack_into('<Q', self.mm, H_USED, self.used)
+        return offset
+
+    def _write_slot(self, num, hsh, key_off, key_len, data_off, data_len, gen):
+        '''
+        Writes a slot guarded by its sequence-counter
+        '''
+        pos = HEADER.size + num * SLOT.size
+        seq = struct.unpack_from('<Q', self.mm, pos)[0]
+        struct.pack_into('<Q', self.mm, pos, seq + 1)
+        SLOT.pack_into(self.mm, pos, seq + 1, hsh, key_off, key_len,
+                       data_off, data_len, gen)
+        struct.pack_into('<Q', self.mm, pos, seq + 2)
+
+    def put(self, key, data, gen=0):
+        '''
+        Stores data for a key. Returns False if the store is full and
+        needs to be rebuilt with rebuild().
+        '''
+        num = self.index.get(key, None)
+        if num is None:
+            # keep the index at most 70% full to keep the probing short
+            if len(self.index) * 10 >= self.nslots * 7:
+                return False
+            hsh = key_hash(key)
+            num = hsh % self.nslots
+            while SLOT.unpack_from(self.mm, HEADER.size + num * SLOT.size)[1]:
+                num = (num + 1) % self.nslots
+            key_off = self._alloc(key)
+            if key_off is None:
+                return False
+            data_off = self._alloc(data)
+            if data_off is None:
+                return False
+            self._write_slot(num, hsh, key_off, len(key), data_off, len(data), gen)
+            self.index[key] = num
+            struct.pack_into('<Q', self.mm, H_COUNT, len(self.index))
+            return True
+
+        _, hsh, key_off, key_len, _, _, _ = SLOT.unpack_from(self.mm,
+                                                             HEADER.size + num * SLOT.size)
+        data_off = self._alloc(data)
+        if data_off is None:
+            return False
+        self._write_slot(num, hsh, key_off, key_len, data_off, len(data), gen)
+        return True
+
+    def delete(self, key, gen=0):
+        '''
+        Marks a keys slot as deleted, the slot is reused if the key comes back
+        '''
+        num = self.index.get(key, None)
+        if num is None:
+            return
+        _, hsh, key_off, key_len, _, _, _ = SLOT.unpack_from(self.mm,
+                                                             HEADER.size + num * SLOT.size)
+        self._write_slot(num, hsh, key_off, key_len, 0, TOMBSTONE, gen)
+
+    def rebuild(self, items):
+        '''
+        Replaces the store with a new one holding only the given
+        (key, data) items, growing it if they would not fit
+        '''
+        items = list(items)
+        # keep the generations of the entries we already know
+        gens = {}
+        for key, num in self.index.iteritems():
+            gens[key] = SLOT.unpack_from(self.mm, HEADER.size + num * SLOT.size)[6]
+        need = sum(len(key) + len(data) for key, data in items)
+        while need * 2 > self.size:
+            self.size *= 2
+        while len(items) * 2 > self.nslots:
+            self.nslots *= 2
+        self.create()
+        for key, data in items:
+            self.put(key, data, gens.get(key, 0))
+
+
+class ShmReader(object):
+    '''
+    The reading side of the store, used by the cache-clients
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.mm = None
+
+    def open(self):
+        '''
+        Maps the store, returns False if there is no usable store
+        '''
+        # the old mapping is not closed, buffers handed out with
+        # copy=False may still point into it
+        self.mm = None
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            self.mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            return False
+        finally:
+            os.close(fd)
+        magic, self.nslots, _, _, _, stale, _ = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or stale:
+            self.mm = None
+            return False
+        return True
+
+    def get(self, key, copy=True):
+        '''
+        Returns the data of a key or None if it is not in the store. With
+        copy=False a buffer pointing into the mapping is returned.
+        '''
+        if self.mm is None or struct.unpack_from('<Q', self.mm, H_STALE)[0]:
+            if not self.open():
+                return None
+        mm = self.mm
+        hsh = key_hash(key)
+        num = hsh % self.nslots
+        for _ in xrange(self.nslots):
+            pos = HEADER.size + num * SLOT.size
+            while 1:
+                seq, s_hsh, key_off, key_len, data_off, data_len, _ = SLOT.unpack_from(mm, pos)
+                # the writer is busy with this slot
+                if seq & 1:
+                    continue
+                if s_hsh == 0:
+                    return None
+                found = s_hsh == hsh and mm[key_off:key_off + key_len] == key
+                if found and data_len != TOMBSTONE:
+                    if copy:
+                        data = mm[data_off:data_off + data_len]
+                    else:
+                        data = buffer(mm, data_off, data_len)
+                if struct.unpack_from('<Q', mm, pos)[0] == seq:
+                    break
+            if found:
+                if data_len == TOMBSTONE:
+                    return None
+                return data
+            num = (num + 1) % self.nslots
+        return None
@@ -0,0 +1,96 @@
+'''
+Snapshots of the FSCaches data for fast restarts.
+
+A snapshot is a single file holding the cached files and a serialized blob of
+metadata, the manifests and projections of the jobs. It is written to a
+temporary file and renamed over the old one, a crashed write never destroys
+the last good snapshot. The crc32 over everything after the header is checked
+before a snapshot is used.
+
+Layout of the file:
+
+    header  - magic, crc32, metadata-length, entries
+    meta    - the serialized metadata
+    index   - <entries> times: key-offset, key-length, data-offset, data-length
+    data    - keys and data
+
+All offsets are absolute, the file can be used through an mmap as is.
+'''
+import mmap
+import os
+import struct
+import zlib
+
+MAGIC = 'FSCSNAP1'
+HEADER = struct.Struct('<8sIIQ')
+ENTRY = struct.Struct('<QIQI')
+
+
+def write_snapshot(path, meta, items):
+    '''
+    Writes the metadata-blob and the (key, data) items to a snapshot
+    '''
+    items = list(items)
+    tmp_path = '{0}.{1}'.format(path, os.getpid())
+    index_off = HEADER.size + len(meta)
+    data_off = index_off + len(items) * ENTRY.size
+
+    index = []
+    offset = data_off
+    for key, data in items:
+        index.append(ENTRY.pack(offset, len(key), offset + len(key), len(data)))
+        offset += len(key) + len(data)
+
+    crc = zlib.crc32(meta)
+    for entry in index:
+        crc = zlib.crc32(entry, crc)
+    for key, data in items:
+        crc = zlib.crc32(data, zlib.crc32(key, crc))
+
+    with open(tmp_path, 'wb') as fhandle:
+        fhandle.write(HEADER.pack(MAGIC, crc & 0xffffffff, len(meta), len(items)))
+        fhandle.write(meta)
+        fhandle.write(''.join(index))
+        for key, data in items:
+            fhandle.write(key)
+            fhandle.write(data)
+        fhandle.flush()
+        os.fsync(fhandle.fileno())
+    os.rename(tmp_path, path)
+
+
+def read_snapshot(path):
+    '''
+    Returns the metadata-blob and the (key, data) items of a snapshot, or
+    None if there is none or it is damaged
+    '''
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        size = os.fstat(fd).st_size
+        if size < HEADER.size:
+            return None
+        mm = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+    try:
+        magic, crc, meta_len, entries = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC:
+            print "FSSNAP:  {0} is not a snapshot".format(path)
+            return None
+        if zlib.crc32(buffer(mm, HEADER.size)) & 0xffffffff != crc:
+            print "FSSNAP:  {0} is damaged, ignoring it".format(path)
+            return None
+        meta = mm[HEADER.size:HEADER.size + meta_len]
+        items = []
+        pos = HEADER.size + meta_len
+        for _ in xrange(entries):
+            key_off, key_len, data_off, data_len = ENTRY.unpack_from(mm, pos)
+            items.append((mm[key_off:key_off + key_len],
+                          mm[data_off:data_off + data_len]))
+            pos += ENTRY.size
+        return meta, items
+    finally:
+        mm.close()
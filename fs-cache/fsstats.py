@@ -0,0 +1,104 @@
+'''
+Helpers to measure the FSCache and its clients.
+'''
+import math
+import re
+import resource
+
+
+def rss():
+    '''
+    Returns the resident memory of the calling process in bytes, the peak
+    if the current one is not available
+    '''
+    try:
+        with open('/proc/self/statm') as fhandle:
+            return int(fhandle.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError):
+        # linux reports kilobytes
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Histogram(object):
+    '''
+    A latency-histogram with logarithmic buckets. Bucket n counts the
+    values between 2**(n-1) and 2**n microseconds.
+    '''
+
+    def __init__(self, buckets=32):
+        self.counts = [0] * buckets
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds):
+        '''
+        Adds a measured duration in seconds
+        '''
+        usec = seconds * 1000000
+        if usec < 1:
+            bucket = 0
+        else:
+            bucket = min(int(math.log(usec, 2)) + 1, len(self.counts) - 1)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, pct):
+        '''
+        Returns the upper bound in seconds of the bucket holding the
+        given percentile, or 0 if nothing was measured
+        '''
+        if not self.count:
+            return 0
+        rank = self.count * pct / 100.0
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return 2 ** bucket / 1000000.0
+        return 2 ** (len(self.counts) - 1) / 1000000.0
+
+    def summary(self):
+        '''
+        Returns count, mean and the usual percentiles
+        '''
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else 0,
+                'p50': self.percentile(50),
+                'p99': self.percentile(99),
+                'p999': self.percentile(99.9)}
+
+
+def prometheus(stats, prefix='fscache', labels=None):
+    '''
+    Formats nested counters in the Prometheus text-format. The keys of
+    nested dicts are appended to the metric-name, except below the keys
+    in labels, whose children become values of the label named there.
+
+    prometheus({'jobs': {'grains': {'hits': 3}}}, labels={'jobs': 'job'})
+    gives 'fscache_jobs_hits{job="grains"} 3'
+    '''
+    labels = labels or {}
+    lines = []
+
+    def walk(node, name, tags, label):
+        for key, value in sorted(node.iteritems()):
+            key = str(key)
+            if label is not None:
+                sub_name = name
+                sub_tags = tags + [(label, key)]
+            else:
+                sub_name = '{0}_{1}'.format(name, re.sub(r'[^a-zA-Z0-9_]', '_', key))
+                sub_tags = tags
+            if isinstance(value, dict):
+                walk(value, sub_name, sub_tags, labels.get(key) if label is None else None)
+            elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+                if sub_tags:
+                    tag_str = ','.join('{0}="{1}"'.format(tag, val.replace('\\', '\\\\').replace('"', '\\"'))
+                                       for tag, val in sub_tags)
+                    lines.append('{0}{{{1}}} {2}'.format(sub_name, tag_str, value))
+                else:
+                    lines.append('{0} {1}'.format(sub_name, value))
+
+    walk(stats, prefix, [], None)
+    return '\n'.join(lines) + '\n'
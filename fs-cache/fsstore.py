@@ -0,0 +1,624 @@
+'''
+The storage of the FSCaches data.
+
+Every job owns the files found under its path. Their data is kept per job and
+counted against a per-job quota and the global byte-budget of the cache. If a
+budget is exceeded, files not used recently are evicted down to their
+metadata: the cache still knows the file, but its data has to be loaded
+from disk again once it is requested. The store never reads from disk
+itself, the FSCache has its workers do it.
+
+Files larger than the max entry-size are never admitted with their data,
+they are always loaded on demand.
+
+To keep the per-file overhead low, files are keyed by their path relative
+to the jobs root and their state is kept in flat arrays. Optionally
+their data is compressed with zlib or lz4 and packed into large shared buffers
+(a BlobArena) instead of being kept as one string-object per file. Both are
+undone when the data is read.
+'''
+import sys
+import threading
+import zlib
+from array import array
+
+try:
+    from lz4.block import compress as lz4_compress, decompress as lz4_decompress
+except ImportError:
+    lz4_compress = None
+
+# smaller files are not worth compressing
+MIN_COMPRESS = 64
+
+# the states of a JobStores slots: unused, a file without data in
+# memory, a file with its data and a file too large to be admitted
+FREE = 0
+META = 1
+DATA = 2
+LARGE = 3
+
+
+def make_codec(name, level=1):
+    '''
+    Returns the (compress, decompress) functions of a codec or None
+    '''
+    if not name:
+        return None
+    if name == 'lz4':
+        if lz4_compress is not None:
+            return lz4_compress, lz4_decompress
+        print "FSSTORE:  lz4 is not installed, using zlib"
+    elif name != 'zlib':
+        raise ValueError('unknown codec {0}'.format(name))
+    return (lambda data: zlib.compress(data, level)), zlib.decompress
+
+
+class BlobArena(object):
+    '''
+    Packs blobs into segments of seg_bytes. Blobs are appended to the active
+    segment, freed space is reclaimed by moving the live blobs of a segment
+    that is less than half used to the active one. Blobs larger than a
+    segment get a segment of their own.
+
+    The blobs are numbered by the slots of their JobStore. Their segment,
+    offset and size are kept in flat arrays indexed by slot, a blob costs
+    no python-object of its own.
+    '''
+
+    def __init__(self, seg_bytes=4 * 1024 * 1024):
+        self.seg_bytes = seg_bytes
+        self.segs = []
+        # the bytes appended to and still used in each segment, and
+        # the slots appended to it, some of which may be gone already
+        self.used = array('I')
+        self.live_bytes = array('I')
+        self.seg_slots = []
+        self.unused = []
+        self.active = None
+        # the segment (-1 for none), offset and size of every slot
+        self.seg = array('i')
+        self.off = array('I')
+        self.size = array('I')
+
+    def new_seg(self, size):
+        '''
+        Allocates a segment and returns its number
+        '''
+        if self.unused:
+            seg = self.unused.pop()
+            self.segs[seg] = bytearray(size)
+            self.used[seg] = 0
+            self.live_bytes[seg] = 0
+            self.seg_slots[seg] = array('I')
+            return seg
+        self.segs.append(bytearray(size))
+        self.used.append(0)
+        self.live_bytes.append(0)
+        self.seg_slots.append(array('I'))
+        return len(self.segs) - 1
+
+    def alloc(self, slot, blob):
+        '''
+        Stores the blob of a slot
+        '''
+        while len(self.seg) <= slot:
+            self.seg.append(-1)
+            self.off.append(0)
+            self.size.append(0)
+        size = len(blob)
+        seg = self.active
+        if size > self.seg_bytes:
+            seg = self.new_seg(size)
+        elif seg is None or self.used[seg] + size > self.seg_bytes:
+            seg = self.active = self.new_seg(self.seg_bytes)
+        off = self.used[seg]
+        self.segs[seg][off:off + size] = blob
+        self.used[seg] += size
+        self.live_bytes[seg] += size
+        self.seg_slots[seg].append(slot)
+        self.seg[slot] = seg
+        self.off[slot] = off
+        self.size[slot] = size
+
+    def get(self, slot):
+        '''
+        Returns a buffer pointing at the blob of a slot, only valid until
+        the next alloc() or free()
+        '''
+        off = self.off[slot]
+        return buffer(self.segs[self.seg[slot]], off, self.size[slot])
+
+    def free(self, slot):
+        '''
+        Frees the blob of a slot, the segment is compacted if it
+        is less than half used afterwards
+        '''
+        seg = self.seg[slot]
+        self.seg[slot] = -1
+        self.live_bytes[seg] -= self.size[slot]
+        if seg == self.active or self.live_bytes[seg] * 2 >= self.used[seg]:
+            return
+        old = self.segs[seg]
+        for m_slot in self.seg_slots[seg]:
+            # slots freed or moved meanwhile point elsewhere
+            if self.seg[m_slot] == seg:
+                off = self.off[m_slot]
+                self.alloc(m_slot, old[off:off + self.size[m_slot]])
+        self.segs[seg] = None
+        self.seg_slots[seg] = None
+        self.live_bytes[seg] = 0
+        self.used[seg] = 0
+        self.unused.append(seg)
+
+    def nbytes(self):
+        '''
+        Returns the bytes allocated by the segments
+        '''
+        return sum(len(seg) for seg in self.segs if seg is not None)
+
+    def memory(self):
+        '''
+        Returns the bytes used by the segments and the bookkeeping
+        '''
+        return (self.nbytes() +
+                sum(sys.getsizeof(slots) for slots in self.seg_slots if slots is not None) +
+                sys.getsizeof(self.seg) + sys.getsizeof(self.off) + sys.getsizeof(self.size))
+
+
+class JobStore(object):
+    '''
+    The files of a single job. Evicted files stay known without their data.
+
+    The files are keyed by their path relative to the root and each gets a
+    slot, their state is kept in flat columns indexed by the slot instead of
+    a python-object per file. The data is kept as a string in the data-column,
+    compressed if it got smaller, or packed into the arena. The raw-column
+    holds the size before compression.
+
+    Files are evicted in approximate LRU-order by the CLOCK-algorithm: a read
+    sets the reference-bit of a file, the eviction-hand clears it and skips
+    the file once before evicting it.
+    '''
+
+    def __init__(self, name, root, max_bytes=0, codec=None, arena_bytes=0):
+        self.name = name
+        self.root = root
+        self.max_bytes = max_bytes
+        self.codec = codec
+        self.arena = BlobArena(arena_bytes) if arena_bytes else None
+        # {key: slot} and the columns per slot
+        self.slots = {}
+        self.keys = []
+        self.data = []
+        self.raw = array('I')
+        self.state = array('B')
+        self.ref = array('B')
+        self.free_slots = []
+        self.hand = 0
+        # the bytes as stored and before compression
+        self.bytes = 0
+        self.raw_bytes = 0
+        self.key_bytes = 0
+        # the sizes of the python-objects of the keys, slots and data
+        self.obj_bytes = 0
+        self.stats = {'hits': 0,
+                      'misses': 0,
+                      'loads': 0,
+                      'evictions': 0,
+                      'rejected': 0}
+
+    def __len__(self):
+        return len(self.slots)
+
+    def key(self, path):
+        '''
+        Returns the key of a path
+        '''
+        return path[len(self.root):]
+
+    def path(self, key):
+        '''
+        Returns the path of a key
+        '''
+        return self.root + key
+
+    def over_quota(self):
+        '''
+        Checks wether the job uses more than its quota
+        '''
+        return self.max_bytes and self.bytes > self.max_bytes
+
+    def new_slot(self, key):
+        '''
+        Assigns a free slot to a new key
+        '''
+        if self.free_slots:
+            slot = self.free_slots.pop()
+            self.keys[slot] = key
+        else:
+            slot = len(self.keys)
+            self.keys.append(key)
+            self.data.append(None)
+            self.raw.append(0)
+            self.state.append(FREE)
+            self.ref.append(0)
+        self.slots[key] = slot
+        self.key_bytes += len(key)
+        self.obj_bytes += sys.getsizeof(key) + sys.getsizeof(slot)
+        return slot
+
+    def stored(self, slot):
+        '''
+        Returns the stored size of the data of a slot
+        '''
+        if self.arena is not None:
+            return self.arena.size[slot]
+        return len(self.data[slot])
+
+    def pack(self, slot, fdata):
+        '''
+        Stores the data of a file in its slot
+        '''
+        blob = fdata
+        if self.codec is not None and len(fdata) >= MIN_COMPRESS:
+            packed = self.codec[0](fdata)
+            if len(packed) < len(fdata):
+                blob = packed
+        if self.arena is not None:
+            self.arena.alloc(slot, blob)
+        else:
+            self.data[slot] = blob
+            self.obj_bytes += sys.getsizeof(blob)
+        self.raw[slot] = len(fdata)
+        self.state[slot] = DATA
+        self.bytes += len(blob)
+        self.raw_bytes += len(fdata)
+
+    def unpack(self, slot):
+        '''
+        Returns the data of a file stored in a slot
+        '''
+        if self.arena is not None:
+            blob = self.arena.get(slot)
+        else:
+            blob = self.data[slot]
+        if len(blob) != self.raw[slot]:
+            return self.codec[1](blob)
+        return str(blob)
+
+    def drop(self, slot):
+        '''
+        Releases the data of a slot, returns its stored size
+        '''
+        size = self.stored(slot)
+        self.bytes -= size
+        self.raw_bytes -= self.raw[slot]
+        if self.arena is not None:
+            self.arena.free(slot)
+        else:
+            self.obj_bytes -= sys.getsizeof(self.data[slot])
+            self.data[slot] = None
+        self.state[slot] = META
+        return size
+
+    def put(self, path, fdata, large=False):
+        '''
+        Stores the data of a file as recently used, a file without data
+        is kept as evicted or, with large set, as too large to be admitted
+        '''
+        key = self.key(path)
+        slot = self.slots.get(key, None)
+        if slot is None:
+            slot = self.new_slot(key)
+        elif self.state[slot] == DATA:
+            self.drop(slot)
+        self.state[slot] = LARGE if large else META
+        self.ref[slot] = 1
+        if fdata is not None:
+            self.pack(slot, fdata)
+
+    def delete(self, path):
+        '''
+        Removes a file
+        '''
+        key = self.key(path)
+        slot = self.slots.pop(key, None)
+        if slot is None:
+            return
+        if self.state[slot] == DATA:
+            self.drop(slot)
+        self.key_bytes -= len(key)
+        self.obj_bytes -= sys.getsizeof(key) + sys.getsizeof(slot)
+        self.keys[slot] = None
+        self.state[slot] = FREE
+        self.ref[slot] = 0
+        self.free_slots.append(slot)
+
+    def get(self, path):
+        '''
+        Returns (state, data) of a file and marks it as recently used,
+        data is None unless the state is DATA
+        '''
+        slot = self.slots.get(self.key(path), None)
+        if slot is None:
+            return FREE, None
+        self.ref[slot] = 1
+        if self.state[slot] != DATA:
+            return self.state[slot], None
+        return DATA, self.unpack(slot)
+
+    def contains(self, path):
+        '''
+        Checks wether a file is known, with or without its data
+        '''
+        return self.key(path) in self.slots
+
+    def resident(self, path):
+        '''
+        Checks wether the data of a file is in memory
+        '''
+        slot = self.slots.get(self.key(path), None)
+        return slot is not None and self.state[slot] == DATA
+
+    def evict(self):
+        '''
+        Evicts the data of a file that was not used since the hand passed
+        it last and returns its path and size, or (None, 0) if there is
+        nothing left to evict
+        '''
+        count = len(self.keys)
+        state = self.state
+        ref = self.ref
+        # two rounds find a file even if all had their bit set
+        for _ in xrange(2 * count):
+            slot = self.hand
+            self.hand = (slot + 1) % count
+            if state[slot] != DATA:
+                continue
+            if ref[slot]:
+                ref[slot] = 0
+                continue
+            self.stats['evictions'] += 1
+            return self.path(self.keys[slot]), self.drop(slot)
+        return None, 0
+
+    def paths(self):
+        '''
+        Returns the paths of all files
+        '''
+        root = self.root
+        return [root + key for key in self.slots]
+
+    def items(self):
+        '''
+        Returns (path, data) of all files that have their data in memory
+        '''
+        root = self.root
+        state = self.state
+        return [(root + key, self.unpack(slot))
+                for key, slot in self.slots.iteritems()
+                if state[slot] == DATA]
+
+    def memory(self):
+        '''
+        Returns the bytes used by the python-objects of the job as
+        measured by sys.getsizeof()
+        '''
+        mem = (self.obj_bytes + sys.getsizeof(self.slots) + sys.getsizeof(self.keys) +
+               sys.getsizeof(self.data) + sys.getsizeof(self.raw) +
+               sys.getsizeof(self.state) + sys.getsizeof(self.ref) +
+               sys.getsizeof(self.free_slots))
+        if self.arena is not None:
+            mem += self.arena.memory()
+        return mem
+
+    def info(self):
+        '''
+        Returns the counters and sizes of the job. The memory per entry
+        counts all objects of the job, the raw bytes per entry the data
+        with full paths as keys.
+        '''
+        result = dict(self.stats)
+        files = len(self.slots)
+        result['files'] = files
+        result['bytes'] = self.bytes
+        result['raw_bytes'] = self.raw_bytes
+        result['mem_bytes'] = self.memory()
+        if self.arena is not None:
+            result['arena_bytes'] = self.arena.nbytes()
+        if files:
+            result['raw_bytes_per_entry'] = (self.raw_bytes + self.key_bytes +
+                                             files * len(self.root)) / files
+            result['mem_bytes_per_entry'] = result['mem_bytes'] / files
+        return result
+
+
+class CacheStore(object):
+    '''
+    Keeps the data of all jobs within a global byte-budget. A max_bytes
+    of 0 means unlimited.
+
+    codec is None, 'zlib' or 'lz4', arena_bytes the segment-size of
+    the jobs BlobArenas, 0 to not use them.
+    '''
+
+    def __init__(self, max_bytes=0, max_entry_bytes=0, codec=None, level=1,
+                 arena_bytes=0):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.codec = make_codec(codec, level)
+        self.arena_bytes = arena_bytes
+        self.jobs = {}
+        self.bytes = 0
+        # reader-threads and the main loop share the store and
+        # the JobStores are not safe to be used concurrently
+        self.lock = threading.RLock()
+
+    def add_job(self, name, root, max_bytes=0):
+        '''
+        Registers a job and the directory it owns
+        '''
+        self.jobs[name] = JobStore(name, root, max_bytes, self.codec,
+                                   self.arena_bytes)
+
+    def job_of(self, path):
+        '''
+        Returns the JobStore owning a path, the one with the longest root
+        '''
+        owner = None
+        for job in self.jobs.itervalues():
+            if path.startswith(job.root):
+                if owner is None or len(job.root) > len(owner.root):
+                    owner = job
+        return owner
+
+    def __len__(self):
+        return sum(len(job) for job in self.jobs.itervalues())
+
+    def put(self, name, path, fdata):
+        '''
+        Stores the data of a file and returns the paths that were evicted
+        to make room for it, including the path itself if it was not admitted
+        '''
+        job = self.jobs[name]
+        with self.lock:
+            before = job.bytes
+            if self.max_entry_bytes and len(fdata) > self.max_entry_bytes:
+                job.put(path, None, large=True)
+                self.bytes += job.bytes - before
+                job.stats['rejected'] += 1
+                return [path]
+            job.put(path, fdata)
+            self.bytes += job.bytes - before
+            return self.enforce(job)
+
+    def delete(self, name, path):
+        '''
+        Removes a file from the store
+        '''
+        job = self.jobs[name]
+        with self.lock:
+            before = job.bytes
+            job.delete(path)
+            self.bytes += job.bytes - before
+
+    def enforce(self, job):
+        '''
+        Evicts files until the job is within its quota and the
+        store within its budget
+        '''
+        evicted = []
+        while job.over_quota():
+            path, size = job.evict()
+            if path is None:
+                break
+            self.bytes -= size
+            evicted.append(path)
+        while self.max_bytes and self.bytes > self.max_bytes:
+            # take from the job using the most memory
+            victim = max(self.jobs.itervalues(), key=lambda jstore: jstore.bytes)
+            path, size = victim.evict()
+            if path is None:
+                break
+            self.bytes -= size
+            evicted.append(path)
+        return evicted
+
+    def get(self, path, cold=None):
+        '''
+        Returns the data of a file or None if it is not in memory. Evicted
+        files of the metadata-tier are added to the optional list cold,
+        the caller has them loaded again.
+        '''
+        job = self.job_of(path)
+        if job is None:
+            return None
+        with self.lock:
+            state, fdata = job.get(path)
+            if state == DATA:
+                job.stats['hits'] += 1
+                return fdata
+            if state == META and cold is not None:
+                job.stats['loads'] += 1
+                cold.append(path)
+            else:
+                job.stats['misses'] += 1
+            return None
+
+    def contains(self, path):
+        '''
+        Checks wether the store knows a file, with or without its data
+        '''
+        job = self.job_of(path)
+        return job is not None and job.contains(path)
+
+    def resident(self, path):
+        '''
+        Checks wether the data of a file is in memory
+        '''
+        job = self.job_of(path)
+        if job is None:
+            return False
+        with self.lock:
+            return job.resident(path)
+
+    def paths(self):
+        '''
+        Returns the paths of all files, including the metadata-tier
+        '''
+        with self.lock:
+            return [path for job in self.jobs.itervalues() for path in job.paths()]
+
+    def items(self):
+        '''
+        Returns (path, data) of all files that have their data in memory
+        '''
+        with self.lock:
+            return [item for job in self.jobs.itervalues() for item in job.items()]
+
+    def stats(self):
+        '''
+        Returns the counters and sizes of all jobs
+        '''
+        with self.lock:
+            result = {}
+            for name, job in self.jobs.iteritems():
+                result[name] = job.info()
+            return result
+
+
+class SingleFlight(object):
+    '''
+    Makes concurrent threads that want the same key wait for the first one
+    to do the work instead of doing it again themselves
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def do(self, key, func, *args):
+        '''
+        Runs func(*args) unless another thread already runs it for the key,
+        in which case we wait for that one to finish. Returns wether we did
+        the work ourself and the result of func, which the waiting threads
+        get as well.
+        '''
+        with self.lock:
+            flight = self.flights.get(key, None)
+            if flight is None:
+                # the event and the result, filled in once func returned
+                flight = self.flights[key] = [threading.Event(), None]
+                leader = True
+            else:
+                leader = False
+        if not leader:
+            flight[0].wait()
+            return False, flight[1]
+        try:
+            flight[1] = func(*args)
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight[0].set()
+        return True, flight[1]
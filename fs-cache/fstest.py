@@ -1,16 +1,45 @@
 #!/usr/bin/python
 '''
-Classes for salts filesystem cache for larger installations.
+A benchmark for salts filesystem cache.
+
+The benchmark generates a minion-cache tree of <minions>/data.p files with
+sizes drawn from a distribution, starts an FSCache on it and measures the
+latency and throughput of requests for those files. Each client is a process
+of its own, threads would cap the clients at one core.
+
+Every combination of target, load-mode and number of clients is run once,
+the cache-target once for every number of FSCache-shards:
+
+    targets - 'cache' asks the FSCache, 'disk' reads the files directly
+    closed  - every client keeps a window of requests in flight and sends
+              the next one once a reply arrived
+    open    - the clients send at a fixed total rate with poisson arrivals,
+              no matter how fast the replies come. The latency counts from
+              the time a request was due, a stalled cache does not make the
+              clients wait politely.
+
+The results are written as JSON for regression-tracking, a summary of
+every step is printed to stderr. With several numbers of shards every
+cache-result has the scaling of its throughput per shard against the
+smallest number of shards.
 '''
-import salt.utils
+import salt.payload
 import salt.config
-import time
+import array
+import json
+import math
+import multiprocessing
+import os
 import random
-from random import shuffle
+import shutil
+import signal
+import socket
 import sys
+import tempfile
+import time
 import zmq
-from __init__ import FSCache
-from fsworker import Statwalker
+from __init__ import start_cache
+from fsworker import ipc_addr, shard_of
 import argparse
 
 
@@ -22,273 +51,747 @@ class Argparser(object):
 
     def add_args(self):
 
+        self.main_parser.add_argument('-m',
+                                      type=str,
+                                      default='/etc/salt/master',
+                                      dest='master',
+                                      required=False,
+                                      help='the master-config with the fsc_-settings of the cache')
+
+        self.main_parser.add_argument('-n',
+                                      type=int,
+                                      default=1000,
+                                      dest='minions',
+                                      required=False,
+                                      help='the number of minions to generate')
+
+        self.main_parser.add_argument('-z',
+                                      type=str,
+                                      default='lognorm:8192,1.0',
+                                      dest='sizes',
+                                      required=False,
+                                      help='the sizes of the data.p files: <bytes>, <min>-<max> '
+                                           'or lognorm:<median>,<sigma>')
+
         self.main_parser.add_argument('-f',
                                       type=str,
-                                      default='',
-                                      dest='pathfile',
-                                      required=True,
-                                      help='the file from which to load paths')
+                                      default=None,
+                                      dest='tree',
+                                      required=False,
+                                      help='an existing minion-cache tree to use instead of '
+                                           'generating one')
 
-        self.main_parser.add_argument('-r',
+        self.main_parser.add_argument('-t',
+                                      type=str,
+                                      default='cache,disk',
+                                      dest='targets',
+                                      required=False,
+                                      help='comma-separated targets: cache and disk')
+
+        self.main_parser.add_argument('-l',
+                                      type=str,
+                                      default='closed,open',
+                                      dest='modes',
+                                      required=False,
+                                      help='comma-separated load-modes: closed and open')
+
+        self.main_parser.add_argument('-c',
+                                      type=str,
+                                      default='1,8,32',
+                                      dest='clients',
+                                      required=False,
+                                      help='comma-separated numbers of client-processes')
+
+        self.main_parser.add_argument('-w',
                                       type=int,
                                       default=1,
-                                      dest='runs',
+                                      dest='window',
                                       required=False,
-                                      help='the number of runs to execute')
+                                      help='the requests each client keeps in flight in closed mode')
 
-        self.main_parser.add_argument('-t',
+        self.main_parser.add_argument('-r',
+                                      type=int,
+                                      default=10000,
+                                      dest='rate',
+                                      required=False,
+                                      help='the total requests per second of all clients in open mode')
+
+        self.main_parser.add_argument('-d',
+                                      type=int,
+                                      default=10,
+                                      dest='duration',
+                                      required=False,
+                                      help='the seconds to run each step')
+
+        self.main_parser.add_argument('-s',
                                       type=str,
-                                      default='cache',
-                                      dest='type',
+                                      default='1',
+                                      dest='shards',
                                       required=False,
-                                      help='wether to run the tests on cache or filesystem')
+                                      help='comma-separated numbers of FSCache-shards to start')
+
+        self.main_parser.add_argument('-o',
+                                      type=str,
+                                      default=None,
+                                      dest='output',
+                                      required=False,
+                                      help='the file to write the JSON-results to, stdout by default')
+
+        self.main_parser.add_argument('--seed',
+                                      type=int,
+                                      default=0,
+                                      dest='seed',
+                                      required=False,
+                                      help='the seed of the tree-generator and the clients')
+
+        self.main_parser.add_argument('--check',
+                                      action='store_true',
+                                      default=False,
+                                      dest='check',
+                                      required=False,
+                                      help='check the cache against misbehaving peers and tight '
+                                           'limits instead of benchmarking it')
 
     def parse_args(self):
         return self.main_parser.parse_args()
 
 
-class FSCacheTest(object):
+def size_sampler(spec):
     '''
-    run different tests for the FSCache
+    Returns a function drawing a file-size from a random.Random, see
+    the -z option for the possible specs
     '''
+    if spec.startswith('lognorm:'):
+        median, sigma = [float(val) for val in spec[len('lognorm:'):].split(',')]
+        return lambda rand: int(rand.lognormvariate(math.log(median), sigma))
+    if '-' in spec:
+        low, high = [int(val) for val in spec.split('-')]
+        return lambda rand: rand.randint(low, high)
+    size = int(spec)
+    return lambda rand: size
 
-    def __init__(self, opts, runs=1, type='cache'):
-        self.opts = opts
-        self.runs = runs
-        self.serial = salt.payload.Serial("msgpack")
-        self.type = type
 
-        # the cache timeout in ms * 5 is the max time we allow
-        # the cache to take to reply to the request
-        self.cache_timeout = 50
+def make_tree(root, minions, sizes, seed=0):
+    '''
+    Writes a minion-cache tree with a <root>/<id>/data.p of about the drawn
+    size for every minion and returns the paths of the files
+    '''
+    serial = salt.payload.Serial('msgpack')
+    rand = random.Random(seed)
+    sample = size_sampler(sizes)
+    paths = []
+    for num in xrange(minions):
+        minion = 'minion{0:06d}'.format(num)
+        grains = {'id': minion,
+                  'ipv4': ['127.0.0.1', '10.{0}.{1}.{2}'.format(num >> 16 & 255,
+                                                                 num >> 8 & 255,
+                                                                 num & 255)],
+                  'pad': ''}
+        # pad the grains to the drawn size, the other fields add a few bytes
+        grains['pad'] = 'x' * max(0, sample(rand) - len(serial.dumps({'grains': grains})))
+        os.mkdir(os.path.join(root, minion))
+        path = os.path.join(root, minion, 'data.p')
+        with open(path, 'wb') as fhandle:
+            fhandle.write(serial.dumps({'grains': grains}))
+        paths.append(path)
+    return paths
+
+
+def find_tree(root):
+    '''
+    Returns the paths of the data.p files of an existing minion-cache tree
+    '''
+    paths = []
+    for minion in sorted(os.listdir(root)):
+        path = os.path.join(root, minion, 'data.p')
+        if os.path.isfile(path):
+            paths.append(path)
+    return paths
 
-        self.dirs = [
-                        '/var/cache/salt/master/jobs/',
-                        '/var/cache/salt/master/minions/'
-                    ]
 
-        # the number of random files to load
-        self.rand_files = 3000
-        self.files = []
-        self.filelist = 'filelist'
-        self.setup()
-
-        self.stats = {
-                       'req_total' : 0,
-                       'hits': 0,
-                       'misses': 0,
-                       'bytes': 0,
-                       'avg_100': 0,
-                       'avg_1000': 0,
-                       'runs': 0
-                     }
-
-    def setup(self):
-        self.context = zmq.Context()
-        self.cache_cli = self.context.socket(zmq.REQ)
-        self.cache_cli.connect('ipc:///tmp/fsc_cache')
-
-        self.poll = zmq.Poller()
-        self.poll.register(self.cache_cli, zmq.POLLIN)
-
-    def do_cache_req(self, path):
-
-        # add random id to cache-request to have a 1:1 relation
-        msgid = random.randint(10000, 20000)
-        msg = [msgid, path]
-        self.stats['req_total'] += 1
+def percentiles(samples):
+    '''
+    Returns the mean, max and the usual percentiles of latencies in seconds
+    '''
+    if not samples:
+        return {'mean': 0, 'max': 0, 'p50': 0, 'p99': 0, 'p999': 0}
+    samples = sorted(samples)
+    count = len(samples)
 
-        try:
-            # send a request to the FSCache. If we get to here after
-            # the cache was too slow before, the send() will fail but we try
-            # anyway going by EAFP rules.
-#            print "MAIN:  Query: {0}".format(msg)
-            self.cache_cli.send(self.serial.dumps(msg))
-        except zmq.error.ZMQError:
-            # on failure we do a dummy recv()and resend the last msg. That
-            # keeps us from having to re-init the socket on failure.
-            self.cache_cli.recv()
-            print "MAIN:  Resend: {0}:{1}".format(msgid, msg)
-            self.cache_cli.send(self.serial.dumps(msg))
-
-        to_max = self.cache_timeout*5
-        to_count = 0
+    def rank(pct):
+        return samples[min(count - 1, int(math.ceil(pct / 100.0 * count)) - 1)]
 
-        while 1:
-            # we wait cache_timout*5
-            self.socks = dict(self.poll.poll(self.cache_timeout))
-            if self.socks.get(self.cache_cli) == zmq.POLLIN:
-                reply = self.serial.loads(self.cache_cli.recv())
+    return {'mean': sum(samples) / count,
+            'max': samples[-1],
+            'p50': rank(50),
+            'p99': rank(99),
+            'p999': rank(99.9)}
 
-                # no reply is broken, we brake the loop
-                if not reply:
-                    break
 
-                # we expect to receive only lists with an id
-                # and the data for the requested file
-                if isinstance(msg, list):
-                    # first field must be our matching request-id
-                    if msgid == reply[0]:
-                        if reply[1] is not None:
-#                            print "MAIN:  Reply: {0}:{1} bytes".format(reply[0], len(reply[1]))
-                            self.stats['hits'] += 1
-                            self.stats['bytes'] += sys.getsizeof(reply[1])
-                        else:
-#                            print "MAIN:  Reply: {0}:miss".format(reply[0])
-                            self.stats['misses'] += 1
-                        #print ""
-                        # received reply for request, enable the
-                        # break the loop to make way for next request
-                        break
-                # None is a cache miss, we have to go to disk
-                elif msg is None:
-                    print "MAIN:  cache miss..."
-                # we should never get here
-                else:
-                    print "MAIN:  deformed packet {0}".format(reply)
-                    raise zmq.error.ZMQError, "invalid state in FSCache-communication"
-            # we wait a maximum time of cache_timeout*5, which means 100ms
-            #to_count += cache_timeout
-            to_count += 1
-            if to_count == to_max:
-                to_count = 0
-                print "MAIN:  cache was too slow, breaking\n"
-                break
+class LoadClient(multiprocessing.Process):
+    '''
+    A client-process sending requests for random files to a target for a
+    given duration. The counters and the latency of every request are put
+    into the result-queue once it is done.
+    '''
 
-    def do_fs_req(self, path):
+    def __init__(self, opts, target, mode, files, window, rate, duration,
+                 results, seed):
+        super(LoadClient, self).__init__()
+        self.daemon = True
+        self.opts = opts
+        self.target = target
+        self.mode = mode
+        self.files = files
+        self.window = window
+        # the requests per second of this client in open mode
+        self.rate = rate
+        self.duration = duration
+        self.results = results
+        self.seed = seed
+        self.serial = salt.payload.Serial('msgpack')
+
+        self.count = {'requests': 0,
+                      'late': 0,
+                      'misses': 0,
+                      'errors': 0,
+                      'bytes': 0}
+        self.latencies = array.array('d')
+
+    def pick(self):
+        '''
+        Returns the next file to ask for
+        '''
+        return self.files[self.rand.randint(0, len(self.files) - 1)]
+
+    def record(self, seconds, fdata, late=False):
         '''
-        open a single file from disk and read its data
+        Counts a finished request. Requests finished after the end of the
+        run count as late instead, the throughput is that of the duration
+        only. Their latency is kept, it is the worst of all.
+        '''
+        self.count['late' if late else 'requests'] += 1
+        self.latencies.append(seconds)
+        if fdata is None:
+            self.count['misses'] += 1
+        else:
+            self.count['bytes'] += len(fdata)
+
+    def read_file(self, path):
+        '''
+        Reads a file the way a master without the cache does
         '''
         try:
-            fhandle = open(path, 'rb')
-            data = fhandle.read()
-            #print data
-            self.stats['hits'] += 1
-            self.stats['bytes'] += sys.getsizeof(data)
-            fhandle.close()
+            with open(path, 'rb') as fhandle:
+                return fhandle.read()
         except IOError:
-            self.stats['misses'] += 1
-            return
+            return None
 
-    def load_random(self):
+    def run_disk(self):
         '''
-        load filenames randomly from a filelist
+        Reads files one after the other, in open mode each read starts
+        when it is due or as soon as the previous one finished
         '''
-        fhandle = open('./filelist', 'r')
+        t_stop = time.time() + self.duration
+        due = time.time()
+        while 1:
+            if self.mode == 'open':
+                due += self.rand.expovariate(self.rate)
+                wait = due - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                t_start = due
+            else:
+                t_start = time.time()
+            if t_start >= t_stop:
+                break
+            fdata = self.read_file(self.pick())
+            t_done = time.time()
+            self.record(t_done - t_start, fdata, t_done >= t_stop)
 
-        while not len(self.files) >= self.rand_files:
-            for file_n in fhandle.readlines():
-                rint = random.randint(1, 1000)
-                if rint % 10 == 0:
-                    self.files.append(file_n.strip())
-                if len(self.files) >= self.rand_files:
+    def run_cache(self):
+        '''
+        Sends pipelined requests to the shards of the FSCache owning the
+        files. Requests without a reply within a second of the end are
+        counted as errors, those with a reply in that second as late.
+        '''
+        shards = self.opts.get('fsc_shards', 1)
+        context = zmq.Context()
+        poller = zmq.Poller()
+        socks = []
+        for shard in range(shards):
+            # a DEALER with an empty delimiter-frame talks like a REQ
+            # socket, but is not limited to one outstanding request
+            sock = context.socket(zmq.DEALER)
+            sock.setsockopt(zmq.LINGER, 0)
+            sock.connect(ipc_addr(self.opts, 'cache', shard))
+            poller.register(sock, zmq.POLLIN)
+            socks.append(sock)
+
+        # {msgid: the time the request was due}
+        inflight = {}
+        msgids = [0]
+
+        def send(t_start):
+            path = self.pick()
+            msgids[0] += 1
+            inflight[msgids[0]] = t_start
+            socks[shard_of(path, shards)].send_multipart(['', self.serial.dumps([msgids[0], path])])
+
+        t_stop = time.time() + self.duration
+        due = time.time()
+        if self.mode == 'closed':
+            for _ in range(self.window):
+                send(time.time())
+        while 1:
+            now = time.time()
+            if self.mode == 'open':
+                while due <= now < t_stop:
+                    send(due)
+                    due += self.rand.expovariate(self.rate)
+                wait = min(due, t_stop) - now
+            else:
+                wait = t_stop - now
+            if now >= t_stop:
+                if not inflight:
                     break
-                else:
-                    fhandle.seek(0)
-        shuffle(self.files)
-        print "MAIN/{0}:  loaded {1} paths-strings".format(self.stats['runs'],
-                                                           len(self.files))
+                wait = t_stop + 1 - now
+                if wait <= 0:
+                    break
+            for sock, _ in poller.poll(max(0, wait) * 1000):
+                while 1:
+                    try:
+                        frames = sock.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    reply = self.serial.loads(frames[-1])
+                    t_start = inflight.pop(reply[0], None)
+                    if t_start is None:
+                        continue
+                    t_done = time.time()
+                    self.record(t_done - t_start, reply[1], t_done >= t_stop)
+                    if self.mode == 'closed' and t_done < t_stop:
+                        send(t_done)
+        self.count['errors'] += len(inflight)
+        for sock in socks:
+            sock.close()
+        context.term()
+
+    def run(self):
+        self.rand = random.Random(self.seed)
+        if self.target == 'cache':
+            self.run_cache()
+        else:
+            self.run_disk()
+        self.results.put((self.count, self.latencies.tostring()))
+
+
+class FSCacheBench(object):
+    '''
+    Generates the tree, starts the FSCache and runs the benchmark-steps
+    '''
+
+    def __init__(self, opts, args):
+        self.args = args
+        self.targets = args['targets'].split(',')
+        self.modes = args['modes'].split(',')
+        self.clients = [int(num) for num in args['clients'].split(',')]
+        self.shards = [int(num) for num in args['shards'].split(',')]
+        self.serial = salt.payload.Serial('msgpack')
+
+        # a cache of our own, off the sockets and files
+        # of a cache running on this host
+        self.opts = dict(opts)
+        for opt in ('fsc_snap_path', 'fsc_shm_path', 'fsc_metrics_path',
+                    'fsc_repl_bind', 'fsc_repl_primary'):
+            self.opts.pop(opt, None)
+        self.opts['fsc_shards'] = self.shards[0]
+        self.opts['fsc_ipc_dir'] = tempfile.mkdtemp(prefix='fsc_bench')
+
+        self.tmp_tree = None
+        self.tree_bytes = 0
+        self.caches = []
+        self.files = []
+        self.results = []
+
+    def log(self, msg):
+        print >> sys.stderr, "BENCH:  {0}".format(msg)
 
-    def do_random(self, num, cache=True):
+    def setup_tree(self):
+        '''
+        Generates the minion-cache tree or reads the given one
+        '''
+        if self.args['tree']:
+            self.root = os.path.abspath(self.args['tree'])
+            self.files = find_tree(self.root)
+        else:
+            self.tmp_tree = tempfile.mkdtemp(prefix='fsc_tree')
+            self.root = self.tmp_tree
+            t_start = time.time()
+            self.files = make_tree(self.root,
+                                   self.args['minions'],
+                                   self.args['sizes'],
+                                   self.args['seed'])
+            self.log("generated {0} minions in {1:.1f}s".format(len(self.files),
+                                                                time.time() - t_start))
+        if not self.files:
+            raise ValueError('no data.p files in {0}'.format(self.root))
+        self.tree_bytes = sum(os.path.getsize(path) for path in self.files)
+
+    def query(self, shard, query, timeout=1000):
+        '''
+        Sends a query to a shard and returns the reply, or None if
+        it did not answer within timeout milliseconds
+        '''
+        context = zmq.Context()
+        sock = context.socket(zmq.REQ)
+        sock.setsockopt(zmq.LINGER, 0)
+        try:
+            sock.connect(ipc_addr(self.opts, 'cache', shard))
+            sock.send(self.serial.dumps([shard, query]))
+            if not sock.poll(timeout):
+                return None
+            return self.serial.loads(sock.recv())[1]
+        finally:
+            sock.close()
+            context.term()
+
+    def cached_files(self):
+        '''
+        Returns the number of files cached by all shards, or None if
+        one of them did not answer
         '''
-        do cache requests with random paths
+        total = 0
+        for shard in range(self.opts['fsc_shards']):
+            stats = self.query(shard, {'op': 'stats'})
+            if stats is None:
+                return None
+            total += sum(job['files'] for job in stats['jobs'].itervalues())
+        return total
+
+    def start_cache(self, shards, timeout=120):
         '''
-        count = 0
+        Starts the FSCache with the given number of shards on the tree
+        and waits until it cached all files
+        '''
+        self.opts['fsc_shards'] = shards
+        # the job runs a few seconds from now and then once a minute
+        self.caches = start_cache(self.opts, [{'name': 'grains',
+                                               'path': self.root,
+                                               'ival': [int(time.time() + 3) % 60],
+                                               'patt': r'^.*/data\.p$',
+                                               'incr': True}])
         t_start = time.time()
-        for file_n in self.files[:num]:
-            if not cache:
-                self.do_fs_req(file_n)
-            else:
-                self.do_cache_req(file_n)
-            count += 1
-
-        t_stop = time.time()
-        t_delta = t_stop - t_start
-
-        print "MAIN/{0}:  did {1} requests in: {2}".format(self.stats['runs'],
-                                                           count,
-                                                           t_delta)
-        return t_delta
-
-    def loop_reqs(self, cache=True):
-        timeframe = 30
-        t_start = int(time.time())
-
-        count = 0
-
-        while True:
-            for file_n in self.files:
-                if not cache:
-                    self.do_fs_req(file_n)
-                else:
-                    self.do_cache_req(file_n)
-                count += 1
-            t_stop = int(time.time())
-            if t_stop  >= t_start+timeframe:
-                break
-        print "MAIN/{0}:  did {1} requests in: {2}".format(self.stats['runs'],
-                                                           count,
-                                                           timeframe)
-
-        return count 
+        while time.time() - t_start < timeout:
+            time.sleep(1)
+            if self.cached_files() >= len(self.files):
+                self.log("cache of {0} shards warm after {1:.1f}s".format(self.opts['fsc_shards'],
+                                                                        time.time() - t_start))
+                return
+        raise RuntimeError('the cache did not load the tree within {0}s'.format(timeout))
+
+    def stop_cache(self):
+        for cache in self.caches:
+            os.kill(cache.pid, signal.SIGINT)
+        for cache in self.caches:
+            cache.join(30)
+            if cache.is_alive():
+                cache.terminate()
+        self.caches = []
+
+    def run_step(self, target, mode, clients):
+        '''
+        Runs the given number of clients against a target and
+        returns the merged result
+        '''
+        results = multiprocessing.Queue()
+        procs = [LoadClient(self.opts,
+                            target,
+                            mode,
+                            self.files,
+                            self.args['window'],
+                            float(self.args['rate']) / clients,
+                            self.args['duration'],
+                            results,
+                            self.args['seed'] + num)
+                 for num in range(clients)]
+        for proc in procs:
+            proc.start()
+        count = {'requests': 0, 'late': 0, 'misses': 0, 'errors': 0, 'bytes': 0}
+        latencies = array.array('d')
+        # the queue has to be emptied before the clients can exit
+        for _ in procs:
+            p_count, p_latencies = results.get()
+            for key in count:
+                count[key] += p_count[key]
+            latencies.fromstring(p_latencies)
+        for proc in procs:
+            proc.join()
+
+        result = {'target': target,
+                  'mode': mode,
+                  'shards': self.opts['fsc_shards'] if target == 'cache' else None,
+                  'clients': clients,
+                  'window': self.args['window'] if mode == 'closed' else None,
+                  'rate': self.args['rate'] if mode == 'open' else None,
+                  'duration': self.args['duration'],
+                  'throughput': count['requests'] / float(self.args['duration']),
+                  'latency': percentiles(latencies)}
+        result.update(count)
+        if target == 'cache':
+            target = '{0}({1} shards)'.format(target, self.opts['fsc_shards'])
+        self.log("{0}/{1} {2} clients: {3:.0f} req/s, p50 {4:.3f}ms, p99 {5:.3f}ms, "
+                 "p999 {6:.3f}ms, {7} misses, {8} errors, {9} late".format(target,
+                                                                           mode,
+                                                                           clients,
+                                                                           result['throughput'],
+                                                                           result['latency']['p50'] * 1000,
+                                                                           result['latency']['p99'] * 1000,
+                                                                           result['latency']['p999'] * 1000,
+                                                                           count['misses'],
+                                                                           count['errors'],
+                                                                           count['late']))
+        return result
+
+    def add_scaling(self):
+        '''
+        Adds the scaling of the shards to the cache-results, the throughput
+        per shard compared to that of the smallest number of shards with
+        the same mode and clients. 1.0 scales linearly.
+        '''
+        steps = {}
+        for result in self.results:
+            if result['target'] == 'cache':
+                steps.setdefault((result['mode'], result['clients']), []).append(result)
+        for (mode, clients), results in sorted(steps.iteritems()):
+            results.sort(key=lambda result: result['shards'])
+            base = results[0]['throughput'] / results[0]['shards']
+            for result in results:
+                result['scaling'] = result['throughput'] / result['shards'] / base if base else None
+            if len(results) > 1:
+                scaling = ', '.join('{0} shards {1:.2f}'.format(result['shards'], result['scaling'] or 0)
+                                    for result in results)
+                self.log("cache/{0} {1} clients scaling: {2}".format(mode, clients, scaling))
+
+    def report(self):
+        '''
+        Returns the configuration and results as JSON
+        '''
+        config = dict((key, value) for key, value in self.args.iteritems()
+                      if key not in ('master', 'output'))
+        config['files'] = len(self.files)
+        config['bytes'] = self.tree_bytes
+        return json.dumps({'time': time.time(),
+                           'host': os.uname()[1],
+                           'cpus': multiprocessing.cpu_count(),
+                           'config': config,
+                           'results': self.results}, indent=2, sort_keys=True)
 
-    def do_fs(self, num):
+    def run(self):
+        try:
+            self.setup_tree()
+            for target in self.targets:
+                # the disk does not care about the shards
+                for shards in self.shards if target == 'cache' else [None]:
+                    if shards is not None:
+                        self.start_cache(shards)
+                    for mode in self.modes:
+                        for clients in self.clients:
+                            self.results.append(self.run_step(target, mode, clients))
+                    self.stop_cache()
+        finally:
+            self.stop_cache()
+            shutil.rmtree(self.opts['fsc_ipc_dir'], ignore_errors=True)
+            if self.tmp_tree is not None:
+                shutil.rmtree(self.tmp_tree, ignore_errors=True)
+
+        self.add_scaling()
+        report = self.report()
+        if self.args['output']:
+            with open(self.args['output'], 'w') as fhandle:
+                fhandle.write(report + '\n')
+        else:
+            print report
+
+def free_port():
+    '''
+    Returns a tcp-port on localhost that is free along with the next one
+    '''
+    while 1:
+        socks = [socket.socket(), socket.socket()]
+        try:
+            socks[0].bind(('127.0.0.1', 0))
+            port = socks[0].getsockname()[1]
+            socks[1].bind(('127.0.0.1', port + 1))
+            return port
+        except socket.error:
+            continue
+        finally:
+            for sock in socks:
+                sock.close()
+
+
+class FSCacheCheck(FSCacheBench):
+    '''
+    Runs the FSCache against misbehaving peers and tight limits instead
+    of benchmarking it. Every check_* method raises an AssertionError if
+    the cache does not hold up.
+    '''
 
-        count = 0
+    def wait_alive(self, timeout=30):
+        '''
+        Waits until the first shard answers a stats-query
+        '''
         t_start = time.time()
-        for file_n in self.files[:num]:
-            count += 1
-
-        t_stop = time.time()
-        t_delta = t_stop - t_start
-
-        print "MAIN/{0}:  did {1} requests in: {2}".format(self.stats['runs'],
-                                                           count,
-                                                           t_delta)
-        return t_delta
-
-    def pstats(self):
-        print "Summary for {0} runs and test-type '{1}'".format(self.stats['runs'],
-                                                             self.type)
-        print "Requests: {0},  Hits: {1},  Misses: {2}".format(self.stats['req_total'],
-                                                               self.stats['hits'],
-                                                               self.stats['misses'])
-        if self.type == 'cached' or self.type == 'fs':
-            print "avg/100: {0},  avg/1000: {1},  bytes: {2}".format(self.stats['avg_100'] / self.stats['runs'],
-                                                                     self.stats['avg_1000'] / self.stats['runs'],
-                                                                     self.stats['bytes'])
-        elif self.type == 'timed':
-            print "timeframe: 30s  reqs: {0}/s bytes: {1}".format(self.stats['req_total'] / 30,
-                                                                  self.stats['bytes'])
-        print ""
+        while time.time() - t_start < timeout:
+            if self.query(0, {'op': 'stats'}) is not None:
+                return
+            time.sleep(0.5)
+        raise AssertionError('the cache did not come up within {0}s'.format(timeout))
+
+    def assert_alive(self):
+        '''
+        Asserts that the cache processes run and still answer queries,
+        returns the counters of the first shard
+        '''
+        for cache in self.caches:
+            assert cache.is_alive(), 'shard {0} died'.format(cache.shard)
+        stats = self.query(0, {'op': 'stats'}, timeout=5000)
+        assert stats is not None, 'the cache does not answer anymore'
+        return stats['counters']
+
+    def check_repl_primary(self):
+        '''
+        Sends garbage to the resync-port of a primary: single frames as a
+        REQ-peer sends them, undecodable frames and requests that are not
+        a resync-request. A well-formed request has to be answered after.
+        '''
+        port = free_port()
+        self.opts.update({'fsc_repl_bind': '127.0.0.1', 'fsc_repl_port': port})
+        self.start_cache(1)
+        context = zmq.Context()
+        sock = context.socket(zmq.DEALER)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.connect('tcp://127.0.0.1:{0}'.format(port + 1))
+        try:
+            sock.send('garbage')
+            sock.send_multipart(['', 'garbage'])
+            sock.send_multipart(['', self.serial.dumps({'op': 'resync'})])
+            sock.send_multipart(['', self.serial.dumps(['resync', 'grains'])])
+            sock.send_multipart(['', self.serial.dumps({'op': 'resync', 'job': 'grains'})])
+            assert sock.poll(5000), 'no state for a valid resync-request'
+            state = self.serial.loads(sock.recv_multipart()[-1])
+            assert len(state['upsert']) == len(self.files), 'incomplete state'
+        finally:
+            sock.close()
+            context.term()
+        counters = self.assert_alive()
+        assert counters['bad_repl_msgs'] == 4, counters
+
+    def check_repl_replica(self):
+        '''
+        Plays the primary of a replica and streams garbage, chunks without
+        an epoch or sequence and an invalid resync-state to it
+        '''
+        port = free_port()
+        self.opts.update({'fsc_repl_primary': '127.0.0.1', 'fsc_repl_port': port})
+        context = zmq.Context()
+        pub = context.socket(zmq.PUB)
+        pub.setsockopt(zmq.LINGER, 0)
+        pub.bind('tcp://127.0.0.1:{0}'.format(port))
+        server = context.socket(zmq.ROUTER)
+        server.setsockopt(zmq.LINGER, 0)
+        server.bind('tcp://127.0.0.1:{0}'.format(port + 1))
+        chunk = {'job': 'grains', 'gen': 1, 'seq': 0, 'last': True,
+                 'upsert': {}, 'sigs': {}, 'delete': []}
+        try:
+            self.caches = start_cache(self.opts, [{'name': 'grains',
+                                                   'path': self.root,
+                                                   'ival': 60,
+                                                   'patt': r'^.*/data\.p$'}])
+            self.wait_alive()
+            # the subscription has to reach us before we publish
+            time.sleep(1)
+            pub.send('grains\0')
+            pub.send_multipart(['grains\0', 'garbage'])
+            pub.send_multipart(['grains\0', self.serial.dumps(chunk)])
+            pub.send_multipart(['grains\0', self.serial.dumps(dict(chunk, epoch='x', rseq='1'))])
+            # the replica asks for the state when it starts, it gets garbage
+            assert server.poll(5000), 'the replica did not resync'
+            ident = server.recv_multipart()[0]
+            server.send_multipart([ident, 'garbage'])
+            server.send_multipart([ident, self.serial.dumps(dict(chunk, epoch='x'))])
+            time.sleep(1)
+            counters = self.assert_alive()
+            assert counters['bad_repl_msgs'] == 6, counters
+        finally:
+            pub.close()
+            server.close()
+            context.term()
+
+    def check_readers(self):
+        '''
+        Starts a cache with reader-threads, the requests they answer have
+        to be counted and the cache has to exit cleanly on SIGINT
+        '''
+        self.opts['fsc_readers'] = 2
+        self.start_cache(1)
+        counters = self.assert_alive()
+        assert counters['requests'] > 0, counters
+        cache = self.caches[0]
+        os.kill(cache.pid, signal.SIGINT)
+        cache.join(30)
+        assert not cache.is_alive(), 'the cache did not exit'
+        assert cache.exitcode == 0, 'the cache exited with {0}'.format(cache.exitcode)
+
+    def check_parked_pressure(self):
+        '''
+        Asks a cache of 2000 bytes for 30 files of 200 bytes at once, the
+        loads evicting each other must not cost the reply any file
+        '''
+        root = tempfile.mkdtemp(prefix='fsc_tree')
+        try:
+            paths = make_tree(root, 30, '200', self.args['seed'])
+            self.opts.update({'fsc_max_bytes': 2000, 'fsc_shards': 1})
+            self.caches = start_cache(self.opts, [{'name': 'grains',
+                                                   'path': root,
+                                                   'ival': 60,
+                                                   'patt': r'^.*/data\.p$'}])
+            self.wait_alive()
+            files = self.query(0, {'op': 'mget', 'paths': paths, 'load': True}, timeout=30000)
+            assert files is not None, 'no reply to the read-through request'
+            got = len([fdata for fdata in files.itervalues() if fdata is not None])
+            assert got == len(paths), 'got {0} of {1} files'.format(got, len(paths))
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
 
     def run(self):
-        for _ in range(self.runs):
-            self.load_random()
-
-            if self.type == 'cache':
-                self.stats['avg_100'] += self.do_random(100)
-                self.stats['avg_1000'] += self.do_random(1000)
-            elif self.type == 'fs':
-                self.stats['avg_100'] += self.do_random(100, cache=False)
-                self.stats['avg_1000'] += self.do_random(1000, cache=False)
-            elif self.type == 'timed':
-                self.loop_reqs()
-            else:
-                print "unknown test type"
-                sys.exit(1)
-            print "MAIN:  wait 3 seconds...\n"
-            self.stats['runs'] += 1
-            time.sleep(3)
-        self.pstats()
+        checks = sorted(name for name in dir(self) if name.startswith('check_'))
+        failed = 0
+        opts = dict(self.opts)
+        try:
+            self.setup_tree()
+            for name in checks:
+                self.opts = dict(opts)
+                try:
+                    getattr(self, name)()
+                    self.log("{0}: ok".format(name))
+                except AssertionError as err:
+                    failed += 1
+                    self.log("{0}: FAILED: {1}".format(name, err))
+                finally:
+                    self.stop_cache()
+        finally:
+            shutil.rmtree(self.opts['fsc_ipc_dir'], ignore_errors=True)
+            if self.tmp_tree is not None:
+                shutil.rmtree(self.tmp_tree, ignore_errors=True)
+        sys.exit(1 if failed else 0)
 
 if __name__ == '__main__':
 
-    opts = salt.config.master_config('/etc/salt/master')
     args = vars(Argparser().parse_args())
-
-    # let the things settle and the cache
-    # populate before we enter the loop
-    import trace
-    test = FSCacheTest(opts, args['runs'], args['type'])
-    test.run()
+    opts = salt.config.master_config(args['master'])
+    if args['check']:
+        FSCacheCheck(opts, args).run()
+    else:
+        FSCacheBench(opts, args).run()
@@ -0,0 +1,167 @@
+'''
+Helpers to keep the FSWorkers from competing with the requests the FSCache
+answers.
+
+The workers lower their own cpu- and io-priority, can be limited to a rate of
+bytes and files per second per job and pause between their read-batches while
+the FSCache sees the latency of its requests rise.
+'''
+import ctypes
+import ctypes.util
+import multiprocessing
+import os
+import platform
+import time
+
+IOPRIO_CLASS_RT = 1
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+
+IOPRIO_CLASSES = {'rt': IOPRIO_CLASS_RT,
+                  'be': IOPRIO_CLASS_BE,
+                  'idle': IOPRIO_CLASS_IDLE}
+
+# glibc has no wrapper for ioprio_set(), the syscall-numbers per architecture
+SYS_IOPRIO_SET = {'x86_64': 251,
+                  'i386': 289,
+                  'i686': 289,
+                  'aarch64': 30,
+                  'armv7l': 314,
+                  'ppc64le': 273}
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                        use_errno=True)
+    _libc.syscall
+except (OSError, AttributeError):
+    _libc = None
+
+
+def set_ioprio(ioclass='idle', level=7):
+    '''
+    Sets the io-scheduling class of the calling process, 'idle' only gets
+    the disk when no one else wants it, 'be' with a level from 0 (highest)
+    to 7 (lowest) shares it. Returns False if that is not supported here.
+    '''
+    nr = SYS_IOPRIO_SET.get(platform.machine(), None)
+    if _libc is None or nr is None:
+        return False
+    ioclass = IOPRIO_CLASSES[ioclass]
+    if ioclass == IOPRIO_CLASS_IDLE:
+        level = 0
+    prio = ioclass << IOPRIO_CLASS_SHIFT | level
+    if _libc.syscall(nr, IOPRIO_WHO_PROCESS, 0, prio) < 0:
+        err = ctypes.get_errno()
+        print "THROTTLE:  ioprio_set failed: {0}".format(os.strerror(err))
+        return False
+    return True
+
+
+class TokenBucket(object):
+    '''
+    Limits a rate to rate units per second with bursts of up to burst
+    units. A rate of 0 means unlimited.
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.last = time.time()
+
+    def take(self, amount):
+        '''
+        Takes amount units from the bucket and sleeps until they were
+        available, returns the seconds slept. Amounts larger than the burst
+        are allowed, the bucket then stays empty for a while.
+        '''
+        if not self.rate:
+            return 0
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0
+        wait = -self.tokens / self.rate
+        time.sleep(wait)
+        return wait
+
+
+class Backoff(object):
+    '''
+    A delay shared by a shard of the FSCache and the workers. The shard
+    records how long its requests took and adjusts the delay once a second:
+    it doubles while the mean latency is above the target and halves once
+    it is back below. The workers sleep for the delay between their
+    read-batches, see Backoffs.
+
+    The delay lives in shared memory, the Backoff has to be created before
+    the workers are forked.
+    '''
+
+    def __init__(self, target=0.01, max_delay=1.0):
+        self.target = target
+        self.max_delay = max_delay
+        # a single double, written only by the FSCache
+        self.delay = multiprocessing.Value('d', 0.0, lock=False)
+        self.total = 0.0
+        self.count = 0
+
+    def record(self, seconds):
+        '''
+        Records the latency of a request. The reader-threads race on the
+        counters, an update lost now and then does not matter here.
+        '''
+        self.total += seconds
+        self.count += 1
+
+    def adjust(self):
+        '''
+        Adjusts the delay to the latency of the requests recorded
+        since the last call
+        '''
+        if not self.target:
+            return
+        mean = self.total / self.count if self.count else 0
+        self.total = 0.0
+        self.count = 0
+        delay = self.delay.value
+        if mean > self.target:
+            delay = min(self.max_delay, max(delay * 2, 0.01))
+        elif delay > 0.01:
+            delay /= 2
+        else:
+            delay = 0.0
+        self.delay.value = delay
+
+    def pause(self):
+        '''
+        Sleeps for the current delay, returns the seconds slept
+        '''
+        delay = self.delay.value
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+class Backoffs(object):
+    '''
+    The Backoffs of all shards of the FSCache. The workers read the files
+    of every shard and pause for the longest delay of them, a single slow
+    shard is enough to hold them back.
+    '''
+
+    def __init__(self, backoffs):
+        self.backoffs = list(backoffs)
+
+    def pause(self):
+        '''
+        Sleeps for the longest current delay, returns the seconds slept
+        '''
+        delay = max(backoff.delay.value for backoff in self.backoffs)
+        if delay:
+            time.sleep(delay)
+        return delay
@@ -6,35 +6,129 @@ The StatWalker is instantiated by an FSWorker, iterates a given directory
 and yields all files found in it. No symlinks, sockets, etc are returned, only
 regular files.
 
-The FSWorker iterates over the results and filters them by filename. If
-a match is found, the file is opened and filename and data are saved in a dict.
-Once the directory is successfully traversed, all collected data is returned.
+The FSWorkers form a pool of long-lived processes that receive jobs from the
+FSCache. A worker iterates over the StatWalkers results and filters them by
+filename. If a match is found, the file is opened and filename and data are
+saved in a dict.
+
+In incremental mode the FSWorker receives the stat-manifest of the last run
+from the FSCache and only reads files whose stat-signature changed. Files
+found in the manifest but not in the directory anymore are reported as deleted.
+
+Results are streamed as versioned delta-chunks of limited size and file-count
+instead of one big dict, see FSWorker.send_chunk() for the format. The FSCache
+applies them as they arrive.
+
+The files to read are collected into batches by the FileReader, which reads
+them sorted by device and inode, roughly their order on disk.
+
+With fsc_shards set the cache is split into several FSCache-processes that
+each own the paths hashing to them, see shard_of(). The workers take jobs from
+all shards and send every shard the files it owns.
 '''
 import salt.utils
 import salt.payload
 import multiprocessing
 import os
 import stat
+import errno
+import ctypes
+import ctypes.util
 import zmq
-from re import match as rematch
 import time
 import sys
+import threading
+import Queue
+import zlib
+from fsthrottle import set_ioprio, TokenBucket
+from fsfilter import PathFilter
 
-# try importing psutil to set ionice-ness
+# os.scandir is part of python 3.5, the scandir-package has it for older ones
 try:
-    raise ImportError
-    import psutil 
+    from os import scandir
 except ImportError:
-    pass
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# python 2 has no os.posix_fadvise, the readahead-hints go through libc
+POSIX_FADV_WILLNEED = 3
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                        use_errno=True)
+    _fadvise = _libc.posix_fadvise
+    _fadvise.argtypes = [ctypes.c_int, ctypes.c_longlong,
+                         ctypes.c_longlong, ctypes.c_int]
+except (OSError, AttributeError):
+    _fadvise = None
+
+
+def ipc_addr(opts, name, shard=0):
+    '''
+    Returns the address of one of the FSCaches IPC-sockets. Several FSCaches
+    on the same host need a fsc_ipc_dir of their own. With fsc_shards set
+    every shard has sockets of its own.
+    '''
+    return 'ipc://{0}/fsc_{1}'.format(opts.get('fsc_ipc_dir', '/tmp'),
+                                      shard_name(opts, name, shard))
+
+
+def shard_name(opts, name, shard=0):
+    '''
+    Appends the shard to a socket- or file-name if the cache is sharded
+    '''
+    if opts.get('fsc_shards', 1) > 1:
+        return '{0}.{1}'.format(name, shard)
+    return name
+
+
+def shard_of(path, shards):
+    '''
+    Returns the FSCache-shard owning a path. The paths are spread over the
+    shards by the crc32 of the path, workers and clients agree on it.
+    '''
+    if shards <= 1:
+        return 0
+    return (zlib.crc32(path) & 0xffffffff) % shards
+
+
+def stat_sig(st):
+    '''
+    Returns the signature of a stat()-result that is used to detect changed
+    files between two runs: [mtime in nanoseconds, size, inode]. It is a list
+    to compare equal to the signatures received through the serializer.
+    '''
+    return [int(st.st_mtime * 1000000000), st.st_size, st.st_ino]
+
+
+def project(obj, spec):
+    '''
+    Extracts the fields of a projection from a decoded file. The spec maps
+    field-names to dotted paths into the object, for example
+    {'ipv4': 'grains.ipv4'}. Missing paths are left out of the result.
+    '''
+    result = {}
+    for field, dotted in spec.iteritems():
+        value = obj
+        for key in dotted.split('.'):
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            result[field] = value
+    return result
 
 
 class Statwalker(object):
     '''
     Iterator class that walks through a directory and
-    collects the stat()-data for every file it finds
+    collects the stat()-data for every file it finds. Subdirectories
+    the optional want_dir(path) rejects are not entered.
     '''
 
-    def __init__(self, directory):
+    def __init__(self, directory, want_dir=None):
+        self.want_dir = want_dir
         self.stack = [directory]
         self.files = []
         self.index = 0
@@ -61,39 +155,364 @@ class Statwalker(object):
                 mode = st[stat.ST_MODE]
                 # if a dir is found, stash it for iteration
                 if stat.S_ISDIR(mode) and not stat.S_ISLNK(mode):
-                    self.stack.append(fullname)
+                    if self.want_dir is None or self.want_dir(fullname):
+                        self.stack.append(fullname)
                 # we only want files to be returned, no smylinks, sockets, etc.
                 if stat.S_ISREG(mode):
                     return fullname, st
 
 
+class ParallelWalker(object):
+    '''
+    Walks a directory with a pool of threads, each listing a directory and
+    stat()ing its files while the others do the same for other directories.
+    With many outstanding syscalls fast disks and network filesystems are
+    used much better than by the Statwalker.
+
+    The d_type hints of os.scandir() tell directories from files without
+    a stat(). Files are only stat()ed when the optional match(path) callback
+    accepts them. Subdirectories the optional want_dir(path) rejects are not
+    listed.
+
+    Iterating yields (path, stat) for all regular files in no particular
+    order, reading them is left to the FileReader. Symlinks are not
+    followed. At most depth batches of results are queued for the consumer.
+    '''
+
+    def __init__(self, directory, threads=4, depth=1024, match=None,
+                 want_dir=None):
+        self.directory = directory
+        self.threads = threads
+        self.match = match
+        self.want_dir = want_dir
+        self.dirs = Queue.Queue()
+        self.results = Queue.Queue(maxsize=depth)
+        # the directories queued or being listed, the walk
+        # is done once it drops to zero
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.count = {'files': 0, 'dirs': 0, 'seconds': 0.0}
+
+    def list_dir(self, directory):
+        '''
+        Returns (name, is_dir, is_file, stat) for all entries of a directory,
+        stat is only filled in when no d_type hints are available
+        '''
+        if scandir is not None:
+            return [(entry.name,
+                     entry.is_dir(follow_symlinks=False),
+                     entry.is_file(follow_symlinks=False),
+                     None)
+                    for entry in scandir(directory)]
+        entries = []
+        for name in os.listdir(directory):
+            st = os.lstat(os.path.join(directory, name))
+            entries.append((name,
+                            stat.S_ISDIR(st.st_mode),
+                            stat.S_ISREG(st.st_mode),
+                            st))
+        return entries
+
+    def walk_dir(self, directory):
+        '''
+        Lists a directory, queues its subdirectories and returns the
+        results for its files
+        '''
+        batch = []
+        try:
+            entries = self.list_dir(directory)
+        except OSError:
+            print "Folder not found... {0}".format(directory)
+            return batch
+        for name, is_dir, is_file, st in entries:
+            fullname = os.path.join(directory, name)
+            if is_dir:
+                if self.want_dir is not None and not self.want_dir(fullname):
+                    continue
+                with self.lock:
+                    self.pending += 1
+                self.dirs.put(fullname)
+            elif is_file:
+                if self.match is not None and not self.match(fullname):
+                    continue
+                if st is None:
+                    try:
+                        st = os.lstat(fullname)
+                    except OSError:
+                        # deleted while we were looking at it
+                        continue
+                batch.append((fullname, st))
+        return batch
+
+    def put(self, item):
+        '''
+        Queues a result unless the consumer went away
+        '''
+        while not self.stopped:
+            try:
+                self.results.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def work(self):
+        '''
+        The threads main loop
+        '''
+        while not self.stopped:
+            directory = self.dirs.get()
+            if directory is None:
+                break
+            batch = self.walk_dir(directory)
+            if batch:
+                self.put(batch)
+            with self.lock:
+                self.pending -= 1
+                self.count['dirs'] += 1
+                done = self.pending == 0
+            if done:
+                # wake up the other threads and the consumer
+                for _ in range(self.threads):
+                    self.dirs.put(None)
+                self.put(None)
+
+    def __iter__(self):
+        t_start = time.time()
+        self.pending = 1
+        self.dirs.put(self.directory)
+        workers = []
+        for _ in range(self.threads):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            workers.append(thread)
+        try:
+            while 1:
+                batch = self.results.get()
+                if batch is None:
+                    break
+                for item in batch:
+                    self.count['files'] += 1
+                    yield item
+        finally:
+            self.stopped = True
+            for _ in range(self.threads):
+                self.dirs.put(None)
+            for thread in workers:
+                thread.join()
+            self.count['seconds'] = time.time() - t_start
+
+    def stats(self):
+        '''
+        Returns the counters of the walk including the files per second
+        '''
+        result = dict(self.count)
+        if result['seconds']:
+            result['files_per_sec'] = result['files'] / result['seconds']
+        else:
+            result['files_per_sec'] = 0
+        return result
+
+
+class FileReader(object):
+    '''
+    Reads the files of a job in batches. The files of a batch are read in
+    the order of their device and inode, which is close to their order on
+    disk for most filesystems, and the kernel is told to read all of them
+    ahead with posix_fadvise(WILLNEED) before the first one is read.
+
+    Every file is read with as few read()-calls as possible into a buffer
+    sized from its stat-result. Empty files are not opened at all and files
+    larger than max_bytes are skipped. The skipped files and those that
+    vanished or could not be read are collected in self.dropped, the
+    cache must not keep serving an older copy of them. The bytes read and
+    the syscalls issued are counted in self.count.
+
+    The optional bytes_rate and files_rate limit the reading to that many
+    bytes and files per second.
+    '''
+
+    def __init__(self, batch=256, max_bytes=0, bytes_rate=0, files_rate=0):
+        self.batch = batch
+        self.max_bytes = max_bytes
+        self.bytes_bucket = TokenBucket(bytes_rate)
+        self.files_bucket = TokenBucket(files_rate)
+        # the (path, stat) waiting to be read
+        self.pending = []
+        # the paths of the last batch that were not read
+        self.dropped = []
+        self.count = {'files': 0,
+                      'bytes': 0,
+                      'syscalls': 0,
+                      'empty': 0,
+                      'skipped': 0,
+                      'throttled': 0.0,
+                      'paused': 0.0}
+
+    def add(self, fn, st):
+        '''
+        Queues a file for reading, returns True once the batch is full
+        '''
+        self.pending.append((fn, st))
+        return len(self.pending) >= self.batch
+
+    def read_file(self, fd, size):
+        '''
+        Reads size bytes from fd, less if the file shrunk in the meantime.
+        A file that grew is read up to its size at stat()-time, its new
+        signature makes the next run read it again.
+        '''
+        fdata = os.read(fd, size)
+        self.count['syscalls'] += 1
+        if len(fdata) == size or not fdata:
+            return fdata
+        parts = [fdata]
+        got = len(fdata)
+        while got < size:
+            part = os.read(fd, size - got)
+            self.count['syscalls'] += 1
+            if not part:
+                break
+            parts.append(part)
+            got += len(part)
+        return ''.join(parts)
+
+    def flush(self):
+        '''
+        Reads the pending files and returns their (path, stat, data), files
+        that were skipped, vanished or could not be read are left out and
+        listed in self.dropped
+        '''
+        batch = []
+        self.dropped = []
+        for fn, st in self.pending:
+            if st.st_size == 0:
+                self.count['empty'] += 1
+                batch.append((fn, st, ''))
+            elif self.max_bytes and st.st_size > self.max_bytes:
+                self.count['skipped'] += 1
+                self.dropped.append(fn)
+            else:
+                batch.append((fn, st, None))
+        self.pending = []
+
+        batch.sort(key=lambda item: (item[1].st_dev, item[1].st_ino))
+        # open everything first to have the readahead of the
+        # whole batch running while we read the first files
+        fds = []
+        for fn, st, fdata in batch:
+            if fdata is not None:
+                fds.append(None)
+                continue
+            try:
+                fd = os.open(fn, os.O_RDONLY)
+            except OSError:
+                fds.append(None)
+                continue
+            self.count['syscalls'] += 1
+            if _fadvise is not None:
+                _fadvise(fd, 0, st.st_size, POSIX_FADV_WILLNEED)
+                self.count['syscalls'] += 1
+            fds.append(fd)
+
+        result = []
+        for (fn, st, fdata), fd in zip(batch, fds):
+            if fd is not None:
+                self.count['throttled'] += self.files_bucket.take(1)
+                self.count['throttled'] += self.bytes_bucket.take(st.st_size)
+                try:
+                    fdata = self.read_file(fd, st.st_size)
+                except OSError as err:
+                    if err.errno != errno.EISDIR:
+                        print "WORKER:  failed to read {0}: {1}".format(fn, err)
+                    fdata = None
+                finally:
+                    os.close(fd)
+                    self.count['syscalls'] += 1
+            if fdata is None:
+                self.dropped.append(fn)
+                continue
+            self.count['files'] += 1
+            self.count['bytes'] += len(fdata)
+            result.append((fn, st, fdata))
+        return result
+
+
 class FSWorker(multiprocessing.Process):
     '''
-    Instantiates a StatWalker to walk a directory and filters the returned files
-    by name. On a match the files path and data is saved in a dict which is
-    returned to the caller once traversing the directory is finished.
+    A long-lived worker of the FSCaches worker-pool. It waits for jobs from
+    the FSCache, instantiates a StatWalker to walk the jobs directory and
+    filters the returned files by name. On a match the files path and data
+    are collected and streamed back to the FSCache in delta-chunks.
     '''
 
-    def __init__(self, opts, name, **kwargs):
+    def __init__(self, opts, wid, backoff=None):
         super(FSWorker, self).__init__()
-        self.name = name
-        self.path = kwargs.get('path', None)
-        self.pattern = kwargs.get('patt', None)
+        self.wid = wid
+        self.daemon = True
         self.opts = opts
+        # the Backoffs of the FSCaches shards telling us to pause while
+        # the requests of one of them are slow
+        self.backoff = backoff
         self.serial = salt.payload.Serial(self.opts.get('serial', ''))
-        self.set_nice()
+        self.reset({})
+
+    def reset(self, job):
+        '''
+        Sets up the state for the next job received from the FSCache
+        '''
+        self.job_name = job.get('name', None)
+        self.path = job.get('path', None)
+        # the compiled 'patt', 'include', 'exclude' and 'prune' of the job
+        self.filter = PathFilter.from_job(job)
+        # only read files that changed since the last run
+        self.incr = job.get('incr', False)
+        # the {path: stat_sig} of the last run as known by the FSCache
+        self.manifest = job.get('manifest', {})
+        # the generation of this run, assigned by the FSCache
+        self.gen = job.get('gen', 0)
+        # the FSCache-shard that dispatched the run
+        self.shard = job.get('shard', 0)
+        # the max size and number of files of a single delta-chunk
+        self.chunk_bytes = job.get('chunk_bytes', 4 * 1024 * 1024)
+        self.chunk_files = job.get('chunk_files', 1000)
+        # the fields to extract from the decoded files, see project()
+        self.proj_spec = job.get('proj', {})
+        # the single files to read instead of walking the directory
+        self.paths = job.get('paths', None)
+        # the threads of the ParallelWalker, 1 uses the Statwalker as does
+        # a missing scandir, and the number of result-batches it may queue up
+        self.walk_threads = job.get('walk_threads', self.opts.get('fsc_walk_threads', 4))
+        self.walk_depth = job.get('walk_depth', 1024)
+        # the files read in one sorted batch, the size above which files
+        # are not read at all and the bytes and files read per second,
+        # 0 for no limit
+        self.reader = FileReader(job.get('read_batch', self.opts.get('fsc_read_batch', 256)),
+                                 job.get('max_file_bytes', self.opts.get('fsc_max_file_bytes', 0)),
+                                 job.get('max_bps', 0),
+                                 job.get('max_fps', 0))
+
+        # the current chunk and its sequence number within this run
+        self.seq = 0
+        self.data = {}
+        self.sigs = {}
+        self.proj = {}
+        self.deleted = []
+        self.c_bytes = 0
+        self.c_files = 0
 
     def set_nice(self):
         '''
-        Set the ionice-ness very low to harm the disk as little as possible.
-        Not all systems might have a recent enough psutils-package, but we 
-        try anyway.
+        Lowers our cpu- and io-priority to harm the masters request-path as
+        little as possible. The io-class defaults to idle, with fsc_ioprio
+        set to 'be' fsc_ioprio_level is used.
         '''
-        try:
-            self.proc = psutil.Process(os.getpid())
-            self.proc.set_ionice(psutil.IOPRIO_CLASS_IDLE)
-        except NameError:
-            pass
+        nice = self.opts.get('fsc_nice', 10)
+        if nice:
+            os.nice(nice)
+        set_ioprio(self.opts.get('fsc_ioprio', 'idle'),
+                   self.opts.get('fsc_ioprio_level', 7))
 
     def verify(self):
         '''
@@ -102,64 +521,309 @@ class FSWorker(multiprocessing.Process):
         if os.path.isdir(self.path):
             return True
 
-    def run(self):
+    def send_chunk(self, socks, last=False):
         '''
-        Main loop that searches directories and retrieves the data
+        Pushes the collected upserts and deletes as the next delta-chunk of
+        this run to the FSCache. Once the sockets high-water-mark is reached
+        this blocks until the FSCache caught up, which bounds our memory.
+        With several shards the chunk is split up, see send_split().
+
+        {'job': <name>, 'gen': <run-generation>, 'seq': <chunk-number>,
+         'last': <True for the final chunk of a run>,
+         'load': <True if the chunk holds files requested with 'paths'>,
+         'upsert': {<path>: <data>}, 'sigs': {<path>: <stat_sig>},
+         'proj': {<path>: {<field>: <value>}}, 'delete': [<path>, ...],
+         'io': <the FileReaders counters, only in the last chunk>}
         '''
-        # the socket for outgoing cache-update-requests to FSCache
-        context = zmq.Context()
-        socket = context.socket(zmq.REQ)
-        socket.setsockopt(zmq.LINGER, 100)
-        socket.connect("ipc:///tmp/fsc_upd")
-        time.sleep(1)
+        chunk = {'job': self.job_name,
+                 'gen': self.gen,
+                 'seq': self.seq,
+                 'last': last,
+                 'load': self.paths is not None,
+                 'upsert': self.data,
+                 'delete': self.deleted,
+                 'sigs': self.sigs,
+                 'proj': self.proj}
+        if last:
+            chunk['io'] = self.reader.count
+        if len(socks) > 1:
+            self.send_split(socks, chunk)
+        else:
+            socks[0].send(self.serial.dumps(chunk))
+        self.seq += 1
+        self.data = {}
+        self.sigs = {}
+        self.proj = {}
+        self.deleted = []
+        self.c_bytes = 0
+        self.c_files = 0
+
+    def send_split(self, socks, chunk):
+        '''
+        Sends each shard the part of a chunk with the files it owns. The
+        shard that dispatched the run gets the signatures and deletes of
+        all files to keep the complete manifest of the job, and is the only
+        one that is told about the end of the run.
+        '''
+        parts = {}
+        for key in ('upsert', 'sigs', 'proj'):
+            for fn, value in chunk[key].iteritems():
+                part = parts.setdefault(shard_of(fn, len(socks)), {})
+                part.setdefault(key, {})[fn] = value
+        for fn in chunk['delete']:
+            part = parts.setdefault(shard_of(fn, len(socks)), {})
+            part.setdefault('delete', []).append(fn)
+
+        for shard, socket in enumerate(socks):
+            part = parts.get(shard, {})
+            if shard != self.shard and not part:
+                continue
+            sub = dict(chunk)
+            sub['upsert'] = part.get('upsert', {})
+            sub['proj'] = part.get('proj', {})
+            if shard == self.shard:
+                sub['sigs'] = chunk['sigs']
+                sub['delete'] = chunk['delete']
+            else:
+                sub['sigs'] = part.get('sigs', {})
+                sub['delete'] = part.get('delete', [])
+                sub['last'] = False
+                sub.pop('io', None)
+            socket.send(self.serial.dumps(sub))
+
+    def chunk_full(self):
+        '''
+        Checks wether the current chunk reached its size- or file-limit
+        '''
+        return self.c_bytes >= self.chunk_bytes or self.c_files >= self.chunk_files
+
+    def add_proj(self, fn):
+        '''
+        Decodes a file and adds its projection to the current chunk, files
+        that can not be decoded get an empty projection
+        '''
+        try:
+            self.proj[fn] = project(self.serial.loads(self.data[fn]), self.proj_spec)
+        except Exception:
+            self.proj[fn] = {}
 
-        data = {}
+    def add_file(self, socks, fn, sig, fdata):
+        '''
+        Adds a changed file and its data to the current chunk
+        '''
+        self.sigs[fn] = sig
+        self.data[fn] = fdata
+        if self.proj_spec:
+            self.add_proj(fn)
+        self.c_bytes += len(fn) + len(self.data[fn])
+        self.c_files += 1
+        if self.chunk_full():
+            self.send_chunk(socks)
+
+    def add_deleted(self, socks, fn):
+        '''
+        Reports a file that is gone in the current chunk
+        '''
+        self.deleted.append(fn)
+        self.c_bytes += len(fn)
+        self.c_files += 1
+        if self.chunk_full():
+            self.send_chunk(socks)
+
+    def read_batch(self, socks):
+        '''
+        Reads the files queued in the FileReader into the current chunk.
+        Files that were not read are reported as deleted, without their
+        signature they are looked at again on the next run.
+        '''
+        if self.backoff is not None:
+            self.reader.count['paused'] += self.backoff.pause()
+        for fn, st, fdata in self.reader.flush():
+            self.add_file(socks, fn, stat_sig(st), fdata)
+        for fn in self.reader.dropped:
+            self.add_deleted(socks, fn)
+
+    def load_paths(self, socks):
+        '''
+        Reads the single files the FSCache asked for, files that do not
+        exist anymore are reported as deleted
+        '''
+        for fn in self.paths:
+            try:
+                st = os.stat(fn)
+                if not stat.S_ISREG(st.st_mode):
+                    raise OSError
+            except OSError:
+                self.add_deleted(socks, fn)
+                continue
+            if self.reader.add(fn, st):
+                self.read_batch(socks)
+        self.read_batch(socks)
+        self.send_chunk(socks, last=True)
+
+    def run_job(self, socks):
+        '''
+        Searches the jobs directory and streams the data to the FSCache
+        '''
+        seen = set()
 
         # create shortcut to prevent manymany dot-lookups in the loop
-        dir_n = os.path.dirname
+        old_sig = self.manifest.get
 
         if self.verify():
             print "WORKER({0}):  {1} running in dir {2}".format(self.pid, 
-                                                                self.name,
+                                                                self.job_name,
                                                                 self.path)
-            for fn, _ in Statwalker(self.path):
-                # add a few more checks data:
-                # - dont open empty files
-                # - what to add to the dict for empty files?
-                if rematch(self.pattern, fn):
-                    data[fn] = {}
-                    #data[fn] = 'test'
-                    data[fn] = salt.utils.fopen(fn, 'rb').read()
-            # send the data back to the caller
-            socket.send(self.serial.dumps(data))
-            ack = self.serial.loads(socket.recv())
-            if ack == 'OK':
-                print "WORKER:  {0} finished".format(self.name)
+            # without the d_type hints of scandir the ParallelWalker has to
+            # stat() every entry, the Statwalker does not do worse then
+            if self.walk_threads > 1 and scandir is not None:
+                walker = ParallelWalker(self.path,
+                                        self.walk_threads,
+                                        self.walk_depth,
+                                        match=self.filter.match,
+                                        want_dir=self.filter.want_dir)
+            else:
+                match = self.filter.match
+                walker = ((fn, st)
+                          for fn, st in Statwalker(self.path, self.filter.want_dir)
+                          if match(fn))
+            for fn, st in walker:
+                seen.add(fn)
+                # unchanged files are already in the cache
+                if self.incr and old_sig(fn) == stat_sig(st):
+                    continue
+                if self.reader.add(fn, st):
+                    self.read_batch(socks)
+            self.read_batch(socks)
+            self.reader.count['walked'] = len(seen)
+            # files we knew about last time but did not see anymore
+            for fn in self.manifest:
+                if fn not in seen:
+                    self.add_deleted(socks, fn)
+            # send the remaining data back to the caller
+            self.send_chunk(socks, last=True)
+            rstats = self.reader.count
+            if isinstance(walker, ParallelWalker):
+                wstats = walker.stats()
+                print "WORKER:  {0} finished, {1} files/s, read {2} bytes in {3} syscalls".format(self.job_name,
+                                                                                              int(wstats['files_per_sec']),
+                                                                                              rstats['bytes'],
+                                                                                              rstats['syscalls'])
+            else:
+                print "WORKER:  {0} finished, read {1} bytes in {2} syscalls".format(self.job_name,
+                                                                                 rstats['bytes'],
+                                                                                 rstats['syscalls'])
         else:
-            # directory does not exist, return empty result dict
-            socket.send(self.serial.dumps({self.path: None}))
+            # directory does not exist, tell the cache the job failed
+            socks[self.shard].send(self.serial.dumps({'job': self.job_name,
+                                                      'gen': self.gen,
+                                                      'error': 'no such directory: {0}'.format(self.path)}))
+
+    def run(self):
+        '''
+        Main loop that waits for jobs from the FSCache and executes them
+        '''
+        self.set_nice()
+
+        context = zmq.Context()
+        # the sockets for incoming jobs from the FSCache, with fsc_shards
+        # set every shard may dispatch jobs to us. We tell all of them when
+        # we are ready for a job and when we took one, they only send jobs
+        # to workers that are ready.
+        shards = self.opts.get('fsc_shards', 1)
+        jobs_in = []
+        poller = zmq.Poller()
+        for shard in range(shards):
+            socket = context.socket(zmq.DEALER)
+            socket.setsockopt(zmq.LINGER, 100)
+            socket.connect(ipc_addr(self.opts, 'jobs', shard))
+            poller.register(socket, zmq.POLLIN)
+            jobs_in.append(socket)
+
+        # the sockets for the stream of cache-updates to each shard. The
+        # linger makes sure queued chunks are delivered before we exit.
+        socks = []
+        for shard in range(shards):
+            socket = context.socket(zmq.PUSH)
+            socket.setsockopt(zmq.LINGER, 30000)
+            socket.setsockopt(zmq.SNDHWM, 4)
+            socket.connect(ipc_addr(self.opts, 'upd', shard))
+            socks.append(socket)
+
+        print "WORKER({0}):  #{1} started".format(self.pid, self.wid)
+        ready = self.serial.dumps({'ready': True, 'wid': self.wid})
+        for socket in jobs_in:
+            socket.send(ready)
+        while 1:
+            try:
+                events = dict(poller.poll())
+            except (KeyboardInterrupt, zmq.ZMQError):
+                break
+            frame = None
+            for shard, socket in enumerate(jobs_in):
+                if events.get(socket) != zmq.POLLIN:
+                    continue
+                try:
+                    frame = socket.recv(zmq.NOBLOCK)
+                except zmq.Again:
+                    continue
+                break
+            if frame is None:
+                continue
+            job = self.serial.loads(frame)
+            # anything but a job-dict tells us to exit
+            if not isinstance(job, dict):
+                break
+            for other, socket in enumerate(jobs_in):
+                busy = {'busy': True, 'wid': self.wid}
+                if other == shard:
+                    busy.update({'job': job.get('name'),
+                                 'gen': job.get('gen'),
+                                 'load': 'paths' in job})
+                socket.send(self.serial.dumps(busy))
+            self.reset(job)
+            if self.paths is not None:
+                self.load_paths(socks)
+            else:
+                self.run_job(socks)
+            # dont keep the manifest around until the next job
+            self.reset({})
+            for socket in jobs_in:
+                socket.send(ready)
+
+        for socket in jobs_in:
+            socket.close()
+        for socket in socks:
+            socket.close()
+        context.term()
 
 # test code for the FSWalker class
 if __name__ == '__main__':
     context = zmq.Context()
-    cupd_in = context.socket(zmq.REP)
+    jobs_out = context.socket(zmq.ROUTER)
+    jobs_out.setsockopt(zmq.LINGER, 100)
+    jobs_out.bind("ipc:///tmp/fsc_jobs")
+
+    cupd_in = context.socket(zmq.PULL)
     cupd_in.setsockopt(zmq.LINGER, 100)
     cupd_in.bind("ipc:///tmp/fsc_upd")
 
     poller = zmq.Poller()
     poller.register(cupd_in, zmq.POLLIN)
     serial = salt.payload.Serial('msgpack')
-    fsw = FSWorker({'serial': 'msgpack'},
-                    'test',
-                    **{'path': '/tmp', 'patt': '.*'})
+    fsw = FSWorker({'serial': 'msgpack'}, 0)
     fsw.start()
+    # wait for the worker to be ready
+    worker, _ = jobs_out.recv_multipart()
+    jobs_out.send_multipart([worker, serial.dumps({'name': 'test', 'path': '/tmp', 'patt': '.*'})])
 
     while 1:
         socks = dict(poller.poll())
         if socks.get(cupd_in) == zmq.POLLIN:
             reply = serial.loads(cupd_in.recv())
-            print reply
-            cupd_in.send(serial.dumps('OK'))
-        break
+            print reply.get('upsert')
+            if reply.get('last', True):
+                break
+    jobs_out.send_multipart([worker, serial.dumps('stop')])
     fsw.join()
     sys.exit(0)
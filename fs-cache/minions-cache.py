@@ -15,85 +15,459 @@ import salt.payload
 import salt.utils
 from salt.exceptions import CommandExecutionError
 from multiprocessing.pool import ThreadPool
-import random
+import itertools
 import zmq
 import time
+from fsshm import ShmReader
+from fsworker import ipc_addr, shard_name, shard_of
+from fsstats import Histogram
+
+log = logging.getLogger(__name__)
+
+class CacheUnavailable(Exception):
+    '''
+    Raised when the FSCache did not answer in time or is known to be down
+    '''
+
+
+class CircuitBreaker(object):
+    '''
+    Stops us from asking a cache that failed threshold times in a row. Once
+    open, requests fail right away for reset seconds, then a single request
+    is let through to probe the cache again.
+    '''
+
+    def __init__(self, threshold=3, reset=5):
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.open_until = 0
+
+    def allow(self):
+        '''
+        Checks wether the next request may be sent
+        '''
+        if self.failures < self.threshold:
+            return True
+        if time.time() >= self.open_until:
+            # half-open, one request probes the cache
+            self.open_until = time.time() + self.reset
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.open_until = time.time() + self.reset
+
 
 class CacheCli(object):
+    '''
+    The client of the FSCache. Every request has a deadline and is retried
+    retries times on a fresh socket. If the cache does not answer or the
+    circuit-breaker is open, the data is read from disk instead.
+
+    The deadline grows with the work a request asks for: single paths get
+    timeout milliseconds, lists of paths fsc_cli_path_timeout more for each
+    path and requests going over a whole job like glob, index or snapshot
+    get fsc_cli_bulk_timeout. The bulk requests accept their own timeout.
+
+    With fsc_shards set, single paths are asked from the shard owning them,
+    lists of paths are split up by shard and the other requests go to all
+    shards. The shards are asked at once and their replies merged.
+    '''
 
-    def __init__(self, opts, timeout=20):
+    def __init__(self, opts, timeout=20, read_through=False):
         self.opts = opts
-        self.timeout = timeout
+        self.shards = self.opts.get('fsc_shards', 1)
+        # the milliseconds to wait for a reply, read-through requests
+        # wait for the FSCache to load the files from disk as well
+        self.timeout = self.opts.get('fsc_cli_timeout', timeout)
+        self.load_timeout = self.timeout + self.opts.get('fsc_load_timeout', 5) * 1000
+        self.path_timeout = self.opts.get('fsc_cli_path_timeout', 0.1)
+        self.bulk_timeout = self.opts.get('fsc_cli_bulk_timeout', 2000)
+        self.retries = self.opts.get('fsc_cli_retries', 1)
+        self.breakers = [CircuitBreaker(self.opts.get('fsc_cli_failures', 3),
+                                        self.opts.get('fsc_cli_reset', 5))
+                         for _ in range(self.shards)]
+        # let the FSCache load files from disk that it does not know yet
+        self.read_through = read_through
+        # wether the last reply needed the FSCache to load from disk
+        # and wether the last request had to read from disk itself
+        self.loaded = False
+        self.fallback = False
+        # the ids of the requests count up, a late reply on a socket
+        # can never be taken for the reply to a later request
+        self.msgids = itertools.count(1)
+        # the latencies of get() and get_many() by outcome
+        self.latency = {'hit': Histogram(),
+                        'miss': Histogram(),
+                        'load': Histogram(),
+                        'fallback': Histogram()}
         self.setup()
 
     def setup(self):
         self.context = zmq.Context()
-        self.cache_cli = self.context.socket(zmq.REQ)
-        self.cache_cli.connect('ipc:///tmp/fsc_cache')
-
         self.poll = zmq.Poller()
-        self.poll.register(self.cache_cli, zmq.POLLIN)
+        self.socks = [None] * self.shards
+        for shard in range(self.shards):
+            self.connect(shard)
 
         self.serial = salt.payload.Serial(self.opts.get('serial', ''))
 
-    def get(self, path):
+        # read directly from the FSCaches memory-mapped stores if it has them
+        if self.opts.get('fsc_shm_path', None):
+            self.shms = [ShmReader(shard_name(self.opts, self.opts['fsc_shm_path'], shard))
+                         for shard in range(self.shards)]
+        else:
+            self.shms = None
+
+    def connect(self, shard):
+        '''
+        Opens a new socket to a shard of the FSCache
+        '''
+        sock = self.context.socket(zmq.REQ)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.connect(ipc_addr(self.opts, 'cache', shard))
+        self.socks[shard] = sock
+        self.poll.register(sock, zmq.POLLIN)
 
-        # add random id to cache-request to have a 1:1 relation
-        msgid = random.randint(10000, 20000)
-        msg = [msgid, path]
+    def reconnect(self, shard):
+        '''
+        Throws away a socket stuck waiting for a reply, a REQ-socket can
+        not send again before it received one
+        '''
+        self.poll.unregister(self.socks[shard])
+        self.socks[shard].close()
+        self.connect(shard)
 
+    def deadline(self, query):
+        '''
+        Returns the milliseconds to wait for the reply to a query
+        '''
+        if isinstance(query, list):
+            return self.timeout + len(query) * self.path_timeout
+        if not isinstance(query, dict):
+            return self.timeout
+        if query.get('op') in ('glob', 'index', 'snapshot'):
+            return self.bulk_timeout
+        timeout = self.load_timeout if query.get('load') else self.timeout
+        return timeout + len(query.get('paths', ())) * self.path_timeout
+
+    def request(self, query, shard=0, timeout=None):
+        '''
+        Sends a query to a shard of the FSCache and returns the data of its
+        reply. See FSCache.handle_request() for the possible queries. Raises
+        CacheUnavailable if there was no reply within the deadline.
+        '''
+        replies = self.request_shards({shard: query}, timeout)
+        if shard not in replies:
+            raise CacheUnavailable('no reply from shard {0}'.format(shard))
+        return replies[shard]
+
+    def request_shards(self, queries, timeout=None):
+        '''
+        Sends {<shard>: <query>} to the shards at once and returns the data
+        of their replies as {<shard>: <data>}. Shards that did not answer
+        within the deadline, answered with an error or whose circuit-breaker
+        is open are left out. Without a timeout the deadline of the slowest
+        query is used.
+        '''
+        pending = dict((shard, query) for shard, query in queries.iteritems()
+                       if self.breakers[shard].allow())
+        if timeout is None:
+            timeout = max([self.deadline(query) for query in pending.itervalues()] or [0])
+
+        self.loaded = False
+        replies = {}
+        for _ in range(self.retries + 1):
+            if not pending:
+                break
+            # add an id to cache-request to have a 1:1 relation
+            msgids = {}
+            for shard, query in pending.iteritems():
+                msgids[shard] = next(self.msgids)
+                self.socks[shard].send(self.serial.dumps([msgids[shard], query]))
+            deadline = time.time() + timeout / 1000.0
+            while msgids:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    break
+                ready = dict(self.poll.poll(wait * 1000))
+                if not ready:
+                    break
+                for shard, msgid in msgids.items():
+                    if ready.get(self.socks[shard]) != zmq.POLLIN:
+                        continue
+                    reply = self.serial.loads(self.socks[shard].recv())
+                    del msgids[shard]
+                    # we expect to receive only lists with our id
+                    # and the data for the requested file, others
+                    # are asked again in the next round
+                    if isinstance(reply, list) and len(reply) >= 2 and reply[0] == msgid:
+                        del pending[shard]
+                        self.breakers[shard].success()
+                        if len(reply) > 3 and reply[3]:
+                            log.error('FSCache shard {0} failed a request: {1}'.format(shard,
+                                                                                      reply[3]))
+                            continue
+                        self.loaded = self.loaded or len(reply) > 2 and reply[2]
+                        replies[shard] = reply[1]
+            # no reply at all, wait for the next one
+            # on a new socket (lazy pirate)
+            for shard in msgids:
+                self.reconnect(shard)
+        for shard in pending:
+            self.breakers[shard].failure()
+        return replies
+
+    def read_file(self, path):
+        '''
+        Reads a file from disk when the FSCache is not available
+        '''
+        try:
+            with salt.utils.fopen(path, 'rb') as fhandle:
+                return fhandle.read()
+        except (IOError, OSError):
+            return None
+
+    def get(self, path):
+        '''
+        Returns the cached data of a path or {} if its not cached
+        '''
+        t_start = time.time()
+        shard = shard_of(path, self.shards)
+        if self.shms is not None:
+            fdata = self.shms[shard].get(path)
+            if fdata is not None:
+                self.latency['hit'].add(time.time() - t_start)
+                return fdata
         try:
-            # send a request to the FSCache. If we get to here after
-            # the cache was too slow before, the send() will fail but we try
-            # anyway going by EAFP rules.
-            self.cache_cli.send(self.serial.dumps(msg))
-        except zmq.error.ZMQError:
-            # on failure we do a dummy recv()and resend the last msg. That
-            # keeps us from having to re-init the socket on failure.
-            self.cache_cli.recv()
-            self.cache_cli.send(self.serial.dumps(msg))
-
-        to_max = self.timeout*5
-        to_count = 0 
-        self.loop = 0
+            if self.read_through:
+                fdata = self.request({'op': 'get', 'path': path, 'load': True}, shard)
+            else:
+                fdata = self.request(path, shard)
+        except CacheUnavailable:
+            fdata = self.read_file(path)
+            self.latency['fallback'].add(time.time() - t_start)
+            return fdata if fdata is not None else {}
+        if self.loaded:
+            self.latency['load'].add(time.time() - t_start)
+        elif fdata is not None:
+            self.latency['hit'].add(time.time() - t_start)
+        else:
+            self.latency['miss'].add(time.time() - t_start)
+        if fdata is not None:
+            return fdata
+        return {}
 
+    def get_many(self, paths, timeout=None):
+        '''
+        Returns {<path>: <data>} for a list of paths in a single request,
+        paths that are not cached have None as their data. The latency
+        counts as a miss if any path was not cached.
+        '''
+        t_start = time.time()
+        self.loaded = False
+        self.fallback = False
+        if self.shms is None:
+            found = self.request_many(list(paths), timeout)
+        else:
+            # only ask the FSCache for what is not in the store
+            found = {}
+            missing = []
+            for path in paths:
+                found[path] = self.shms[shard_of(path, self.shards)].get(path)
+                if found[path] is None:
+                    missing.append(path)
+            if missing:
+                found.update(self.request_many(missing, timeout))
+        if self.fallback:
+            outcome = 'fallback'
+        elif self.loaded:
+            outcome = 'load'
+        elif None in found.values():
+            outcome = 'miss'
+        else:
+            outcome = 'hit'
+        self.latency[outcome].add(time.time() - t_start)
+        return found
+
+    def request_many(self, paths, timeout=None):
+        '''
+        Requests a list of paths from the shards owning them
+        '''
+        by_shard = {}
+        for path in paths:
+            by_shard.setdefault(shard_of(path, self.shards), []).append(path)
+        queries = {}
+        for shard, s_paths in by_shard.iteritems():
+            if self.read_through:
+                queries[shard] = {'op': 'mget', 'paths': s_paths, 'load': True}
+            else:
+                queries[shard] = s_paths
+        replies = self.request_shards(queries, timeout)
+        found = {}
+        for shard, s_paths in by_shard.iteritems():
+            if shard in replies:
+                found.update(replies[shard] or {})
+            else:
+                self.fallback = True
+                found.update((path, self.read_file(path)) for path in s_paths)
+        return found
+
+    def get_glob(self, patt, timeout=None):
+        '''
+        Returns {<path>: <data>} for all cached paths matching a shell-pattern,
+        the files the FSCache evicted from memory are read from disk
+        '''
+        replies = self.request_shards(dict((shard, {'op': 'glob', 'patt': patt})
+                                           for shard in range(self.shards)),
+                                      timeout)
+        found = {}
+        for data in replies.itervalues():
+            found.update(data or {})
+        for path, fdata in found.items():
+            if fdata is None:
+                found[path] = self.read_file(path)
+        if len(replies) < self.shards:
+            found.update((path, self.read_file(path)) for path in glob.glob(patt)
+                         if shard_of(path, self.shards) not in replies)
+        return found
+
+    def lookup(self, job, field, values, timeout=None):
+        '''
+        Returns {<path>: [<value>, ...]} for all paths whose projected field
+        in the given cache-job matches any of the values, or None if the job
+        has no projection or a shard of the FSCache is not available
+        '''
+        query = {'op': 'index',
+                 'job': job,
+                 'field': field,
+                 'values': list(values)}
+        replies = self.request_shards(dict((shard, query) for shard in range(self.shards)),
+                                      timeout)
+        if len(replies) < self.shards or None in replies.values():
+            return None
+        found = {}
+        for data in replies.itervalues():
+            found.update(data)
+        return found
+
+class CacheReplica(object):
+    '''
+    A local copy of the files and projections of a cache-job. It is loaded
+    with a snapshot from the FSCache and kept up to date with the change-
+    events the FSCache publishes with fsc_pub set. Reads are plain dict-
+    lookups once the pending events were applied with update().
+
+    Events are numbered per job and shard, a missed event makes the replica
+    load a new snapshot. Snapshots may take a while, they get fsc_sync_timeout
+    seconds and a failed one is not tried again for fsc_sync_retry seconds.
+    '''
+
+    def __init__(self, opts, job, cli=None):
+        self.opts = opts
+        self.job = job
+        self.cli = cli or CacheCli(opts)
+        self.serial = salt.payload.Serial(self.opts.get('serial', ''))
+        # {path: data} and {path: {field: value}} of the job
+        self.files = {}
+        self.proj = {}
+        # the number of the last event applied per shard, None until synced
+        self.seq = None
+        self.resyncs = 0
+        self.sync_timeout = self.opts.get('fsc_sync_timeout', 30) * 1000
+        self.sync_retry = self.opts.get('fsc_sync_retry', 5)
+        # no new snapshot is asked for before this time
+        self.sync_after = 0
+
+        self.context = zmq.Context()
+        self.sub = self.context.socket(zmq.SUB)
+        self.sub.setsockopt(zmq.LINGER, 0)
+        self.sub.setsockopt(zmq.SUBSCRIBE, '{0}\0'.format(job))
+        for shard in range(self.cli.shards):
+            self.sub.connect(ipc_addr(self.opts, 'events', shard))
+
+    def sync(self):
+        '''
+        Replaces the replica with a snapshot of the job from every shard,
+        returns False if one of them was not available
+        '''
+        if time.time() < self.sync_after:
+            return False
+        query = {'op': 'snapshot', 'job': self.job}
+        snaps = self.cli.request_shards(dict((shard, query)
+                                             for shard in range(self.cli.shards)),
+                                        self.sync_timeout)
+        if len(snaps) < self.cli.shards or None in snaps.values():
+            self.sync_after = time.time() + self.sync_retry
+            return False
+        self.files = {}
+        self.proj = {}
+        self.seq = {}
+        for shard, snap in snaps.iteritems():
+            self.files.update(snap['files'])
+            self.proj.update(snap['proj'])
+            self.seq[shard] = snap['seq']
+        return True
+
+    def apply(self, event):
+        '''
+        Applies a change-event, events from before the snapshot are skipped
+        '''
+        shard = event.get('shard', 0)
+        seq = self.seq.get(shard, 0)
+        if event['seq'] <= seq:
+            return True
+        if event['seq'] != seq + 1:
+            return False
+        self.files.update(event['upsert'])
+        self.proj.update(event['proj'])
+        for path in event['delete']:
+            self.files.pop(path, None)
+            self.proj.pop(path, None)
+        self.seq[shard] = event['seq']
+        return True
+
+    def update(self):
+        '''
+        Applies all pending events without waiting for new ones
+        '''
+        if self.seq is None and not self.sync():
+            return
         while 1:
-            self.loop += 1
-            # we wait cache_timout*5
-            self.socks = dict(self.poll.poll())
-            if self.socks.get(self.cache_cli) == zmq.POLLIN:
-                reply = self.serial.loads(self.cache_cli.recv())
-
-                # no reply is broken, we brake the loop
-                if not reply:
+            try:
+                _, frame = self.sub.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            if not self.apply(self.serial.loads(frame)):
+                # we lost events, start over
+                self.resyncs += 1
+                self.seq = None
+                if not self.sync():
                     break
 
-                # we expect to receive only lists with an id
-                # and the data for the requested file
-                if isinstance(msg, list):
-                    # first field must be our matching request-id
-                    if msgid == reply[0]:
-                        if reply[1] is not None:
-                            return reply[1]
-                        else:
-                            return {}
-                        # received reply for request, enable the
-                        # break the loop to make way for next request
-                        break
-                # None is a cache miss, we have to go to disk
-                elif msg is None:
-                    print "MAIN:  cache miss..."
-                # we should never get here
-                else:
-                    raise zmq.error.ZMQError, "invalid state in FSCache-communication"
-            break
-        return {}
+    def get(self, path):
+        '''
+        Returns the data of a path or None
+        '''
+        self.update()
+        return self.files.get(path)
+
+    def close(self):
+        self.sub.close()
+        self.context.term()
+
 
 class CkMinions(object):
     '''
     Used to check what minions should respond from a target
     '''
-    def __init__(self, opts, from_cache=False):
+    def __init__(self, opts, from_cache=False, read_through=False, replica=False):
         self.opts = opts
         self.serial = salt.payload.Serial(opts)
         if self.opts['transport'] == 'zeromq':
@@ -102,9 +476,17 @@ class CkMinions(object):
             self.acc = 'accepted'
 
         if from_cache:
-            self.cache = CacheCli(self.opts)
+            self.cache = CacheCli(self.opts, read_through=read_through)
         else:
             self.cache = None
+        # keep a local replica of the grains-job up to date
+        # instead of asking the cache every time
+        if from_cache and replica:
+            self.replica = CacheReplica(self.opts,
+                                        self.opts.get('fsc_grains_job', 'grains'),
+                                        self.cache)
+        else:
+            self.replica = None
 
     def connected_ids(self, subset=None, show_ipv4=False, **kwargs):
         '''
@@ -116,17 +498,66 @@ class CkMinions(object):
             if not os.path.isdir(cdir):
                 return minions
             addrs = salt.utils.network.local_port_tcp(int(self.opts['publish_port']))
-            if subset:
+            if self.cache:
+                # let the cache intersect its ipv4-index with the connected
+                # addresses, that spares us decoding every minions data.
+                # The index only knows minions that were walked already,
+                # with read-through a subset is fetched and loaded instead.
+                # A replica does the same with its local projections.
+                if self.replica is not None:
+                    self.replica.update()
+                if self.replica is not None and self.replica.seq is not None:
+                    hits = {}
+                    for datap, fields in self.replica.proj.iteritems():
+                        hits[datap] = [addr for addr in fields.get('ipv4', [])
+                                       if addr in addrs and addr not in ('127.0.0.1', '0.0.0.0')]
+                    if not self.replica.proj:
+                        hits = None
+                elif subset and self.cache.read_through:
+                    hits = None
+                else:
+                    hits = self.cache.lookup(self.opts.get('fsc_grains_job', 'grains'),
+                                             'ipv4',
+                                             [addr for addr in addrs
+                                              if addr not in ('127.0.0.1', '0.0.0.0')])
+                if hits is not None:
+                    for datap, ipv4s in hits.iteritems():
+                        id_ = os.path.basename(os.path.dirname(datap))
+                        if not ipv4s or subset and id_ not in subset:
+                            continue
+                        if show_ipv4:
+                            minions.add((id_, ipv4s[0]))
+                        else:
+                            minions.add(id_)
+                    return minions
+
+                # without a projection fetch all minions data in a single request
+                if self.replica is not None and self.replica.seq is not None:
+                    cached = self.replica.files
+                    if subset:
+                        cached = dict((datap, fdata) for datap, fdata in cached.iteritems()
+                                      if os.path.basename(os.path.dirname(datap)) in subset)
+                elif subset:
+                    cached = self.cache.get_many(
+                        [os.path.join(cdir, id_, 'data.p') for id_ in subset]
+                    )
+                else:
+                    cached = self.cache.get_glob(os.path.join(cdir, '*', 'data.p'))
+                search = [os.path.basename(os.path.dirname(datap))
+                          for datap, fdata in cached.iteritems()
+                          if fdata is not None]
+            elif subset:
                 search = subset
             else:
                 search = os.listdir(cdir)
             for id_ in search:
                 datap = os.path.join(cdir, id_, 'data.p')
+                grains = {}
 
                 if self.cache:
                     try:
                         grains = self.serial.loads(
-                            self.cache.get(datap)
+                            cached[datap]
                         ).get('grains', {})
                     except AttributeError:
                         pass